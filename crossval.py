@@ -0,0 +1,64 @@
+import argparse
+import os
+import time
+
+import pandas as pd
+
+from punches_lib import crossval, sweep
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="ii", choices=["cnn", "ii"], help="'cnn' cross-validates the CNN of main_cnn.py (outlier scores from OpenMax), 'ii' the II-loss network of main_ii.py (default: ii).")
+    parser.add_argument("--num_folds", type=int, default=5, help="number of stratified folds (default: 5).")
+    parser.add_argument("--num_procs", type=int, default=1, help="number of folds trained concurrently, one process each (default: 1).")
+    parser.add_argument("--num_threads", type=int, default=None, help="number of threads of each process (default: None -> the cores split evenly among the processes).")
+    parser.add_argument("--root_data", type=str, default="data/train", help="root of the labelled data split into folds (default: data/train).")
+    parser.add_argument("--root_openset", type=str, default="data/openset", help="root of ood data, scored by the model of every fold (default: data/openset).")
+    parser.add_argument("--image_size", type=int, default=256, help="size of the decoded images (default: 256).")
+    parser.add_argument("--cache_dir", type=str, default=None, help="folder of the decoded images shared by the processes, e.g. on /dev/shm; reused across runs (default: None -> <out_dir>/cache).")
+    parser.add_argument("--out_dir", type=str, default="crossval", help="folder where the results of the folds (folds.csv) and their summary (summary.csv) are saved (default: crossval).")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size (default: 32).")
+    parser.add_argument("--epochs", type=int, default=20, help="number of epochs to train (default: 20).")
+    parser.add_argument("--lr", type=float, default=0.001, help="learning rate (default: 0.001).")
+    parser.add_argument("--lr_decay_gamma", type=float, default=0.1, help="learning rate decay factor (default: 0.1).")
+    parser.add_argument("--lr_decay_epochs", type=int, nargs="*", default=[10, 15], help="learning rate decay epochs (default: 10 and 15).")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class (default: resnet18).")
+    parser.add_argument("--use_pretrained", action="store_true", default=False, help="use ImageNet-pretrained model, for 'cnn' (default: False).")
+    parser.add_argument("--tail_size", type=int, default=20, help="number of largest distances to the MAV fitted by each Weibull model of OpenMax, for 'cnn' (default: 20).")
+    parser.add_argument("--alpha_rank", type=int, default=10, help="number of top classes whose activations are recalibrated by OpenMax, for 'cnn' (default: 10).")
+    parser.add_argument("--pretrained_params_path", type=str, default=None, help="path to pretrained params, for 'ii' (default: None).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of the latent space where II-loss is computed, for 'ii' (default: 32).")
+    parser.add_argument("--lambda_ii", type=float, default=1, help="weight of the II-loss, for 'ii' (default: 1).")
+    parser.add_argument("--delta_ii", type=float, default=float("inf"), help="delta (margin) for the II-loss, for 'ii' (default: infinite).")
+    parser.add_argument("--confidence", type=float, default=0.95, help="level of the confidence intervals of the metrics (default: 0.95).")
+    parser.add_argument("--device", type=str, default="cpu", help="device of the folds (default: cpu).")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the folds and of the training (default: 0).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    cache_dir = args.cache_dir or os.path.join(args.out_dir, "cache")
+    os.makedirs(args.out_dir, exist_ok=True)
+    print(f"Decoding the images into {cache_dir}")
+    config = vars(args).copy()
+    config["image_cache"] = sweep.cache_images(args.root_data, os.path.join(cache_dir, "images_data"), args.image_size, args.batch_size, args.num_procs)
+    config["open_cache"] = sweep.cache_images(args.root_openset, os.path.join(cache_dir, "images_open"), args.image_size, args.batch_size, args.num_procs)
+
+    start = time.perf_counter()
+    results = crossval.cross_validate(config, args.num_folds, args.num_procs, args.num_threads, args.seed)
+    wall_time = time.perf_counter() - start
+    summary = crossval.summarize_folds(results, args.confidence)
+    results.to_csv(os.path.join(args.out_dir, "folds.csv"), index=False)
+    summary.to_csv(os.path.join(args.out_dir, "summary.csv"), index=False)
+
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(results.to_string(index=False))
+        print(f"Mean and {args.confidence:.0%} confidence interval over {args.num_folds} folds")
+        print(summary.to_string(index=False))
+    # sum of the training times of the folds over the wall-clock time: close to --num_procs if the folds scale linearly
+    print(f"Wall-clock time {wall_time:.1f} s, speedup over sequential folds {results.seconds.sum() / wall_time:.2f}x with {args.num_procs} processes")
+    print(f"Results saved to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
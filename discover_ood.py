@@ -0,0 +1,76 @@
+import argparse
+import re
+
+import numpy as np
+import torch
+
+from punches_lib import calibration, discovery
+from punches_lib.ii_loss import registry
+from punches_lib.score_cache import ScoreCache
+from punches_lib.storage import ScoreStore
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--score_store", type=str, required=True, help="folder of the score store filled by ii_outscores.py, watch_scores.py or gan_eval.py.")
+    parser.add_argument("--splits", type=str, nargs="+", default=["crops"], help="splits of the store whose rejected crops are clustered (default: crops).")
+    parser.add_argument("--model_id", type=str, default=None, help="model id of the scores in the store (default: None -> the store must contain a single model).")
+    parser.add_argument("--column", type=str, default="outlier_score", choices=["outlier_score", "disc_score"], help="score used to reject the crops: II-loss outlier scores at least --threshold, or OpenGAN discriminator outputs below --threshold (default: outlier_score).")
+    parser.add_argument("--threshold", type=float, default=None, help="rejection threshold on --column. Required if --thresholds_path is not specified (default: None).")
+    parser.add_argument("--thresholds_path", type=str, default=None, help="path to the per-class thresholds saved by ii_calibrate_thresholds.py, replacing --threshold: each crop is compared with the threshold of its predicted class. Only for --column outlier_score (default: None).")
+    parser.add_argument("--score_cache", type=str, required=True, help="folder of the per-image score cache of the II-loss evaluation pass (--score_cache of ii_outscores.py), holding the embeddings.")
+    parser.add_argument("--cache_fingerprint", type=str, default=None, help="fingerprint of the II-loss model whose cached embeddings are used, i.e. the name of its sub-folder of --score_cache. Required unless --column is outlier_score and --model_id is a default id of ii_outscores.py, <params file name>:<fingerprint> (default: None -> the part of --model_id after ':').")
+    parser.add_argument("--num_clusters", type=int, default=50, help="number of clusters (default: 50).")
+    parser.add_argument("--num_epochs", type=int, default=1, help="number of passes of mini-batch k-means over the embeddings (default: 1).")
+    parser.add_argument("--chunk_size", type=int, default=65536, help="number of embeddings in memory at once (default: 65536).")
+    parser.add_argument("--num_exemplars", type=int, default=10, help="number of exemplars listed per cluster (default: 10).")
+    parser.add_argument("--mean_embedding_path", type=str, default=None, help="path to the mean embeddings of the known classes, to report the closest known class of each cluster (default: None).")
+    parser.add_argument("--out_dir", type=str, default="model/discovery", help="folder where the prototypes, clusters, exemplars and assignments are saved (default: model/discovery).")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    assert (args.threshold is None) != (args.thresholds_path is None), "Exactly one of --threshold and --thresholds_path must be provided."
+    store = ScoreStore(args.score_store)
+    model_id = args.model_id
+    if model_id is None:
+        models = store.categories("model")
+        assert len(models) == 1, f"The store contains scores for {len(models)} models ({models}): please specify --model_id."
+        model_id = models[0]
+    fingerprint = args.cache_fingerprint
+    if fingerprint is None:
+        # only the default model ids of ii_outscores.py end with the fingerprint of the score cache holding the embeddings: the ids of
+        # gan_eval.py hash the discriminator, those of openmax_outscores.py and watch_scores.py have a different format
+        match = re.fullmatch(r"[^:]+:([0-9a-f]{16})", model_id)
+        assert args.column == "outlier_score" and match is not None, f"Cannot infer the score cache of the embeddings from the model id {model_id} (--column {args.column}): please specify --cache_fingerprint, the sub-folder of --score_cache written by ii_outscores.py or ii_test.py."
+        fingerprint = match.group(1)
+
+    thresholds = calibration.load_thresholds(args.thresholds_path) if args.thresholds_path is not None else None
+    rejected = [discovery.rejected_crops(store, split, args.threshold, args.column, model_id, thresholds) for split in args.splits]
+    paths = np.concatenate([r["path"] for r in rejected])
+    scores = np.concatenate([r["score"] for r in rejected])
+    # a crop may appear in several splits
+    _, first = np.unique(paths, return_index=True)
+    paths, scores = paths[np.sort(first)], scores[np.sort(first)]
+    print(f"{len(paths)} rejected crops in splits {args.splits}")
+
+    embeddings, rows = discovery.cached_embeddings(ScoreCache(args.score_cache, fingerprint), paths)
+    missing = rows < 0
+    if missing.any():
+        # the backbone is never run here: crops without cached embeddings are skipped
+        print(f"Skipping {missing.sum()} rejected crops without cached embeddings")
+        paths, scores, rows = paths[~missing], scores[~missing], rows[~missing]
+    assert len(rows) > 0, "No embeddings to cluster."
+
+    kmeans = discovery.fit_clusters(embeddings, rows, args.num_clusters, args.chunk_size, args.num_epochs, args.seed)
+    assignments = discovery.assign_clusters(embeddings, rows, kmeans, args.num_exemplars, args.chunk_size)
+    traindata_means, class_names = None, None
+    if args.mean_embedding_path is not None:
+        traindata_means = registry.load_means(args.mean_embedding_path)
+        class_names = registry.load_classes(args.mean_embedding_path)
+    discovery.write_report(args.out_dir, kmeans, paths, scores, assignments, traindata_means, class_names)
+    print(f"Clusters, exemplars and assignments saved to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import time
+
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+from punches_lib import datasets, distributed
+from punches_lib.cnn import models as cnn_models, train as train_cnn
+from punches_lib.ii_loss import ii_loss, models as ii_models, train as train_ii
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default="ii", choices=["ii", "cnn"], help="model to train: 'ii' for ResNetCustom with II-loss and CE, 'cnn' for a plain classifier (default: ii).")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class (default: resnet18).")
+    parser.add_argument("--world_sizes", type=int, nargs="+", default=[1, 2, 4, 8], help="numbers of processes to test (default: 1 2 4 8).")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size per process (default: 32).")
+    parser.add_argument("--num_batches", type=int, default=10, help="number of batches per process timed for each world size (default: 10).")
+    parser.add_argument("--root_train", type=str, default=None, help="root of training data. If None, random images are used, so that only the compute is measured (default: None).")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes of the random data (default: 19).")
+    parser.add_argument("--image_size", type=int, default=256, help="size of the random images (default: 256).")
+    parser.add_argument("--dist_port", type=int, default=29500, help="port used by the processes to communicate (default: 29500).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the report is saved (default: None).")
+    return parser.parse_args()
+
+def get_trainset(args, world_size):
+    if args.root_train is not None:
+        return datasets.get_dataset(args.root_train, transforms=datasets.get_bare_transforms())
+    num_images = args.batch_size * args.num_batches * world_size
+    trainset = torch.utils.data.TensorDataset(torch.randn(num_images, 3, args.image_size, args.image_size), torch.randint(args.num_classes, (num_images,)))
+    trainset.classes = list(range(args.num_classes))
+    return trainset
+
+def worker(rank, world_size, args, queue):
+    distributed.setup(rank, world_size, master_port=args.dist_port)
+    trainset = get_trainset(args, world_size)
+    # one epoch of num_batches batches per process
+    trainset = torch.utils.data.Subset(trainset, range(min(len(trainset), args.batch_size * args.num_batches * world_size)))
+    trainset.classes = trainset.dataset.classes
+    trainloader = distributed.get_dataloader(trainset, args.batch_size, num_workers=0)
+    num_classes = len(trainset.classes)
+    if args.model_type == "ii":
+        net = distributed.wrap_model(ii_models.ResNetCustom(num_classes, args.model_class))
+        optimizer = torch.optim.Adam(net.parameters())
+        train_fn = lambda num_epochs: train_ii.train_model(net, trainloader, ii_loss.IILoss(distributed=True), torch.nn.CrossEntropyLoss(), num_epochs, optimizer, device="cpu")
+    else:
+        net = distributed.wrap_model(cnn_models.get_model(args.model_class, num_classes=num_classes))
+        optimizer = torch.optim.Adam(net.parameters())
+        train_fn = lambda num_epochs: train_cnn.train_model(net, trainloader, torch.nn.CrossEntropyLoss(), optimizer, num_epochs, device="cpu")
+
+    # warmup epoch, then a timed one
+    train_fn(1)
+    torch.distributed.barrier()
+    start = time.perf_counter()
+    train_fn(1)
+    torch.distributed.barrier()
+    elapsed = time.perf_counter() - start
+    if distributed.is_main_process():
+        queue.put(elapsed)
+    distributed.cleanup()
+
+def main():
+    args = get_args()
+    queue = mp.get_context("spawn").SimpleQueue()
+    results = []
+    for world_size in args.world_sizes:
+        print(f"Running with {world_size} processes")
+        distributed.launch(worker, world_size, args, queue)
+        elapsed = queue.get()
+        results.append({"world_size": world_size, "seconds_per_epoch": elapsed, "throughput": args.batch_size * args.num_batches * world_size / elapsed})
+    report = pd.DataFrame(results)
+    baseline = report["throughput"].iloc[0] / report["world_size"].iloc[0]
+    report["speedup"] = report["throughput"] / report["throughput"].iloc[0]
+    # weak scaling: each process trains on the same number of images
+    report["scaling_efficiency"] = report["throughput"] / (report["world_size"] * baseline)
+    print(report.to_string(index=False))
+    if args.report_path is not None:
+        report.to_csv(args.report_path, index=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from punches_lib import metrics
+from punches_lib.gan import architecture, compression, data, test, train
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path_features_train", type=str, default=None, help="path of the layer4 features of the trainset (torch.save tensor or .npy file) (default: None -> synthetic features).")
+    parser.add_argument("--path_features_valid", type=str, default=None, help="path of the layer4 features of the validation set (ID) (default: None -> synthetic features).")
+    parser.add_argument("--path_features_open", type=str, default=None, help="path of the layer4 features of the open set (OOD) (default: None -> synthetic features).")
+    parser.add_argument("--num_synthetic", type=int, default=512, help="number of synthetic feature maps per set, if the paths are not given (default: 512).")
+    parser.add_argument("--levels", type=str, nargs="+", default=["none,512,8,float32", "pca,128,8,float32", "pca,128,4,float32", "pca,64,4,float16", "random,64,4,float16"], help="compression levels, as projection,channels,spatial size,storage dtype (default: none,512,8,float32 pca,128,8,float32 pca,128,4,float32 pca,64,4,float16 random,64,4,float16).")
+    parser.add_argument("--epochs", type=int, default=5, help="number of training epochs per level (default: 5).")
+    parser.add_argument("--batch_size", type=int, default=64, help="batch size (default: 64).")
+    parser.add_argument("--lr", type=float, default=0.0001, help="learning rate (default: 0.0001).")
+    parser.add_argument("--nz", type=int, default=100, help="size of the latent vector of the generator (default: 100).")
+    parser.add_argument("--ngf", type=int, default=64, help="size of feature maps in generator (default: 64).")
+    parser.add_argument("--ndf", type=int, default=64, help="size of feature maps in discriminator (default: 64).")
+    parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the results are saved (default: None).")
+    return parser.parse_args()
+
+def load_features(path, num_synthetic, shift, generator):
+    if path is None:
+        # non-negative, ReLU-like maps; the OOD set is shifted on a subset of the channels
+        features = torch.randn(num_synthetic, 512, 8, 8, generator=generator)
+        features[:, :64] += shift
+        return features.relu()
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    return torch.load(path, map_location="cpu")
+
+def main():
+    args = get_args()
+    if args.device is None:
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    generator = torch.Generator().manual_seed(args.seed)
+    features_train = load_features(args.path_features_train, args.num_synthetic, 0.0, generator)
+    features_valid = load_features(args.path_features_valid, args.num_synthetic, 0.0, generator)
+    features_open = load_features(args.path_features_open, args.num_synthetic, 1.0, generator)
+
+    results = []
+    for level in args.levels:
+        projection, channels, spatial_size, dtype = level.split(",")
+        channels, spatial_size = int(channels), int(spatial_size)
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        compressor = compression.fit_compressor(features_train, None if projection == "none" else channels, "pca" if projection == "none" else projection, spatial_size, dtype == "float16")
+        train_compressed = compressor.compress(features_train)
+        fit_time = time.perf_counter() - start
+        nc = compressor.num_channels(features_train.shape[1])
+
+        netG = architecture.Generator(nz=args.nz, ngf=args.ngf, nc=nc)
+        netD = architecture.DiscriminatorFunnel(nc=nc, ndf=args.ndf, spatial_size=spatial_size)
+        netG.apply(architecture.weights_init)
+        netD.apply(architecture.weights_init)
+        optimizerD = torch.optim.Adam(netD.parameters(), lr=args.lr / 5, betas=(0.5, 0.999))
+        optimizerG = torch.optim.Adam(netG.parameters(), lr=args.lr, betas=(0.5, 0.999))
+        loader = torch.utils.data.DataLoader(data.FeatDataset(data=train_compressed), batch_size=args.batch_size, shuffle=True)
+        fixed_noise = torch.randn(64, args.nz, 1, 1)
+        with tempfile.TemporaryDirectory() as save_dir:
+            start = time.perf_counter()
+            train.train_model(args.epochs, loader, netG, netD, 1, 0, optimizerG, optimizerD, args.nz, fixed_noise, torch.nn.BCELoss(), args.device, save_dir, spatial_size=spatial_size)
+            epoch_time = (time.perf_counter() - start) / args.epochs
+
+        outputs = {}
+        for name, features in (("valid", features_valid), ("open", features_open)):
+            loader = torch.utils.data.DataLoader(data.FeatDataset(data=compressor.compress(features)), batch_size=args.batch_size, shuffle=False)
+            outputs[name], _ = test.evalutate_data(netD, loader, args.device)
+        results.append({
+            "level": level,
+            "nc": nc,
+            "spatial_size": spatial_size,
+            "fit_s": fit_time,
+            "epoch_s": epoch_time,
+            "features_mb": train_compressed.element_size() * train_compressed.nelement() / 2**20,
+            "discriminator_params": sum(p.numel() for p in netD.parameters()),
+            # the discriminator outputs are lower for OOD data
+            "auroc": metrics.auroc(-outputs["open"], -outputs["valid"]),
+        })
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.report_path is not None:
+        if (folder := os.path.dirname(args.report_path)) != "":
+            os.makedirs(folder, exist_ok=True)
+        results.to_csv(args.report_path, index=False)
+
+if __name__ == "__main__":
+    main()
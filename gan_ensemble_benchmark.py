@@ -0,0 +1,68 @@
+import argparse
+import tempfile
+import time
+
+import pandas as pd
+import torch
+
+from punches_lib.gan import architecture, data, ensemble, train
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ensemble_sizes", type=int, nargs="+", default=[1, 4, 8], help="numbers of members M compared (default: 1 4 8).")
+    parser.add_argument("--num_features", type=int, default=512, help="number of synthetic training feature maps (default: 512).")
+    parser.add_argument("--nc", type=int, default=64, help="number of channels of the features, e.g. after compression (default: 64).")
+    parser.add_argument("--spatial_size", type=int, default=4, help="spatial size of the features (default: 4).")
+    parser.add_argument("--nz", type=int, default=100, help="size of the latent vector of the generators (default: 100).")
+    parser.add_argument("--ngf", type=int, default=16, help="size of feature maps in the generators (default: 16).")
+    parser.add_argument("--ndf", type=int, default=16, help="size of feature maps in the discriminators (default: 16).")
+    parser.add_argument("--epochs", type=int, default=2, help="number of timed epochs (default: 2).")
+    parser.add_argument("--batch_size", type=int, default=64, help="batch size (default: 64).")
+    parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the results are saved (default: None).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.device is None:
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    features = torch.randn(args.num_features, args.nc, args.spatial_size, args.spatial_size).relu()
+    loader = torch.utils.data.DataLoader(data.FeatDataset(data=features), batch_size=args.batch_size, shuffle=True)
+
+    results = []
+    for num_members in args.ensemble_sizes:
+        # M separate runs of train.train_model
+        start = time.perf_counter()
+        for member in range(num_members):
+            torch.manual_seed(member)
+            netG = architecture.Generator(nz=args.nz, ngf=args.ngf, nc=args.nc)
+            netD = architecture.DiscriminatorFunnel(nc=args.nc, ndf=args.ndf, spatial_size=args.spatial_size)
+            optimizerD = torch.optim.Adam(netD.parameters(), lr=0.0001 / 5, betas=(0.5, 0.999))
+            optimizerG = torch.optim.Adam(netG.parameters(), lr=0.0001, betas=(0.5, 0.999))
+            with tempfile.TemporaryDirectory() as save_dir:
+                train.train_model(args.epochs, loader, netG, netD, 1, 0, optimizerG, optimizerD, args.nz, torch.randn(4, args.nz, 1, 1), torch.nn.BCELoss(), args.device, save_dir, spatial_size=args.spatial_size)
+        separate_time = time.perf_counter() - start
+
+        # one vectorized run of the M members
+        start = time.perf_counter()
+        gans = ensemble.GANEnsemble(num_members, nz=args.nz, ngf=args.ngf, nc=args.nc, ndf=args.ndf, spatial_size=args.spatial_size)
+        optimizerD = torch.optim.Adam(gans.discriminators.parameters(), lr=0.0001 / 5, betas=(0.5, 0.999))
+        optimizerG = torch.optim.Adam(gans.generators.parameters(), lr=0.0001, betas=(0.5, 0.999))
+        ensemble.train_ensemble(args.epochs, loader, gans, optimizerG, optimizerD, args.device)
+        ensemble_time = time.perf_counter() - start
+
+        results.append({
+            "num_members": num_members,
+            "separate_s": separate_time,
+            "ensemble_s": ensemble_time,
+            "speedup": separate_time / ensemble_time,
+            "ensemble_s_per_member": ensemble_time / num_members,
+        })
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.report_path is not None:
+        results.to_csv(args.report_path, index=False)
+
+if __name__ == "__main__":
+    main()
@@ -4,17 +4,20 @@ from torch.utils.data import Dataset, DataLoader
 from torch import nn
 import argparse
 from typing import Union
+import pandas as pd
 
-from punches_lib.gan import models, models_experimental as me, features,  testing, utils
-from punches_lib import datasets
+from punches_lib.gan import architecture, compression, data, ensemble, plot, test
+from punches_lib import datasets, metrics, score_cache
+from punches_lib import utils as punches_utils
+from punches_lib.storage import ScoreStore
 
 
 
 def load_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--discriminator_path", type=str, required=True, help="Path where the params for the discriminator are stored.")
-    parser.add_argument("--discriminator_type", type=str, default="classic", choices=["classic", "experimental"], help="Type of discriminator to use. Options: funnel, conv, dense.")
+    parser.add_argument("--discriminator_path", type=str, required=True, help="Path where the params for the discriminator are stored, or the ensemble.pth saved by main_gan.py with --ensemble_size > 1: the outputs are then the mean over the discriminators of the ensemble, reported along with their variance.")
     parser.add_argument("--input_channel_dim", type=int, default=512, help="Number of channels of the input data (the features representation of the images --- default: 512).")
+    parser.add_argument("--compressor_path", type=str, default=None, help="Path of the feature compressor saved by main_gan.py with --compressor_path. The features are compressed with it before the discriminator, whose number of channels and spatial size follow from it (default: None).")
     parser.add_argument("--base_width", type=int, default=64, help="Base width (i.e., minimum number of output channels) per hidden conv layer in discriminator and generator (default: 64).")
     parser.add_argument("--batch_size", type=int, default=128, help="Batch size for evaluating the features (default: 128).")
     parser.add_argument("--validset_root", type=str, default=None, help="Root where the validation data are stored (default: None).")
@@ -23,31 +26,74 @@ def load_args():
     parser.add_argument("--path_features_valid", type=str, default=None, help="Path from where the features for the validation dataset will be loaded from. If None, features will be calculated at runtime but not saved. For recalculating the features and saving them in this path, toggle the switch --force_feats_recalculation (default: None).")
     parser.add_argument("--path_features_open", type=str, default=None, help="Path from where the features for the open data dataset will be loaded from. If None, features will be calculated at runtime but not saved. For recalculating the features and saving them in this path, toggle the switch --force_feats_recalculation (default: None).")
     parser.add_argument("--path_features_crops", type=str, default=None, help="")
-    parser.add_argument("--force_feats_recalculation", action="store_true", default=False, help="Force recalculation of the features even if --backbone_network_feats is passed")
+    parser.add_argument("--force_feats_recalculation", action="store_true", default=False, help="Force recalculation of the features even if they are found at --path_features_*")
     parser.add_argument("--backbone_network_feats", type=str, choices=["resnet18", "resnet34", "resnet50", None], default=None, help="Backbone network for obtaining the features (default: None).")
     parser.add_argument("--backbone_network_params", type=str, default=None, help="Path to the state_dict containing the parameters for the pretrained backbone (default: None)")
     parser.add_argument("--folder_save_outputs", type=str, default=None, help="Folder where to save the outputs after discriminator evaluation (default: None).")
     parser.add_argument("--save_hist_path", type=str, default="hist.png", help="Path where to save the histogram (default: hist.png).")
     parser.add_argument("--by", type=float, default=0.05, help="Calculation of performance: increment used for swiping the axis 0-1 in search of a threshold (default: 0.05).")
     parser.add_argument("--save_performance_path", type=str, default="performance.csv", help="Path where to save the performance as a CSV file (default: performance.csv).")
+    parser.add_argument("--num_bootstrap", type=int, default=2000, help="Number of bootstrap resamples of the outputs for the confidence intervals of AUROC, best W, its threshold and sensitivity/specificity; 0 to skip them (default: 2000).")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Level of the bootstrap confidence intervals (default: 0.95).")
+    parser.add_argument("--save_bootstrap_path", type=str, default=None, help="Path where to save the bootstrap confidence intervals as a CSV file (default: None).")
     parser.add_argument("--rescale_factor", type=float, default=1.0, help="Rescale factor for the embeddings (default: 1.0).")
+    parser.add_argument("--num_procs", type=int, default=1, help="Number of CPU processes the evaluation is sharded across; 0 to choose the split between processes and threads automatically (default: 1).")
     parser.add_argument("--device", type=str, default=None, help="Device to use for the computations (default: None -> use CUDA if available).")
     parser.add_argument("--verbose", action="store_true", default=False, help="Verbose mode (default: False).")
     parser.add_argument("--do_random", action="store_true", default=False, help="Do eval with random sample (default: False).")
+    parser.add_argument("--score_store", type=str, default=None, help="Folder of the score store where the discriminator outputs are appended (default: None).")
+    parser.add_argument("--model_id", type=str, default=None, help="Model id stored with the outputs in the score store (default: None -> <discriminator file name>:<fingerprint of the backbone, the discriminator, --rescale_factor and the compressor>, as the score-cache key).")
+    parser.add_argument("--score_cache", type=str, default=None, help="Folder of the per-image score cache. If specified, the discriminator outputs for the validation and open data are computed from the images (requires --backbone_network_feats and --backbone_network_params) and only the images which are new or modified since the last run with the same backbone and discriminator are evaluated (default: None).")
     args = parser.parse_args()
     return args
 
+def get_features(path, force_recalculation, dataset, get_backbone, batch_size, device, num_procs=1):
+    '''
+    Loads the layer4 features saved at path, or computes them on the dataset with the backbone returned by get_backbone() (and saves them at path,
+    if not None) if they are not found or force_recalculation is set.
+    '''
+    if path is not None and os.path.exists(path) and not force_recalculation:
+        return torch.load(path, map_location="cpu")
+    assert dataset is not None, f"No features found at {path} and no data to compute them."
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+    features, _ = data.get_hidden_features(loader, device, get_backbone(), num_procs=num_procs)
+    if path is not None:
+        torch.save(features, path)
+    return features
+
 def main():
     args = load_args()
+    device = args.device if args.device is not None else punches_utils.use_cuda_if_possible()
     
     # INSTANTIATE DISCRIMINATOR AND LOAD WEIGHTS
-    if args.discriminator_type == "classic":
-        netD = models.DiscriminatorFunnel(num_channels=args.input_channel_dim, base_width=args.base_width)
-    elif args.discriminator_type == "experimental":
-        netD = me.Discriminator(num_channels=args.input_channel_dim, base_width=args.base_width)
+    # the discriminator is evaluated on the features compressed as in training
+    compressor = compression.load_compressor(args.compressor_path) if args.compressor_path is not None else None
+    nc = compressor.num_channels(args.input_channel_dim) if compressor is not None else args.input_channel_dim
+    spatial_size = compressor.spatial_size if compressor is not None else 8
+    compressor_state = compressor.state() if compressor is not None else None
+    state_dict = torch.load(args.discriminator_path, map_location="cpu")
+    if ensemble.is_ensemble_state_dict(state_dict):
+        netD = ensemble.load_ensemble(state_dict, nc=nc, ndf=args.base_width, spatial_size=spatial_size)
     else:
-        raise ValueError("Invalid discriminator type: {}".format(args.discriminator_type))
-    netD.load_state_dict(torch.load(args.discriminator_path))
+        netD = architecture.DiscriminatorFunnel(nc=nc, ndf=args.base_width, spatial_size=spatial_size)
+        netD.load_state_dict(state_dict)
+
+    # variance of the outputs across the members of an ensemble, per split
+    variances = {}
+    def unpack(name, outputs):
+        if outputs is None:
+            return None
+        if "disc_variance" in outputs:
+            variances[name] = outputs["disc_variance"]
+        return outputs["disc_scores"]
+
+    backbone = None
+    def get_backbone():
+        nonlocal backbone
+        if backbone is None:
+            assert args.backbone_network_feats is not None and args.backbone_network_params is not None, "Computing the features requires --backbone_network_feats and --backbone_network_params."
+            backbone = data.create_backbone(args.backbone_network_params, args.backbone_network_feats, device)
+        return backbone
 
     if args.verbose:
         print("...Discriminator loaded.")
@@ -57,55 +103,76 @@ def main():
     dataset_valid = datasets.get_dataset(args.validset_root, transforms=datasets.get_bare_transforms()) if args.validset_root is not None else None
     dataset_open = datasets.get_dataset(args.openset_root, transforms=datasets.get_bare_transforms()) if args.openset_root is not None else None
     if args.do_random:
-        dataset_random = datasets.BasicDataset(torch.randn((500, 3, 256, 256)))
+        dataset_random = datasets.BasicDatasetLabels(torch.randn((500, 3, 256, 256)))
     
     if args.verbose:
         print("\u2713")    
 
         print("...Computing features")
         print("\t\t Validation:", end=" ")
-    valid_features = features.get_features(args.path_features_valid, args.force_feats_recalculation, dataset_valid, args.backbone_network_feats, args.backbone_network_params, args.batch_size, num_classes=19, device=args.device) if dataset_valid is not None else None
-    if args.rescale_factor != 1.0:
+    # paths are only known when the outputs are computed from the images
+    paths = {"valid": None, "open": None}
+    if args.score_cache is not None:
+        paths = {name: [path for path, _ in dataset.samples] if dataset is not None else None for name, dataset in (("valid", dataset_valid), ("open", dataset_open))}
+        cache = score_cache.ScoreCache(args.score_cache, punches_utils.fingerprint(get_backbone(), state_dict, args.rescale_factor, compressor_state))
+        outs_cached = {}
+        for name, dataset in (("valid", dataset_valid), ("open", dataset_open)):
+            if dataset is not None:
+                loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+                outs_cached[name] = test.get_discriminator_outputs(loader, get_backbone(), netD, device, rescale_factor=args.rescale_factor, cache=cache, num_procs=args.num_procs, projection=compressor)
+        # the cached outputs replace the feature computation below
+        dataset_valid = dataset_open = None
+    for name, dataset, features_path in (("valid", dataset_valid, args.path_features_valid), ("open", dataset_open, args.path_features_open)):
+        if dataset is not None and (features_path is None or not os.path.exists(features_path) or args.force_feats_recalculation):
+            # the features are computed below from the images, in the order of the dataset
+            paths[name] = [path for path, _ in dataset.samples]
+
+    valid_features = get_features(args.path_features_valid, args.force_feats_recalculation, dataset_valid, get_backbone, args.batch_size, device, args.num_procs) if dataset_valid is not None else None
+    if args.rescale_factor != 1.0 and valid_features is not None:
         valid_features = torch.nn.functional.interpolate(valid_features, scale_factor=args.rescale_factor, mode='bilinear')
     if args.verbose:
         print("\u2713")
         print("\t\t Open:", end=" ")
-    open_features = features.get_features(args.path_features_open, args.force_feats_recalculation, dataset_open, args.backbone_network_feats, args.backbone_network_params, args.batch_size, num_classes=19, device=args.device) if dataset_open is not None else None
-    if args.rescale_factor != 1.0:
+    open_features = get_features(args.path_features_open, args.force_feats_recalculation, dataset_open, get_backbone, args.batch_size, device, args.num_procs) if dataset_open is not None else None
+    if args.rescale_factor != 1.0 and open_features is not None:
         open_features = torch.nn.functional.interpolate(open_features, scale_factor=args.rescale_factor, mode='bilinear')
     if args.verbose:
         print("\u2713")
 
-    crops_features = features.get_features(args.path_features_crops, args.force_feats_recalculation, None, args.backbone_network_feats, args.backbone_network_params, args.batch_size, num_classes=19, device=args.device) if args.path_features_crops is not None else None
+    crops_features = get_features(args.path_features_crops, False, None, get_backbone, args.batch_size, device) if args.path_features_crops is not None else None
     rand_features = None
     if args.do_random:
-        rand_features = features.get_features(None, True, dataset_random, args.backbone_network_feats, args.backbone_network_params, args.batch_size, num_classes=19, device=args.device)
+        rand_features = get_features(None, True, dataset_random, get_backbone, args.batch_size, device, args.num_procs)
 
     
     # train_features = features.get_features(args.path_features_train, False, None, args.backbone_network_feats, args.backbone_network_params, args.batch_size, num_classes=19) if args.path_features_train is not None else None
 
     # trainloader = DataLoader(datasets.BasicDataset(train_features), batch_size=args.batch_size, shuffle=False, num_workers=4) if train_features is not None else None
-    validloader = DataLoader(datasets.BasicDataset(valid_features), batch_size=args.batch_size, shuffle=False, num_workers=4) if valid_features is not None else None
-    openloader = DataLoader(datasets.BasicDataset(open_features), batch_size=args.batch_size, shuffle=False, num_workers=4) if open_features is not None else None
-    cropsloader = DataLoader(datasets.BasicDataset(crops_features), batch_size=args.batch_size, shuffle=False, num_workers=4) if crops_features is not None else None
-    if args.do_random:
-        randloader = DataLoader(datasets.BasicDataset(rand_features), batch_size=args.batch_size, shuffle=False, num_workers=4) if rand_features is not None else None
     
     # outs_train = testing.get_outputs(netD, trainloader).squeeze() if trainloader is not None else None
     if args.verbose:
         print("...Evaluating discriminator")
         print("\t\t Validation:", end=" ")
-    outs_valid = testing.get_outputs(netD, validloader, device=args.device).squeeze() if validloader is not None else None
+    outs_valid = unpack("valid", test.get_feature_outputs(netD, valid_features, device, args.batch_size, projection=compressor) if valid_features is not None else None)
     if args.verbose:
         print("\u2713")
         print("\t\t Open:", end=" ")
-    outs_open = testing.get_outputs(netD, openloader, device=args.device).squeeze() if openloader is not None else None
+    outs_open = unpack("open", test.get_feature_outputs(netD, open_features, device, args.batch_size, projection=compressor) if open_features is not None else None)
     if args.verbose:
         print("\u2713")
-    outs_crops = testing.get_outputs(netD, cropsloader, device=args.device).squeeze() if cropsloader is not None else None
+    if args.score_cache is not None:
+        outs_valid = unpack("valid", outs_cached.get("valid"))
+        outs_open = unpack("open", outs_cached.get("open"))
+    outs_crops = unpack("crops", test.get_feature_outputs(netD, crops_features, device, args.batch_size, projection=compressor) if crops_features is not None else None)
     outs_rand = None
     if args.do_random:
-        outs_rand = testing.get_outputs(netD, randloader, device=args.device).squeeze() if randloader is not None else None
+        outs_rand = unpack("rand", test.get_feature_outputs(netD, rand_features, device, args.batch_size, projection=compressor))
+
+    if len(variances) > 0:
+        summary = pd.DataFrame([{"split": name, "disc_score": outs.mean().item(), "disc_variance": variances[name].mean().item()}
+                                for name, outs in (("valid", outs_valid), ("open", outs_open), ("crops", outs_crops), ("rand", outs_rand)) if name in variances])
+        print(f"Mean output and variance of the outputs across the {netD.num_members} discriminators of the ensemble")
+        print(summary.to_string(index=False))
 
     
 
@@ -114,11 +181,43 @@ def main():
         # torch.save(outs_train, os.path.join(fold, "train.pt"))
         torch.save(outs_valid, os.path.join(fold, "validouts_valid.pt"))
         torch.save(outs_open, os.path.join(fold, "open.pt"))
+        for name, variance in variances.items():
+            torch.save(variance, os.path.join(fold, f"{name}_variance.pt"))
         print(f"Outputs saved in {args.folder_save_outputs}")
 
+    if args.score_store is not None:
+        store = ScoreStore(args.score_store)
+        if args.model_id is not None:
+            model_id = args.model_id
+        else:
+            # the same inputs as the score-cache key; the backbone is unknown if only precomputed features are evaluated
+            backbone_id = get_backbone() if args.backbone_network_feats is not None and args.backbone_network_params is not None else None
+            model_id = f"{os.path.basename(args.discriminator_path)}:{punches_utils.fingerprint(backbone_id, state_dict, args.rescale_factor, compressor_state)}"
+        for split, outs, features_path in (("valid", outs_valid, args.path_features_valid), ("open", outs_open, args.path_features_open), ("crops", outs_crops, args.path_features_crops), ("rand", outs_rand, None)):
+            if outs is None:
+                continue
+            if paths.get(split) is not None:
+                keys = score_cache.file_keys(paths[split])
+            elif features_path is not None:
+                # the rows of precomputed features are keyed by the feature file, so that a modified file is appended again
+                stat = os.stat(features_path)
+                keys = [(f"{features_path}:{i}", stat.st_size, stat.st_mtime_ns) for i in range(len(outs))]
+            else:
+                keys = [(f"{split}/{i}", -1, -1) for i in range(len(outs))]
+            # only the images (or features) which are new or modified since they were stored for this model are appended
+            already_stored = store.file_keys(split, model_id)
+            new = [i for i, key in enumerate(keys) if key not in already_stored]
+            if len(new) == 0:
+                print(f"[{split}] no new rows")
+                continue
+            new_keys = [keys[i] for i in new]
+            store.append_scores(split, [k[0] for k in new_keys], model_id, disc_scores=outs.reshape(-1)[new],
+                                sizes=[k[1] for k in new_keys], mtimes=[k[2] for k in new_keys])
+            print(f"[{split}] {len(new)} new rows appended to {args.score_store}")
+
     if (fold:=os.path.dirname(args.save_hist_path)) != "":
         os.makedirs(fold, exist_ok=True)
-    testing.plot_hist(outputs_ood=outs_open, outputs_test=outs_valid, outputs_random=outs_rand, outputs_crops=outs_crops, save_path=args.save_hist_path, title="Discriminator validation")
+    plot.plot_hist_outputs({"open": outs_open, "validation": outs_valid, "random": outs_rand, "crops": outs_crops}, save_path=args.save_hist_path, title="Discriminator validation")
 
     additional_outputs = None
     if outs_rand is not None and outs_crops is not None:
@@ -128,7 +227,7 @@ def main():
     elif outs_crops is not None:
         additional_outputs = outs_crops
 
-    perf = testing.get_performance(outs_valid, outs_open, increment=args.by, additional_outputs=additional_outputs) if outs_valid is not None else None
+    perf = test.get_performance(outs_valid, outs_open, increment=args.by, additional_outputs=additional_outputs) if outs_valid is not None else None
     if (fold:=os.path.dirname(args.save_performance_path)) != "":
         os.makedirs(fold, exist_ok=True)
     perf.to_csv(args.save_performance_path)
@@ -138,6 +237,22 @@ def main():
     if additional_outputs is not None:
         print("Best (additional)\n", perf.nlargest(1, "AW"))
 
+    if args.num_bootstrap > 0 and outs_valid is not None and outs_open is not None:
+        # the discriminator outputs are higher for ID data: negated, they are outlier scores, and so are the thresholds
+        thresholds = -torch.arange(0, 1 + args.by / 2, args.by)
+        series = [("W", outs_open)] + ([("AW", torch.cat((outs_open, additional_outputs)))] if additional_outputs is not None else [])
+        intervals = []
+        for name, outs in series:
+            for metric, values in metrics.bootstrap_intervals(-outs_valid.reshape(-1), -outs.reshape(-1), thresholds, args.num_bootstrap, args.confidence).items():
+                if metric == "threshold":
+                    values = {"estimate": -values["estimate"], "ci_low": -values["ci_high"], "ci_high": -values["ci_low"]}
+                intervals.append({"score": name, "metric": metric, **values})
+        intervals = pd.DataFrame(intervals)
+        print(f"Bootstrap {args.confidence:.0%} confidence intervals ({args.num_bootstrap} resamples)")
+        print(intervals.to_string(index=False))
+        if args.save_bootstrap_path is not None:
+            intervals.to_csv(args.save_bootstrap_path, index=False)
+
     
 if __name__ == "__main__":
     main()
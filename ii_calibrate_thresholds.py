@@ -0,0 +1,58 @@
+import argparse
+
+import pandas as pd
+import torch
+
+from punches_lib import calibration
+from punches_lib.ii_loss import registry
+from punches_lib.storage import ScoreStore
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--score_store", type=str, required=True, help="folder of the score store written by ii_outscores.py, holding the outlier scores and the predictions.")
+    parser.add_argument("--model_id", type=str, default=None, help="model id of the scores to read from the store. Can be omitted if the store contains a single model (default: None).")
+    parser.add_argument("--split", type=str, default="valid", help="in-distribution split of the store the thresholds are calibrated on (default: valid).")
+    parser.add_argument("--ood_split", type=str, default=None, help="OOD split of the store on which the specificity of the per-class and of the global thresholds is compared (default: None).")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes in the dataset (default: 19).")
+    parser.add_argument("--sensitivity", type=float, default=0.95, help="target fraction of the in-distribution images of each predicted class accepted by its threshold (default: 0.95).")
+    parser.add_argument("--min_samples", type=int, default=10, help="classes with fewer calibration images use the global threshold, calibrated on all the images for the same sensitivity (default: 10).")
+    parser.add_argument("--mean_embedding_path", type=str, default=None, help="path to the mean embeddings, whose registered punch ids name the classes (default: None).")
+    parser.add_argument("--save_path", type=str, default="model/model_ii_thresholds.pth", help="path where the thresholds will be saved, to be passed as --thresholds_path to ii_test.py, ii_determine_metrics.py and discover_ood.py (default: model/model_ii_thresholds.pth).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    store = ScoreStore(args.score_store)
+    scores = store.scores(args.split, model=args.model_id)
+    preds = store.scores(args.split, column="pred", model=args.model_id)
+    # rows without an outlier score (e.g., appended by gan_eval.py) are not calibrated on
+    scored = ~torch.isnan(scores)
+    scores, preds = scores[scored], preds[scored]
+    assert len(scores) > 0, f"No outlier scores in split {args.split} of {args.score_store}" + (f" for model {args.model_id}" if args.model_id is not None else "")
+    classes = registry.load_classes(args.mean_embedding_path) if args.mean_embedding_path is not None else None
+    thresholds = calibration.calibrate_thresholds(scores, preds, args.num_classes, args.sensitivity, args.min_samples, classes)
+    torch.save(thresholds.state(), args.save_path)
+
+    accepted = thresholds(scores, preds)
+    per_class = pd.DataFrame({
+        "class": range(args.num_classes),
+        "punch_id": classes if classes is not None else range(args.num_classes),
+        "num_items": thresholds.counts.numpy(),
+        "threshold": thresholds.thresholds.numpy(),
+        "sensitivity": [accepted[preds == c].float().mean().item() for c in range(args.num_classes)],
+        "sensitivity_global": [(scores[preds == c] < thresholds.global_threshold).float().mean().item() for c in range(args.num_classes)],
+    })
+    print(f"PER-CLASS THRESHOLDS (target sensitivity {args.sensitivity:.4f}, global threshold {thresholds.global_threshold:.4f})")
+    print(per_class.to_string(index=False))
+
+    if args.ood_split is not None:
+        scores_ood = store.scores(args.ood_split, model=args.model_id)
+        preds_ood = store.scores(args.ood_split, column="pred", model=args.model_id)
+        specificity = (~thresholds(scores_ood, preds_ood)).float().mean().item()
+        specificity_global = (scores_ood >= thresholds.global_threshold).float().mean().item()
+        print(f"Specificity on {args.ood_split}: per-class thresholds {specificity:.4f} | global threshold {specificity_global:.4f}")
+    print(f"Thresholds saved to {args.save_path}")
+
+if __name__ == "__main__":
+    main()
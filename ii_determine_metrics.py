@@ -4,10 +4,11 @@ import pandas as pd
 import torch
 from matplotlib import pyplot as plt
 
-from punches_lib import datasets
+from punches_lib import calibration, datasets, metrics
 from punches_lib.ii_loss import eval as eval_ii
 from punches_lib.ii_loss import models
 from punches_lib.radam import RAdam
+from punches_lib.storage import ScoreStore
 
 
 def get_args():
@@ -16,17 +17,31 @@ def get_args():
     parser.add_argument("--path_outlier_scores_crops", type=str, default="model/model_ii.pth_crops.pth", help="path to the outlier scores of the ood set (default: model/model_ii.pth_crops.pth).")
     parser.add_argument("--path_outlier_scores_ood", type=str, default="model/model_ii.pth_ood.pth", help="path to the outlier scores of the ood set (default: model/model_ii.pth_ood.pth).")
     parser.add_argument("--path_outlier_scores_random", type=str, default="model/model_ii.pth_rand.pth", help="path to the outlier scores of the random dataset (default: model/model_ii.pth_rand.pth).")
+    parser.add_argument("--score_store", type=str, default=None, help="folder of the score store written by ii_outscores.py. If specified, the scores are read from the store instead of the --path_outlier_scores_* files (default: None).")
+    parser.add_argument("--model_id", type=str, default=None, help="model id of the scores to read from the store. Can be omitted if the store contains a single model (default: None).")
     parser.add_argument("--by", type=float, default=0.5, help="interval for threshold grid search (default: 0.5).")
     parser.add_argument("--save_path", type=str, default="model/model_ii_results.csv", help="path where the results will be stored as a csv (default: model/model_ii_results.csv).")
+    parser.add_argument("--num_bootstrap", type=int, default=2000, help="number of bootstrap resamples of the scores for the confidence intervals of AUROC, best W/WA, their thresholds and sensitivity/specificity; 0 to skip them (default: 2000).")
+    parser.add_argument("--confidence", type=float, default=0.95, help="level of the bootstrap confidence intervals (default: 0.95).")
+    parser.add_argument("--thresholds_path", type=str, default=None, help="path to the per-class thresholds saved by ii_calibrate_thresholds.py, whose sensitivity and specificity are reported along with those of the global thresholds. Needs --score_store, which holds the predictions (default: None).")
+    parser.add_argument("--save_path_bootstrap", type=str, default=None, help="path where the bootstrap confidence intervals will be stored as a csv (default: None).")
     return parser.parse_args()
 
 def main():
     args = get_args()
+    assert args.thresholds_path is None or args.score_store is not None, "--thresholds_path needs the predictions of --score_store."
 
-    scores_valid = torch.load(args.path_outlier_scores_valid, map_location="cpu")
-    scores_crops = torch.load(args.path_outlier_scores_crops, map_location="cpu")
-    scores_ood = torch.load(args.path_outlier_scores_ood, map_location="cpu")
-    scores_random = torch.load(args.path_outlier_scores_random, map_location="cpu")
+    if args.score_store is not None:
+        store = ScoreStore(args.score_store)
+        scores_valid = store.scores("valid", model=args.model_id)
+        scores_crops = store.scores("crops", model=args.model_id)
+        scores_ood = store.scores("ood", model=args.model_id)
+        scores_random = store.scores("rand", model=args.model_id)
+    else:
+        scores_valid = torch.load(args.path_outlier_scores_valid, map_location="cpu")
+        scores_crops = torch.load(args.path_outlier_scores_crops, map_location="cpu")
+        scores_ood = torch.load(args.path_outlier_scores_ood, map_location="cpu")
+        scores_random = torch.load(args.path_outlier_scores_random, map_location="cpu")
     all_ood_scores = torch.cat((scores_crops, scores_ood, scores_random))
 
 
@@ -51,6 +66,29 @@ def main():
     print("Best WA")
     print(eval_results.nlargest(1, "WA_sens_spec"))
     eval_results.to_csv(args.save_path)
+
+    if args.num_bootstrap > 0:
+        # W is computed against the ood split, WA against all the OOD splits
+        intervals = []
+        for name, scores_open in (("W", scores_ood), ("WA", all_scores)):
+            for metric, values in metrics.bootstrap_intervals(scores_valid, scores_open, thresholds, args.num_bootstrap, args.confidence).items():
+                intervals.append({"score": name, "metric": metric, **values})
+        intervals = pd.DataFrame(intervals)
+        print(f"Bootstrap {args.confidence:.0%} confidence intervals ({args.num_bootstrap} resamples; id_pct is the validation_pct)")
+        print(intervals.to_string(index=False))
+        if args.save_path_bootstrap is not None:
+            intervals.to_csv(args.save_path_bootstrap, index=False)
+
+    if args.thresholds_path is not None:
+        thresholds = calibration.load_thresholds(args.thresholds_path)
+        accepted = {split: thresholds(store.scores(split, model=args.model_id), store.scores(split, column="pred", model=args.model_id)) for split in ("valid", "crops", "ood", "rand")}
+        validation_pct = accepted["valid"].float().mean().item()
+        ood_pct = (~accepted["ood"]).float().mean().item()
+        all_pct = (~torch.cat((accepted["rand"], accepted["crops"], accepted["ood"]))).float().mean().item()
+        W = 5 * validation_pct * ood_pct / (4*validation_pct + ood_pct)
+        WA = 5 * validation_pct * all_pct / (4*validation_pct + all_pct)
+        print(f"Per-class thresholds ({args.thresholds_path})")
+        print(f"validation_pct: {validation_pct:.4f} | crops_pct: {(~accepted['crops']).float().mean().item():.4f} | ood_pct: {ood_pct:.4f} | all_pct: {all_pct:.4f} | W_sens_spec: {W:.4f} | WA_sens_spec: {WA:.4f}")
     
 
 if __name__ == "__main__":
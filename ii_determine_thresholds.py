@@ -10,12 +10,15 @@ from punches_lib import datasets
 from punches_lib.ii_loss import eval as eval_ii
 from punches_lib.ii_loss import models
 from punches_lib.radam import RAdam
+from punches_lib.storage import ScoreStore
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--path_outlier_scores_valid", type=str, default="model/model_ii.pth_valid.pth", help="path to the outlier scores of the validation set (default: model/model_ii.pth_valid.pth).")
     # parser.add_argument("--path_outlier_scores_crops", type=str, default="model/model_ii.pth_crops.pth", help="path to the outlier scores of the ood set (default: model/model_ii.pth_crops.pth).")
     parser.add_argument("--path_outlier_scores_ood", type=str, default="model/model_ii.pth_ood.pth", help="path to the outlier scores of the ood set (default: model/model_ii.pth_ood.pth).")
+    parser.add_argument("--score_store", type=str, default=None, help="folder of the score store written by ii_outscores.py. If specified, the scores are read from the store instead of the --path_outlier_scores_* files (default: None).")
+    parser.add_argument("--model_id", type=str, default=None, help="model id of the scores to read from the store. Can be omitted if the store contains a single model (default: None).")
     parser.add_argument("--save_path", type=str, default="model/model_ii_hist.png", help="path where the hist will be saved (default: model/model_ii_hist.png).")
     # parser.add_argument("--use_MDPI_font", action="store_true", default=False, help="use the MDPI font.")
     parser.add_argument("--font", type=str, default=None, help="font to use.")
@@ -37,9 +40,14 @@ def main():
                 args.font = None
         rcParams["font.family"] = args.font
 
-    scores_valid = torch.load(args.path_outlier_scores_valid, map_location="cpu")
-    #scores_crops = torch.load(args.path_outlier_scores_crops, map_location="cpu")
-    scores_ood = torch.load(args.path_outlier_scores_ood, map_location="cpu")
+    if args.score_store is not None:
+        store = ScoreStore(args.score_store)
+        scores_valid = store.scores("valid", model=args.model_id)
+        scores_ood = store.scores("ood", model=args.model_id)
+    else:
+        scores_valid = torch.load(args.path_outlier_scores_valid, map_location="cpu")
+        #scores_crops = torch.load(args.path_outlier_scores_crops, map_location="cpu")
+        scores_ood = torch.load(args.path_outlier_scores_ood, map_location="cpu")
 
     fig = plt.figure(figsize=(8,2.5))
     plt.hist(scores_valid.numpy(), bins=75, label="Validation dataset", alpha=0.5, density=True)
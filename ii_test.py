@@ -3,9 +3,9 @@ import argparse
 import torch
 from matplotlib import pyplot as plt
 
-from punches_lib import datasets
+from punches_lib import calibration, datasets, inference, quantization, score_cache, search
 from punches_lib.ii_loss import eval as eval_ii
-from punches_lib.ii_loss import models
+from punches_lib.ii_loss import models, registry, scorers
 from punches_lib.radam import RAdam
 
 from punches_lib import utils
@@ -14,51 +14,106 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_size", type=int, default=128, help="batch size for training (default: 128).")
     parser.add_argument("--num_classes", type=int, default=19, help="number of classes in the dataset (default: 19).")
-    parser.add_argument("--classif_threshold", type=float, required=True, help="Classification threshold acting on outlier score (if outlier score larger than threshold, instance is classified as OOD).")
+    parser.add_argument("--classif_threshold", type=float, default=None, help="Classification threshold acting on outlier score (if outlier score larger than threshold, instance is classified as OOD). Required if --thresholds_path is not specified (default: None).")
+    parser.add_argument("--thresholds_path", type=str, default=None, help="path to the per-class thresholds saved by ii_calibrate_thresholds.py. If specified, each image is compared with the threshold of its predicted class instead of --classif_threshold (default: None).")
     parser.add_argument("--root_test", type=str, default="data/test", help="root of testing data (default: data/test).")
     parser.add_argument("--root_ood_test", type=str, default="data/openset", help="root of ood data for testing (default: data/openset_test).")
     parser.add_argument("--root_crops", type=str, default="data/crops", help="root of crops data (default: data/crops).")
     parser.add_argument("--pretrained_params_path", type=str, default=None, help="path to pretrained params. Ignored if --use_pretrained is not set. If --use_pretrained is set and this arg is left to None, defaults to loading the ImageNet-pretrained params from torchvision (default: None).")
-    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"],help="model class (default: resnet18).")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=models.MODEL_CLASSES, help="model class: a ResNet trained with II-loss or the architecture of a student distilled with main_distill.py (default: resnet18).")
     parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space (default: 32).")
+    parser.add_argument("--quantized_model_path", type=str, default=None, help="path to a quantized TorchScript model saved by quantize.py. If specified, it replaces --pretrained_params_path and the evaluation runs on the CPU (default: None).")
+    parser.add_argument("--optimize_inference", type=str, default=None, choices=["eager", "trace", "compile"], help="optimize the model for inference (BatchNorm folded into the convolutions, channels-last memory format) and optionally trace or compile it. Ignored for quantized models (default: None).")
+    parser.add_argument("--optimized_cache_dir", type=str, default=None, help="folder where the optimized model is cached, keyed by its params (default: None).")
+    parser.add_argument("--num_procs", type=int, default=1, help="number of CPU processes the evaluation is sharded across; 0 to choose the split between processes and threads automatically (default: 1).")
     parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
     parser.add_argument("--mean_embedding_path", type=str, default=None, help="path to the mean embedding. If specified, will use this mean embedding instead of computing the mean embedding from the training data. (default: None).")
     parser.add_argument("--root_train", type=str, default=None, help="root of training data, to use in case the mean embeddings are not provided (default: None).")
+    parser.add_argument("--scorer", type=str, default="euclidean", choices=["euclidean", "mahalanobis", "diagonal", "class_covariance", "knn"], help="outlier score: squared distance to the closest class mean, either Euclidean, Mahalanobis with shared covariance, scaled by per-class variances or Mahalanobis with per-class covariance, or squared distance to the --knn_k-th nearest trainset embedding (knn). Scorers other than euclidean need the moments of the trainset or its embeddings, from --root_train or --moments_path/--gallery_path (default: euclidean).")
+    parser.add_argument("--knn_k", type=int, default=1, help="with --scorer knn, the neighbour whose distance is the outlier score (default: 1).")
+    parser.add_argument("--gallery_path", type=str, default=None, help="path of the float16 gallery of trainset embeddings used by --scorer knn. Loaded if it exists, otherwise computed on --root_train and saved there (default: None).")
+    parser.add_argument("--centroid_index", type=str, default=None, choices=["exact", "ivf"], help="with --scorer euclidean, search the closest class mean with a search index: 'exact' (blocked matrix multiplication) or 'ivf' (approximate inverted file), useful with many classes (default: None -> brute force).")
+    parser.add_argument("--num_probes", type=int, default=8, help="with --centroid_index ivf, number of lists probed by each query: the recall of the closest class mean grows with it, up to exact search when all the lists are probed (default: 8).")
+    parser.add_argument("--num_subspaces", type=int, default=None, help="with --centroid_index ivf, store the class means as product-quantized codes with this number of subspaces, which must divide --dim_latent (default: None -> full class means).")
+    parser.add_argument("--rerank", type=int, default=16, help="with --centroid_index ivf and --num_subspaces, number of candidates re-scored with the full class means (default: 16).")
+    parser.add_argument("--moments_path", type=str, default=None, help="path of the moments of the trainset embeddings used by --scorer. Loaded if it exists, otherwise computed on --root_train and saved there (default: None).")
+    parser.add_argument("--score_cache", type=str, default=None, help="folder of the per-image score cache. If specified, only the images which are new or modified since the last run with the same model and mean embeddings are evaluated (default: None).")
     #parser.add_argument("--base_path", type=str, default="model/model_ii.pth", help="path to save the scores. _valid.pth and _crops.pth will be added to the filename (default: model/model.pth).")
     parser.add_argument("--calc_test_accuracy", action="store_true", help="if set, will calculate the accuracy of the model on the validation set (default: False).")
     return parser.parse_args()
 
 def main():
     args = get_args()
-    assert args.mean_embedding_path is not None or args.root_train is not None, "Need at least one of mean_embedding_path or root_train to be provided. Both are None."
-    assert args.mean_embedding_path is None or args.root_train is None, f"Only one of mean_embedding_path ({args.mean_embedding_path}) or root_train ({args.root_train}) can be provided."
-
-    net = models.ResNetCustom(args.num_classes, args.model_class, dim_latent=args.dim_latent)
-    net.load_state_dict(torch.load(args.pretrained_params_path))
-
-    if args.root_train is not None:
+    assert (args.classif_threshold is None) != (args.thresholds_path is None), "Exactly one of --classif_threshold and --thresholds_path must be provided."
+    if args.scorer == "euclidean":
+        assert args.mean_embedding_path is not None or args.root_train is not None, "Need at least one of mean_embedding_path or root_train to be provided. Both are None."
+        assert args.mean_embedding_path is None or args.root_train is None, f"Only one of mean_embedding_path ({args.mean_embedding_path}) or root_train ({args.root_train}) can be provided."
+
+    if args.quantized_model_path is not None:
+        net = quantization.load_quantized_model(args.quantized_model_path)
+        args.device = "cpu"
+        args.optimize_inference = None
+        # the packed weights of quantized models are not part of their state_dict: fingerprint the file instead
+        with open(args.quantized_model_path, "rb") as f:
+            net_content = f.read()
+    else:
+        net = models.get_model(args.num_classes, args.model_class, dim_latent=args.dim_latent)
+        net.load_state_dict(torch.load(args.pretrained_params_path))
+        net_content = net
+        if args.optimize_inference is not None:
+            device = args.device if args.device is not None else ("cuda" if torch.cuda.is_available() else "cpu")
+            example_inputs = next(iter(datasets.get_dataloader(args.root_test, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())))[0].to(device)
+            net = inference.optimize_for_inference(net, example_inputs, mode=args.optimize_inference, cache_dir=args.optimized_cache_dir)
+
+    if args.scorer != "euclidean":
+        # the scorer replaces the mean embeddings in the evaluation functions
+        trainloader = datasets.get_dataloader(args.root_train, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms()) if args.root_train is not None else None
+        if args.scorer == "knn":
+            mean_embeddings = scorers.KNNScorer(**scorers.load_or_build_gallery(args.gallery_path, trainloader, net, args.device), k=args.knn_k)
+        else:
+            mean_embeddings = scorers.get_scorer(args.scorer, scorers.load_or_accumulate_moments(args.moments_path, trainloader, net, args.device))
+    elif args.root_train is not None:
         trainloader = datasets.get_dataloader(args.root_train, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
         mean_embeddings = eval_ii.get_mean_embeddings(trainloader, net, device=args.device)
     else:
-        mean_embeddings = torch.load(args.mean_embedding_path)
+        mean_embeddings = registry.load_means(args.mean_embedding_path)
+    if args.scorer == "euclidean" and args.centroid_index is not None:
+        # the index replaces the mean embeddings in the evaluation functions
+        mean_embeddings = search.ExactIndex(mean_embeddings) if args.centroid_index == "exact" else search.IVFIndex(mean_embeddings, num_probes=args.num_probes, num_subspaces=args.num_subspaces, rerank=args.rerank)
+    # settings of the scorer which change the scores but are not part of its state_dict
+    scorer_params = None
+    if args.scorer == "knn":
+        scorer_params = {"knn_k": args.knn_k}
+    elif args.scorer == "euclidean" and args.centroid_index == "ivf":
+        scorer_params = {"num_probes": args.num_probes, "num_subspaces": args.num_subspaces, "rerank": args.rerank}
+    cache = score_cache.ScoreCache(args.score_cache, utils.fingerprint(net_content, mean_embeddings, scorer_params, args.optimize_inference)) if args.score_cache is not None else None
 
     testloader = datasets.get_dataloader(args.root_test, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
     oodloader = datasets.get_dataloader(args.root_ood_test, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
     cropsloader = datasets.get_dataloader(args.root_crops, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
 
-    outlier_scores_test = eval_ii.eval_outlier_scores(testloader, net, mean_embeddings, device=args.device)
-    outlier_scores_ood = eval_ii.eval_outlier_scores(oodloader, net, mean_embeddings, device=args.device)
-    outlier_scores_crops = eval_ii.eval_outlier_scores(cropsloader, net, mean_embeddings, device=args.device)
+    if args.thresholds_path is not None:
+        # the threshold of each image depends on its predicted class
+        thresholds = calibration.load_thresholds(args.thresholds_path)
+        def accept(loader):
+            outputs = eval_ii.eval_outputs(loader, net, mean_embeddings, device=args.device, cache=cache, num_procs=args.num_procs)
+            return thresholds(outputs["outlier_scores"], outputs["logits"].argmax(1))
+    else:
+        def accept(loader):
+            return eval_ii.eval_outlier_scores(loader, net, mean_embeddings, device=args.device, cache=cache, num_procs=args.num_procs) < args.classif_threshold
+
+    test_non_ood = accept(testloader)
+    ood_non_ood = accept(oodloader)
+    crops_non_ood = accept(cropsloader)
 
-    test_non_ood = outlier_scores_test < args.classif_threshold
-    sensitivity = test_non_ood.sum().item() / len(outlier_scores_test)
-    specificity = (outlier_scores_ood >= args.classif_threshold).sum().item() / len(outlier_scores_ood)
+    sensitivity = test_non_ood.sum().item() / len(test_non_ood)
+    specificity = (~ood_non_ood).sum().item() / len(ood_non_ood)
     sens_spec = 2 * sensitivity * specificity / (sensitivity + specificity)
     print(f"Sensitivity: {sensitivity:.4f} | Specificity: {specificity:.4f} | Sens<->Spec: {sens_spec:.4f}")
 
     non_ood_punch_id = {cl: 0 for cl in range(len(testloader.dataset.classes))}
-    for outlier_score, punch_id in zip(outlier_scores_test, testloader.dataset.targets):
-        if outlier_score < args.classif_threshold:
+    for non_ood, punch_id in zip(test_non_ood, testloader.dataset.targets):
+        if non_ood:
             non_ood_punch_id[punch_id] += 1
 
 
@@ -70,7 +125,7 @@ def main():
         print(f"Class: {cl} [ID: {class_id_to_punch_id[cl]}] - correct: {count} - num items: {num_items}-| accuracy: {count/num_items:.4f}")
   
 
-    crops_accuracy = (outlier_scores_crops >= args.classif_threshold).sum().item() / len(outlier_scores_crops)
+    crops_accuracy = (~crops_non_ood).sum().item() / len(crops_non_ood)
     print(f"Crops accuracy: {crops_accuracy:.4f}")
 
 
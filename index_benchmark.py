@@ -0,0 +1,83 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from punches_lib import search
+from punches_lib.ii_loss import ii_loss
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_centroids", type=int, nargs="+", default=[19, 1000, 10000], help="numbers of class centroids to benchmark (default: 19 1000 10000).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of the embeddings (default: 32).")
+    parser.add_argument("--num_queries", type=int, default=4096, help="number of query embeddings (default: 4096).")
+    parser.add_argument("--batch_size", type=int, default=128, help="number of queries scored at once (default: 128).")
+    parser.add_argument("--num_probes", type=int, default=8, help="number of lists probed by the IVF indices (default: 8).")
+    parser.add_argument("--num_subspaces", type=int, default=8, help="number of PQ subspaces of the IVF-PQ index (default: 8).")
+    parser.add_argument("--rerank", type=int, default=16, help="number of IVF-PQ candidates re-scored exactly (default: 16).")
+    parser.add_argument("--target_recall", type=float, default=None, help="if set, num_probes is tuned on the first batch of queries to reach this recall@1 (default: None).")
+    parser.add_argument("--num_runs", type=int, default=3, help="number of timed runs (default: 3).")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the results are saved (default: None).")
+    return parser.parse_args()
+
+def synthetic_data(num_centroids:int, dim:int, num_queries:int, generator:torch.Generator):
+    # centroids spread as the II-loss means, half of the queries close to a centroid (in-distribution) and half far from all of them
+    centroids = torch.randn(num_centroids, dim, generator=generator) * 10
+    queries_id = centroids[torch.randint(num_centroids, (num_queries // 2,), generator=generator)] + torch.randn(num_queries // 2, dim, generator=generator)
+    queries_ood = torch.randn(num_queries - num_queries // 2, dim, generator=generator) * 10
+    return centroids, torch.cat([queries_id, queries_ood])
+
+def time_batched(fn, queries:torch.Tensor, batch_size:int, num_runs:int) -> float:
+    timings = []
+    with torch.no_grad():
+        for _ in range(num_runs):
+            start = time.perf_counter()
+            for i in range(0, len(queries), batch_size):
+                fn(queries[i:i+batch_size])
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+def main():
+    args = get_args()
+    generator = torch.Generator().manual_seed(args.seed)
+    results = []
+    for num_centroids in args.num_centroids:
+        centroids, queries = synthetic_data(num_centroids, args.dim_latent, args.num_queries, generator)
+        exact = search.ExactIndex(centroids)
+        reference_distances, reference_ids = exact.search(queries, 1)
+        half = args.num_queries // 2
+        candidates = {
+            "brute force (outlier_score)": (None, lambda q: ii_loss.outlier_score(q, centroids)),
+            "exact": (exact, None),
+            "ivf": (search.IVFIndex(centroids, num_probes=args.num_probes, seed=args.seed), None),
+            "ivf-pq": (search.IVFIndex(centroids, num_probes=args.num_probes, num_subspaces=args.num_subspaces, rerank=args.rerank, seed=args.seed), None),
+        }
+        for name, (index, fn) in candidates.items():
+            if index is not None and args.target_recall is not None and isinstance(index, search.IVFIndex):
+                # tune on a random sample mixing in-distribution and OOD queries
+                sample = torch.randperm(len(queries), generator=generator)[:args.batch_size]
+                search.tune_num_probes(index, queries[sample], args.target_recall)
+            fn = fn if fn is not None else index.classify
+            elapsed = time_batched(fn, queries, args.batch_size, args.num_runs)
+            row = {"num_centroids": num_centroids, "index": name, "us_per_query": elapsed * 1e6 / len(queries), "queries_per_s": len(queries) / elapsed}
+            if index is not None:
+                ids, scores = index.classify(queries)
+                row["recall@1"] = search.recall_at_k(ids.unsqueeze(1), reference_ids)
+                row["recall@1_id"] = search.recall_at_k(ids[:half].unsqueeze(1), reference_ids[:half])
+                row["recall@1_ood"] = search.recall_at_k(ids[half:].unsqueeze(1), reference_ids[half:])
+                row["max_score_rel_error"] = ((scores - reference_distances[:, 0]).abs() / reference_distances[:, 0].clamp(min=1e-6)).max().item()
+                row["num_probes"] = getattr(index, "num_probes", None)
+                row["index_kb"] = sum(b.numel() * b.element_size() for b in index.buffers()) / 1024
+            print(row)
+            results.append(row)
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.report_path is not None:
+        results.to_csv(args.report_path, index=False)
+
+if __name__ == "__main__":
+    main()
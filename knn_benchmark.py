@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from punches_lib import search
+from punches_lib.ii_loss import scorers
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gallery_sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], help="numbers of trainset embeddings in the gallery (default: 1000 10000 100000 1000000).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of the embeddings (default: 32).")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes the gallery embeddings are drawn from (default: 19).")
+    parser.add_argument("--num_queries", type=int, default=1024, help="number of query embeddings (default: 1024).")
+    parser.add_argument("--batch_size", type=int, default=128, help="number of queries scored at once (default: 128).")
+    parser.add_argument("--k", type=int, default=5, help="neighbour whose distance is the outlier score (default: 5).")
+    parser.add_argument("--memory_budget_mb", type=float, nargs="+", default=[16, 64], help="memory budgets of the blocked search, in MB (default: 16 64).")
+    parser.add_argument("--num_runs", type=int, default=3, help="number of timed runs (default: 3).")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the results are saved (default: None).")
+    return parser.parse_args()
+
+def time_batched(scorer, queries:torch.Tensor, batch_size:int, num_runs:int) -> float:
+    timings = []
+    with torch.no_grad():
+        for _ in range(num_runs):
+            start = time.perf_counter()
+            for i in range(0, len(queries), batch_size):
+                scorer(queries[i:i+batch_size])
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+def main():
+    args = get_args()
+    generator = torch.Generator().manual_seed(args.seed)
+    results = []
+    for gallery_size in args.gallery_sizes:
+        # gallery drawn around the class means like II-loss embeddings, queries half in-distribution and half OOD
+        means = torch.randn(args.num_classes, args.dim_latent, generator=generator) * 10
+        gallery = means[torch.randint(args.num_classes, (gallery_size,), generator=generator)] + torch.randn(gallery_size, args.dim_latent, generator=generator)
+        queries = torch.cat([
+            means[torch.randint(args.num_classes, (args.num_queries // 2,), generator=generator)] + torch.randn(args.num_queries // 2, args.dim_latent, generator=generator),
+            torch.randn(args.num_queries - args.num_queries // 2, args.dim_latent, generator=generator) * 10,
+        ])
+        # float32 reference with the default block size
+        reference = search.ExactIndex(gallery)
+        reference_scores = reference.search(queries, args.k)[0][:, -1]
+        candidates = {"float32 (block 4096)": reference}
+        for budget in args.memory_budget_mb:
+            candidates[f"float16 ({budget:g} MB)"] = scorers.KNNScorer(gallery, k=args.k, memory_budget_mb=budget)
+        for name, scorer in candidates.items():
+            forward = scorer if isinstance(scorer, scorers.KNNScorer) else (lambda q, index=scorer: index.search(q, args.k)[0][:, -1])
+            elapsed = time_batched(forward, queries, args.batch_size, args.num_runs)
+            with torch.no_grad():
+                scores = torch.cat([forward(queries[i:i+args.batch_size]) for i in range(0, len(queries), args.batch_size)])
+            row = {
+                "gallery_size": gallery_size,
+                "scorer": name,
+                "gallery_mb": scorer.centroids.numel() * scorer.centroids.element_size() / 2**20,
+                "block_size": scorer._get_block_size(args.batch_size),
+                "us_per_query": elapsed * 1e6 / len(queries),
+                "max_score_rel_error": ((scores - reference_scores).abs() / reference_scores.clamp(min=1e-6)).max().item(),
+            }
+            print(row)
+            results.append(row)
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.report_path is not None:
+        results.to_csv(args.report_path, index=False)
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ from webbrowser import get
 import torch
 import argparse
 
-from punches_lib import datasets
+from punches_lib import datasets, distributed
 from punches_lib.cnn import models, train, eval
 
 def get_args():
@@ -17,22 +17,42 @@ def get_args():
     parser.add_argument("--model_path", type=str, default="model/model.pth", help="path to save model (default: model/model.pth).")
     parser.add_argument("--use_pretrained", action="store_true", default=False, help="use ImageNet-pretrained model (default: False).")
     parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"],help="model class (default: resnet18).")
+    parser.add_argument("--world_size", type=int, default=1, help="number of local processes for data-parallel training on the CPU (torch.distributed with gloo backend). The batch size is per process (default: 1).")
+    parser.add_argument("--dist_port", type=int, default=29500, help="port used by the processes to communicate, for --world_size larger than 1 (default: 29500).")
     parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
     return parser.parse_args()
 
+def train_net(args, net, trainloader, device=None):
+    loss_fn = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.RAdam(net.parameters(), lr=args.lr)
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.lr_decay_epochs, gamma=args.lr_decay_gamma)
+
+    train.train_model(net, trainloader, loss_fn, optimizer, args.epochs, scheduler, device=device)
+
+def train_worker(rank, world_size, args):
+    # data-parallel training on the CPU: each process trains on its shard of the trainset, gradients are all-reduced
+    distributed.setup(rank, world_size, master_port=args.dist_port)
+    trainset = datasets.get_dataset(args.root_train, transforms=datasets.get_bare_transforms())
+    trainloader = distributed.get_dataloader(trainset, args.batch_size, num_workers=max(1, 8 // world_size))
+    net = distributed.wrap_model(models.get_model(args.model_class, args.use_pretrained, num_classes=len(trainset.classes)))
+    train_net(args, net, trainloader, device="cpu")
+    distributed.save_on_main(net, args.model_path)
+    distributed.cleanup()
+
 def main():
     args = get_args()
     trainloader = datasets.get_dataloader(args.root_train, args.batch_size, num_workers=8, transforms=datasets.get_bare_transforms())
     num_classes = len(trainloader.dataset.classes)
     net = models.get_model(args.model_class, args.use_pretrained, num_classes=num_classes)
 
+    if args.world_size > 1:
+        distributed.launch(train_worker, args.world_size, args)
+        net.load_state_dict(torch.load(args.model_path))
+    else:
+        train_net(args, net, trainloader)
+        torch.save(net.state_dict(), args.model_path)
+        print(f"Model saved to {args.model_path}")
     loss_fn = torch.nn.CrossEntropyLoss()
-    optimizer = torch.optim.RAdam(net.parameters(), lr=args.lr)
-    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.lr_decay_epochs, gamma=args.lr_decay_gamma)
-
-    train.train_model(net, trainloader, loss_fn, optimizer, args.epochs, scheduler, device=None)
-    torch.save(net.state_dict(), args.model_path)
-    print(f"Model saved to {args.model_path}")
 
     testloader = datasets.get_dataloader(args.root_test, args.batch_size, num_workers=8, transforms=datasets.get_bare_transforms(), shuffle=False)
     eval.test_model(net, testloader, loss_fn=loss_fn, device=None)
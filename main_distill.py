@@ -0,0 +1,75 @@
+import argparse
+
+import pandas as pd
+import torch
+
+from punches_lib import datasets, score_cache, utils
+from punches_lib.cnn import distill, models as cnn_models
+from punches_lib.ii_loss import eval as eval_ii, models as ii_models, registry
+from punches_lib.radam import RAdam
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size for training (default: 32).")
+    parser.add_argument("--epochs", type=int, default=20, help="number of epochs to train (default: 20).")
+    parser.add_argument("--lr", type=float, default=0.001, help="learning rate (default: 0.001).")
+    parser.add_argument("--lr_decay_gamma", type=float, default=0.1, help="learning rate decay factor (default: 0.1).")
+    parser.add_argument("--lr_decay_epochs", type=int, nargs="*", default=[10, 15], help="learning rate decay epochs (default: 10 and 15).")
+    parser.add_argument("--root_train", type=str, default="data/train", help="root of training data (default: data/train).")
+    parser.add_argument("--root_test", type=str, default="data/test", help="root of testing data (default: data/test).")
+    parser.add_argument("--root_openset", type=str, default=None, help="root of ood data, used for the AUROC in the report (default: None).")
+    parser.add_argument("--teacher_type", type=str, default="ii", choices=["ii", "cnn"], help="teacher: 'ii' for ResNetCustom trained with II-loss (logits and embeddings are distilled), 'cnn' for the classifier of main_cnn.py (logits only) (default: ii).")
+    parser.add_argument("--teacher_params_path", type=str, required=True, help="path to the params of the teacher.")
+    parser.add_argument("--teacher_model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class of the teacher (default: resnet18).")
+    parser.add_argument("--student_architecture", type=str, default="mobilenet_v3_small", choices=cnn_models.STUDENT_ARCHITECTURES, help="architecture of the student (default: mobilenet_v3_small).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of the latent space of teacher and student (default: 32).")
+    parser.add_argument("--temperature", type=float, default=4.0, help="softmax temperature for distillation (default: 4).")
+    parser.add_argument("--alpha", type=float, default=0.9, help="weight of the distillation loss w.r.t. the cross-entropy on the labels (default: 0.9).")
+    parser.add_argument("--beta", type=float, default=1.0, help="weight of the MSE between student and teacher embeddings. Ignored for 'cnn' teachers (default: 1).")
+    parser.add_argument("--teacher_cache", type=str, default=None, help="folder of the score cache where the outputs of the teacher on the trainset are stored. If None, they are computed once at the beginning of each run (default: None).")
+    parser.add_argument("--model_path", type=str, default="model/model_student.pth", help="path to save the student (default: model/model_student.pth).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the teacher vs. student report is saved (default: None).")
+    parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    device = args.device if args.device is not None else utils.use_cuda_if_possible()
+    trainset = datasets.get_dataset(args.root_train, transforms=datasets.get_bare_transforms())
+    num_classes = len(trainset.classes)
+
+    if args.teacher_type == "ii":
+        teacher = ii_models.ResNetCustom(num_classes, args.teacher_model_class, dim_latent=args.dim_latent)
+    else:
+        teacher = cnn_models.get_model(args.teacher_model_class, num_classes=num_classes)
+    teacher.load_state_dict(torch.load(args.teacher_params_path, map_location="cpu"))
+
+    print("Getting the outputs of the teacher on the trainset")
+    trainloader_eval = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size, num_workers=8, shuffle=False)
+    cache = score_cache.ScoreCache(args.teacher_cache, utils.fingerprint(teacher)) if args.teacher_cache is not None else None
+    teacher_outputs = distill.cached_teacher_outputs(trainloader_eval, teacher, device, cache=cache)
+
+    student = cnn_models.StudentNet(num_classes, args.student_architecture, dim_latent=args.dim_latent)
+    trainloader = torch.utils.data.DataLoader(datasets.IndexedDataset(trainset), batch_size=args.batch_size, num_workers=8, shuffle=True)
+    loss_fn = distill.DistillationLoss(temperature=args.temperature, alpha=args.alpha, beta=args.beta)
+    optimizer = RAdam(student.parameters(), lr=args.lr)
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.lr_decay_epochs, gamma=args.lr_decay_gamma)
+
+    distill.train_model(student, trainloader, teacher_outputs, loss_fn, optimizer, args.epochs, scheduler, device=device)
+    torch.save(student.state_dict(), args.model_path)
+    print(f"Model saved to {args.model_path}")
+
+    print("Getting trainset means")
+    train_data_means = eval_ii.get_mean_embeddings(trainloader_eval, student, device=device)
+    registry.save_means(f"{args.model_path}_means.pth", train_data_means, trainloader_eval.dataset.classes)
+
+    print("Comparing teacher and student")
+    testloader = datasets.get_dataloader(args.root_test, args.batch_size, num_workers=8, transforms=datasets.get_bare_transforms(), shuffle=False)
+    oodloader = datasets.get_dataloader(args.root_openset, args.batch_size, num_workers=8, transforms=datasets.get_bare_transforms(), shuffle=False) if args.root_openset is not None else None
+    report = pd.Series(distill.compare_models(teacher, student, trainloader_eval, testloader, oodloader, device=device))
+    print(report.to_string())
+    if args.report_path is not None:
+        report.to_csv(args.report_path, header=False)
+
+if __name__ == "__main__":
+    main()
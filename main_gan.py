@@ -1,6 +1,7 @@
 from __future__ import print_function, division
 import argparse
 from punches_lib.gan import architecture, data, train, test, dataset_tinyimagenet, plot, eval_funcs
+from punches_lib.gan import compression, ensemble
 
 import os, random, time, copy
 
@@ -43,6 +44,8 @@ def get_args():
     parser.add_argument("--batch_size", type=int, default=128, help="batch size for training (default: 128).")
     parser.add_argument("--batch_size_eval", type=int, default=64, help="batch size for eval (default: 64).")
     parser.add_argument("--lr", type=float, default=0.0001, help="learning rate (default: 0.0001).")
+    parser.add_argument("--lr_modifier_D", type=float, default=0.2, help="learning rate modifier for the discriminator, i.e., the discriminator is trained with --lr * --lr_modifier_D (default: 0.2).")
+    parser.add_argument("--label_smoothing", type=float, default=0.15, help="maximum amount of the random smoothing of the real and fake labels; 0 for no smoothing (default: 0.15).")
     parser.add_argument("--path_to_feats", type=str, default='./feats',
                         help="the path to cached off-the-shelf features")
     parser.add_argument("--root_train", type=str, default='./PunchesDataset',
@@ -59,11 +62,39 @@ def get_args():
                         help="pretrained model (default: ResNet18)")
     parser.add_argument("--model", type=str, default='resnet18',
                         help="model to use (default: resnet18)")
+    parser.add_argument("--num_procs", type=int, default=1,
+                        help="number of CPU processes the feature extraction is sharded across; 0 to choose automatically (default: 1)")
+    parser.add_argument("--optimize_backbone", action="store_true", default=False,
+                        help="fold the BatchNorm layers of the backbone and use the channels-last memory format for feature extraction (default: False)")
 
 
     #For GAN-fea, we set the hyper-parameters as below.
     parser.add_argument("--nc", type=int, default=512,
                         help="Number of channels in the training images. For color images this is 3")
+    parser.add_argument("--compress_channels", type=int, default=None,
+                        help="project the channels of the backbone features to this many channels (fitted once on the train features) before training and evaluating the GAN; replaces --nc (default: None -> keep the 512 channels)")
+    parser.add_argument("--compress_projection", type=str, default="pca", choices=["pca", "random"],
+                        help="projection used with --compress_channels: principal components of the channels or a random orthonormal 1x1 projection (default: pca)")
+    parser.add_argument("--compress_spatial_size", type=int, default=8,
+                        help="average-pool the 8x8 backbone features to this spatial size, e.g. 4 (default: 8)")
+    parser.add_argument("--compress_half", action="store_true", default=False,
+                        help="store the (compressed) features in float16 (default: False)")
+    parser.add_argument("--compressor_path", type=str, default=None,
+                        help="path of the feature compressor. Loaded if it exists, otherwise fitted and saved there (default: None)")
+    parser.add_argument("--pca_components", type=int, default=None,
+                        help="project the channels of the backbone features on this many principal components before training the GAN; same as --compress_channels with --compress_projection pca (default: None)")
+    parser.add_argument("--pca_path", type=str, default=None,
+                        help="path of the PCA used with --pca_components; same as --compressor_path (default: None)")
+    parser.add_argument("--validate_every", type=int, default=None,
+                        help="validate the discriminator every this many epochs on the features of the validation (ID) and of the --root_valid_open (OOD) data, extracted once before training, and stop early when the validation metric stops improving; only the best discriminator is saved. Not supported with --ensemble_size > 1 (default: None -> train for --epochs and save the last 50 epochs)")
+    parser.add_argument("--root_valid_open", type=str, default=None,
+                        help="the path to find the dir of the OOD data used for early stopping with --validate_every. If None, the extra data is used and the results reported on it are optimistically biased, since the discriminator is selected on the same images (default: None)")
+    parser.add_argument("--patience", type=int, default=10,
+                        help="number of validations without improvement before stopping, with --validate_every (default: 10)")
+    parser.add_argument("--monitor", type=str, default="auroc", choices=["auroc", "W"],
+                        help="validation metric used for early stopping: AUROC or the best weighted sensitivity/specificity W (default: auroc)")
+    parser.add_argument("--ensemble_size", type=int, default=1,
+                        help="number of Generator/Discriminator pairs trained simultaneously on the same features (vectorized with torch.func); the discriminator outputs are averaged at evaluation (default: 1)")
     parser.add_argument("--nz", type=int, default=100,
                         help="Size of z latent vector (i.e. size of generator input)")
     parser.add_argument("--ngf", type=int, default=64,
@@ -79,6 +110,7 @@ def get_args():
 
 def main():
     args = get_args()
+    assert args.validate_every is None or args.ensemble_size == 1, "--validate_every (early stopping) is not supported with --ensemble_size > 1"
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu") if args.device is None else args.device
     print("Random Seed: ", args.manualSeed)
     random.seed(args.manualSeed)
@@ -99,9 +131,18 @@ def main():
 
     log_filename = os.path.join(save_dir, 'train.log')
 
+    if args.pca_components is not None:
+        assert args.compress_channels is None, "--pca_components and --compress_channels are alternatives, pass only one of them"
+        args.compress_channels, args.compress_projection = args.pca_components, "pca"
+    if args.pca_path is not None:
+        assert args.compressor_path is None, "--pca_path and --compressor_path are alternatives, pass only one of them"
+        args.compressor_path = args.pca_path
+    if args.compress_channels is not None:
+        args.nc = args.compress_channels
+
     #Initialize the network
     netG = architecture.Generator(nz=args.nz, ngf=args.ngf, nc=args.nc).to(args.device)
-    netD = architecture.DiscriminatorFunnel(nc=args.nc, ndf=args.ndf).to(args.device)
+    netD = architecture.DiscriminatorFunnel(nc=args.nc, ndf=args.ndf, spatial_size=args.compress_spatial_size).to(args.device)
 
     # Handle multi-gpu if desired
     if ('cuda' == args.device) and (args.ngpu > 1):
@@ -135,34 +176,70 @@ def main():
     real_label = 1
     fake_label = 0
 
+    if args.ensemble_size > 1:
+        # the ensemble replaces the single pair: called on features, it returns the mean output of its discriminators
+        netD = ensemble.GANEnsemble(args.ensemble_size, nz=args.nz, ngf=args.ngf, nc=args.nc, ndf=args.ndf, spatial_size=args.compress_spatial_size, seed=args.manualSeedTorch)
+        netG = netD.generators
+        netD.to(device)
+
     # Setup Adam optimizers for both G and D
-    optimizerD = optim.Adam(netD.parameters(), lr=args.lr / 5, betas=(args.beta1, 0.999))
+    optimizerD = optim.Adam(netD.discriminators.parameters() if args.ensemble_size > 1 else netD.parameters(), lr=args.lr * args.lr_modifier_D, betas=(args.beta1, 0.999))
     optimizerG = optim.Adam(netG.parameters(), lr=args.lr, betas=(args.beta1, 0.999))
 
-    backbone = data.create_backbone(args.name_modelpth, args.model, device)
-
-    train_features, backbone = data.get_hidden_features(trainloader, device, backbone)
+    backbone = data.create_backbone(args.name_modelpth, args.model, device, optimize=args.optimize_backbone)
+
+    train_features, backbone = data.get_hidden_features(trainloader, device, backbone, num_procs=args.num_procs)
+    projection = None
+    if args.compress_channels is not None or args.compress_spatial_size != 8 or args.compress_half:
+        projection = compression.load_or_fit_compressor(args.compressor_path, train_features, args.compress_channels, args.compress_projection, args.compress_spatial_size, args.compress_half)
+        train_features = projection.compress(train_features)
+        print(f"Features compressed to {tuple(train_features.shape[1:])} ({train_features.dtype})")
+
+    validation_features = None
+    if args.validate_every is not None:
+        validation_features = []
+        if args.root_valid_open is not None:
+            validopenloader = data.get_dataloader(args.root_valid_open, args.batch_size_eval, transforms=data.get_bare_transforms())
+        else:
+            print("Warning: early stopping on the extra data, the results reported on it are optimistically biased (see --root_valid_open)")
+            validopenloader = extraloader
+        for loader in (validloader, validopenloader):
+            features, backbone = data.get_hidden_features(loader, device, backbone, num_procs=args.num_procs)
+            validation_features.append(projection.compress(features) if projection is not None else features)
 
     print("Start Training...")
     trainset_closeset = data.FeatDataset(data=train_features)
     featureloader_train = DataLoader(trainset_closeset, batch_size=args.batch_size_eval, shuffle=True, num_workers=1)
 
-    G_losses, D_losses = train.train_model(num_epochs, featureloader_train, netG, netD, real_label, fake_label, optimizerG, optimizerD, args.nz, fixed_noise, criterion, device, save_dir)
+    if args.ensemble_size > 1:
+        G_losses, D_losses = ensemble.train_ensemble(num_epochs, featureloader_train, netD, optimizerG, optimizerD, device, save_dir, real_label, fake_label, args.label_smoothing)
+    else:
+        G_losses, D_losses = train.train_model(num_epochs, featureloader_train, netG, netD, real_label, fake_label, optimizerG, optimizerD, args.nz, fixed_noise, criterion, device, save_dir, spatial_size=args.compress_spatial_size,
+                                               validation_features=validation_features, validate_every=args.validate_every or 1, patience=args.patience, monitor=args.monitor,
+                                               label_smoothing_factor=args.label_smoothing)
 
     plot.plot_losses(G_losses, D_losses, args.modelFlag)
 
     print("Start Testing...")
-    test_features, backbone = data.get_hidden_features(testloader, device, backbone)
+    test_features, backbone = data.get_hidden_features(testloader, device, backbone, num_procs=args.num_procs)
     torch.save(test_features, "punzoni_res18_features_TEST.pt")
+    if projection is not None:
+        test_features = projection.compress(test_features)
     featureloader_test = data.FeatDataset(data=test_features)
     features_testloader = DataLoader(featureloader_test, batch_size=args.batch_size_eval, shuffle=True, num_workers=1)
-    outputs_open, outputs_close = test.test_model(backbone, features_testloader, netD, device)
+    outputs_open, outputs_close = test.test_model(backbone, features_testloader, netD, device, projection=projection)
+    if args.ensemble_size > 1:
+        with torch.no_grad():
+            variance = torch.cat([netD.scores(batch.to(device).float())["disc_variance"].cpu() for batch in torch.split(test_features, args.batch_size_eval)])
+        print(f"Mean variance of the discriminator outputs across the ensemble (test): {variance.mean().item():.5f}")
     plot.plot_roc_curve(outputs_open, outputs_close, args.modelFlag)
     plot.plot_hist(outputs_open, outputs_close, args.modelFlag)
 
 
     print("Start Testing for no punch features...")
-    no_punch_features, backbone = data.get_hidden_features(nopunchloader, device, backbone)
+    no_punch_features, backbone = data.get_hidden_features(nopunchloader, device, backbone, num_procs=args.num_procs)
+    if projection is not None:
+        no_punch_features = projection.compress(no_punch_features)
     featureloader_nopunch = data.FeatDataset(data=no_punch_features)
     features_nopunchloader = DataLoader(featureloader_nopunch, batch_size=args.batch_size_eval, shuffle=True, num_workers=1)
     outputs_nopunz, _ = test.evalutate_data(netD, features_nopunchloader, device)
@@ -173,7 +250,9 @@ def main():
 
 
     print("Start Testing for extra features...")
-    extra_features, backbone = data.get_hidden_features(extraloader, device, backbone)
+    extra_features, backbone = data.get_hidden_features(extraloader, device, backbone, num_procs=args.num_procs)
+    if projection is not None:
+        extra_features = projection.compress(extra_features)
     netD.train()
     featureloader_extra = data.FeatDataset(data=extra_features)
     features_extraloader = DataLoader(featureloader_extra, batch_size=args.batch_size_eval, shuffle=True, num_workers=1)
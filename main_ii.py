@@ -1,8 +1,9 @@
 import argparse
+import os
 import torch
 from matplotlib import pyplot as plt
-from punches_lib import datasets
-from punches_lib.ii_loss import ii_loss, models, train, eval as eval_ii
+from punches_lib import datasets, distributed, samplers
+from punches_lib.ii_loss import ii_loss, models, registry, train, eval as eval_ii
 from punches_lib.cnn import eval
 from punches_lib.radam import RAdam
 
@@ -26,43 +27,89 @@ def get_args():
     parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
     parser.add_argument("--load_trained_model", type=str, default=None, help="path to trained model. Bypasses all training args (default: None).")
     parser.add_argument("--alternate_backprop", action="store_true", default=False, help="alternate backprop between II Loss and CE Loss (default: False).")
+    parser.add_argument("--centroid_momentum", type=float, default=None, help="if set, IILoss keeps a memory of the class centroids updated with this momentum (e.g., 0.9), used for the inter-separation and saved as the trainset means at the end of training, skipping the pass over the trainset (default: None).")
+    parser.add_argument("--sampler", type=str, default="random", choices=["random", "balanced"], help="'random' shuffles the trainset, 'balanced' builds each batch from --samples_per_class images of --classes_per_batch classes, so that IILoss sees every class in every batch. With 'balanced', --batch_size is ignored for training (default: random).")
+    parser.add_argument("--classes_per_batch", type=int, default=None, help="number of classes per batch for --sampler balanced (default: None -> all classes).")
+    parser.add_argument("--samples_per_class", type=int, default=4, help="number of images per class in each batch for --sampler balanced (default: 4).")
+    parser.add_argument("--world_size", type=int, default=1, help="number of local processes for data-parallel training on the CPU (torch.distributed with gloo backend). The batch size is per process (default: 1).")
+    parser.add_argument("--dist_port", type=int, default=29500, help="port used by the processes to communicate, for --world_size larger than 1 (default: 29500).")
     return parser.parse_args()
 
+def create_model(args, num_classes):
+    net = models.ResNetCustom(num_classes, args.model_class, dim_latent=args.dim_latent)
+    pretrained = args.use_pretrained
+    pretrained_params = None
+    if args.use_pretrained and args.pretrained_params_path is not None:
+        pretrained = False
+        pretrained_params = torch.load(args.pretrained_params_path, map_location="cpu")
+    elif args.use_pretrained:
+        raise NotImplementedError("Loading pretrained params from torchvision is not implemented yet.")
+    
+    if pretrained_params is not None:
+        # load state dict with strict set to False because the model has 2 FC heads instead of 1
+        net.load_state_dict(pretrained_params, strict=False)
+    return net
+
+def train_net(args, net, trainloader, distributed_loss=False):
+    ii_loss_fn = ii_loss.IILoss(delta=args.delta_ii, distributed=distributed_loss, momentum=args.centroid_momentum)
+    ce_loss_fn = torch.nn.CrossEntropyLoss()
+    optimizer = RAdam(net.parameters(), lr=args.lr)
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.lr_decay_epochs, gamma=args.lr_decay_gamma)
+
+    train.train_model(net, trainloader, ii_loss_fn, ce_loss_fn, args.epochs, optimizer, scheduler, args.device, lambda_scale=args.lambda_ii, alternate_backprop=args.alternate_backprop)
+    if args.centroid_momentum is not None and distributed.is_main_process():
+        # the centroid memory replaces the pass over the trainset of get_mean_embeddings
+        registry.save_means(f"{args.model_path}_means.pth", ii_loss_fn.export_means().cpu(), trainloader.dataset.classes)
+
+def train_worker(rank, world_size, args):
+    # data-parallel training on the CPU: each process trains on its shard of the trainset, gradients are all-reduced
+    distributed.setup(rank, world_size, master_port=args.dist_port)
+    trainset = datasets.get_dataset(args.root_train, transforms=datasets.get_bare_transforms())
+    trainloader = distributed.get_dataloader(trainset, args.batch_size, num_workers=max(1, 8 // world_size))
+    net = distributed.wrap_model(create_model(args, len(trainset.classes)), find_unused_parameters=args.alternate_backprop)
+    train_net(args, net, trainloader, distributed_loss=True)
+    distributed.save_on_main(net, args.model_path)
+    distributed.cleanup()
+
 def main():
     args = get_args()
     trainloader = datasets.get_dataloader(args.root_train, args.batch_size, num_workers=8, transforms=datasets.get_bare_transforms())
     num_classes = len(trainloader.dataset.classes)
 
-    net = models.ResNetCustom(num_classes, args.model_class, dim_latent=args.dim_latent)
-
     if args.load_trained_model is not None:
+        net = models.ResNetCustom(num_classes, args.model_class, dim_latent=args.dim_latent)
         net.load_state_dict(torch.load(args.load_trained_model))
+    elif args.world_size > 1:
+        assert args.sampler == "random", "--sampler balanced is not supported with --world_size larger than 1."
+        args.device = "cpu"
+        distributed.launch(train_worker, args.world_size, args)
+        net = models.ResNetCustom(num_classes, args.model_class, dim_latent=args.dim_latent)
+        net.load_state_dict(torch.load(args.model_path))
     else:
-        pretrained = args.use_pretrained
-        pretrained_params = None
-        if args.use_pretrained and args.pretrained_params_path is not None:
-            pretrained = False
-            pretrained_params = torch.load(args.pretrained_params_path, map_location="cpu")
-        elif args.use_prerained:
-            raise NotImplementedError("Loading pretrained params from torchvision is not implemented yet.")
-        
-        if pretrained_params is not None:
-            # load state dict with strict set to False because the model has 2 FC heads instead of 1
-            net.load_state_dict(pretrained_params, strict=False)
-
-
-        ii_loss_fn = ii_loss.IILoss(delta=args.delta_ii)
-        ce_loss_fn = torch.nn.CrossEntropyLoss()
-        optimizer = RAdam(net.parameters(), lr=args.lr)
-        scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=args.lr_decay_epochs, gamma=args.lr_decay_gamma)
-
-        train.train_model(net, trainloader, ii_loss_fn, ce_loss_fn, args.epochs, optimizer, scheduler, args.device, lambda_scale=args.lambda_ii, alternate_backprop=args.alternate_backprop)
+        net = create_model(args, num_classes)
+        if args.sampler == "balanced":
+            batch_sampler = samplers.ClassBalancedBatchSampler(trainloader.dataset.targets, args.classes_per_batch, args.samples_per_class)
+            train_net(args, net, torch.utils.data.DataLoader(trainloader.dataset, batch_sampler=batch_sampler, num_workers=8))
+        else:
+            train_net(args, net, trainloader)
         torch.save(net.state_dict(), args.model_path)
         print(f"Model saved to {args.model_path}")
 
-    print("Getting trainset means")
-    train_data_means = eval_ii.get_mean_embeddings(trainloader, net, device=args.device,)
-    torch.save(train_data_means, f"{args.model_path}_means.pth")
+    means_path = f"{args.model_path}_means.pth"
+    if args.centroid_momentum is not None and args.load_trained_model is None:
+        print("Using the centroid memory of IILoss as trainset means")
+        train_data_means = registry.load_means(means_path)
+    else:
+        print("Getting trainset means")
+        train_data_means = eval_ii.get_mean_embeddings(trainloader, net, device=args.device,)
+    # the means are saved with the punch id of each row, extended by register_class.py: when evaluating a trained model, the classes
+    # registered since then are kept
+    classes = trainloader.dataset.classes
+    saved_classes = registry.load_classes(means_path) if args.load_trained_model is not None and os.path.exists(means_path) else None
+    if saved_classes is not None and len(saved_classes) > len(classes) and saved_classes[:len(classes)] == classes:
+        print(f"Warning: {means_path} holds {len(saved_classes) - len(classes)} classes registered after training, it is not overwritten")
+    else:
+        registry.save_means(means_path, train_data_means, classes)
 
     print("Evaluating accuracy on testset")
     testloader = datasets.get_dataloader(args.root_test, args.batch_size, num_workers=8, transforms=datasets.get_bare_transforms(), shuffle=False)
@@ -0,0 +1,99 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+import torch
+
+from punches_lib.cnn import openmax
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_classes", type=int, default=19, help="number of known classes (default: 19).")
+    parser.add_argument("--num_train", type=int, default=5000, help="number of synthetic training activation vectors (default: 5000).")
+    parser.add_argument("--num_test", type=int, default=[1000, 10000], nargs="+", help="numbers of synthetic test activation vectors scored (default: 1000 10000).")
+    parser.add_argument("--tail_size", type=int, default=20, help="Weibull tail size (default: 20).")
+    parser.add_argument("--alpha_rank", type=int, default=10, help="number of top classes recalibrated (default: 10).")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the results are saved (default: None).")
+    return parser.parse_args()
+
+def synthetic_logits(num_classes:int, num_samples:int, generator:torch.Generator):
+    # activation vectors concentrated around a per-class peak, half of the test vectors being unstructured (OOD-like)
+    labels = torch.randint(num_classes, (num_samples,), generator=generator)
+    logits = torch.randn(num_samples, num_classes, generator=generator)
+    logits[torch.arange(num_samples), labels] += 6
+    return logits, labels
+
+def loop_fit(logits:np.ndarray, labels:np.ndarray, tail_size:int):
+    # the per-image loops of the former gan.eval_funcs.backup_Weibull, with scipy in place of libMR
+    activation_vectors = {}
+    for i, label in enumerate(labels):
+        if logits[i].argmax() != label:
+            continue
+        activation_vectors.setdefault(label, []).append(logits[i])
+    mean_activation_vectors = {c: np.array(v).mean(axis=0) for c, v in activation_vectors.items()}
+    weibulls = {}
+    for c, vectors in activation_vectors.items():
+        distances = [np.linalg.norm(v - mean_activation_vectors[c]) for v in vectors]
+        weibulls[c] = openmax.fit_weibull(distances, tail_size)
+    return mean_activation_vectors, weibulls
+
+def loop_scores(logits:np.ndarray, mean_activation_vectors:dict, weibulls:dict, alpha_rank:int) -> np.ndarray:
+    scores = []
+    for activation_vector in logits:
+        ranked = np.argsort(activation_vector)[::-1]
+        revised = activation_vector.copy()
+        unknown = 0.0
+        for rank, class_idx in enumerate(ranked[:alpha_rank]):
+            dist = np.linalg.norm(activation_vector - mean_activation_vectors[class_idx])
+            shape, scale = weibulls[class_idx]
+            w_score = scipy.stats.weibull_min.cdf(dist, shape, scale=scale)
+            removed = activation_vector[class_idx] * w_score * (alpha_rank - rank) / alpha_rank
+            revised[class_idx] -= removed
+            unknown += removed
+        exp = np.exp(np.concatenate([[unknown], revised]))
+        scores.append(exp[0] / exp.sum())
+    return np.array(scores)
+
+def main():
+    args = get_args()
+    generator = torch.Generator().manual_seed(args.seed)
+    train_logits, train_labels = synthetic_logits(args.num_classes, args.num_train, generator)
+
+    start = time.perf_counter()
+    mean_activation_vectors, weibulls = loop_fit(train_logits.numpy(), train_labels.numpy(), args.tail_size)
+    loop_fit_time = time.perf_counter() - start
+    start = time.perf_counter()
+    loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(train_logits, train_labels), batch_size=256)
+    scorer = openmax.fit_openmax(loader, torch.nn.Identity(), "cpu", args.tail_size, args.alpha_rank)
+    fit_time = time.perf_counter() - start
+    print(f"Fit on {args.num_train} vectors: loops {loop_fit_time*1000:.1f} ms, vectorized {fit_time*1000:.1f} ms")
+
+    results = []
+    for num_test in args.num_test:
+        logits, _ = synthetic_logits(args.num_classes, num_test, generator)
+        logits[num_test // 2:] = torch.randn(num_test - num_test // 2, args.num_classes, generator=generator) * 3
+        start = time.perf_counter()
+        expected = loop_scores(logits.numpy(), mean_activation_vectors, weibulls, args.alpha_rank)
+        loop_time = time.perf_counter() - start
+        with torch.no_grad():
+            start = time.perf_counter()
+            scores = scorer(logits)
+            vectorized_time = time.perf_counter() - start
+        results.append({
+            "num_test": num_test,
+            "loop_ms": loop_time * 1000,
+            "vectorized_ms": vectorized_time * 1000,
+            "speedup": loop_time / vectorized_time,
+            "max_abs_difference": np.abs(scores.numpy() - expected).max(),
+        })
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.report_path is not None:
+        results.to_csv(args.report_path, index=False)
+
+if __name__ == "__main__":
+    main()
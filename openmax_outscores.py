@@ -0,0 +1,94 @@
+import argparse
+import os
+
+import torch
+
+from punches_lib import datasets, score_cache, utils
+from punches_lib.cnn import models as cnn_models
+from punches_lib.cnn import openmax
+from punches_lib.ii_loss import models as ii_models
+from punches_lib.storage import ScoreStore
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size (default: 32).")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes in the dataset (default: 19).")
+    parser.add_argument("--model_type", type=str, default="cnn", choices=["cnn", "ii"], help="'cnn' for a classifier trained with main_cnn.py, 'ii' for the logits of a ResNetCustom trained with II-loss (default: cnn).")
+    parser.add_argument("--pretrained_params_path", type=str, required=True, help="path to the params of the model.")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class (default: resnet18).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space, for II-loss models (default: 32).")
+    parser.add_argument("--root_train", type=str, default=None, help="root of training data, on which OpenMax is fitted if --openmax_path does not exist (default: None).")
+    parser.add_argument("--root_valid", type=str, default="data/test", help="root of testing data (default: data/test).")
+    parser.add_argument("--root_crops", type=str, default="data/crops", help="root of crops data (default: data/crops).")
+    parser.add_argument("--root_ood", type=str, default="data/openset", help="root of ood data (default: data/openset).")
+    parser.add_argument("--openmax_path", type=str, default=None, help="path of the OpenMax parameters (mean activation vectors and Weibull models). Loaded if it exists, otherwise fitted on --root_train and saved there (default: None).")
+    parser.add_argument("--tail_size", type=int, default=20, help="number of largest distances per class the Weibull models are fitted to (default: 20).")
+    parser.add_argument("--alpha_rank", type=int, default=10, help="number of top classes whose logits are recalibrated (default: 10).")
+    parser.add_argument("--distance", type=str, default="euclidean", choices=["euclidean", "eucos"], help="distance between the logits and the mean activation vectors (default: euclidean).")
+    parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
+    parser.add_argument("--base_path", type=str, default="model/model_openmax.pth", help="path to save the scores. _valid.pth, _crops.pth, _ood.pth (and _rand.pth) will be added to the filename (default: model/model_openmax.pth).")
+    parser.add_argument("--score_store", type=str, default=None, help="folder of the score store. If specified, the scores are appended to the store (as outlier scores, along with paths, labels, predictions and model id) instead of being saved under --base_path. Images already scored by the same model are not evaluated again, unless they were modified since (default: None).")
+    parser.add_argument("--model_id", type=str, default=None, help="model id stored with the scores (default: None -> <params file name>:openmax:<fingerprint of params and OpenMax parameters>).")
+    parser.add_argument("--do_random", action="store_true", help="Do eval with random sample (default: False).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.device is None:
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if args.model_type == "ii":
+        net = ii_models.ResNetCustom(args.num_classes, args.model_class, dim_latent=args.dim_latent)
+    else:
+        net = cnn_models.get_model(args.model_class, num_classes=args.num_classes)
+    net.load_state_dict(torch.load(args.pretrained_params_path, map_location="cpu"))
+
+    trainloader = datasets.get_dataloader(args.root_train, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms()) if args.root_train is not None else None
+    scorer = openmax.load_or_fit_openmax(args.openmax_path, trainloader, net, args.device, args.tail_size, args.alpha_rank, args.distance)
+
+    validloader = datasets.get_dataloader(args.root_valid, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
+    cropsloader = datasets.get_dataloader(args.root_crops, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
+    oodloader = datasets.get_dataloader(args.root_ood, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
+    if args.do_random:
+        randloader = torch.utils.data.DataLoader(datasets.BasicDatasetLabels(torch.randn((500, 3, 256, 256)), transform=None))
+
+    store = ScoreStore(args.score_store) if args.score_store is not None else None
+    # alpha_rank and distance change the scores but are not buffers of OpenMax
+    model_id = args.model_id if args.model_id is not None else f"{os.path.basename(args.pretrained_params_path)}:openmax:{utils.fingerprint(net, scorer, {'alpha_rank': scorer.alpha_rank, 'distance': scorer.distance})}"
+
+    def save_scores(split, loader, has_labels=False):
+        if store is not None:
+            if hasattr(loader.dataset, "samples"):
+                keys = score_cache.file_keys([path for path, _ in loader.dataset.samples])
+            else:
+                keys = [(f"{split}/{i}", -1, -1) for i in range(len(loader.dataset))]
+            # only the images which are new or modified since they were scored by this model are evaluated
+            already_scored = store.file_keys(split, model_id)
+            new = [i for i, key in enumerate(keys) if key not in already_scored]
+            if len(new) == 0:
+                print(f"[{split}] no new rows")
+                return
+            loader = utils.subset_dataloader(loader, new)
+        outputs = openmax.get_outputs(loader, net, scorer, args.device)
+        if has_labels:
+            labels = torch.as_tensor(loader.dataset.targets)
+            print(f"[{split}] accuracy {(outputs['preds'] == labels).float().mean().item():.4f}, rejected as unknown {(outputs['preds'] == -1).float().mean().item():.4f}")
+        if store is None:
+            torch.save(outputs["outlier_scores"], f"{args.base_path}_{split}.pth")
+            return
+        # only the valid set shares the class folders of the trainset: for the other splits the ImageFolder targets are not punch classes
+        labels = torch.as_tensor(loader.dataset.targets) if has_labels else torch.full((len(new),), -1)
+        new_keys = [keys[i] for i in new]
+        store.append_scores(split, [k[0] for k in new_keys], model_id, labels=labels, preds=outputs["preds"], outlier_scores=outputs["outlier_scores"],
+                            sizes=[k[1] for k in new_keys], mtimes=[k[2] for k in new_keys])
+        print(f"[{split}] {len(new)} new rows appended to {args.score_store}")
+
+    save_scores("valid", validloader, has_labels=True)
+    save_scores("crops", cropsloader)
+    save_scores("ood", oodloader)
+    if args.do_random:
+        save_scores("rand", randloader)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import argparse
+
+import pandas as pd
+import torch
+
+from punches_lib import datasets, inference
+from punches_lib.cnn import models as cnn_models
+from punches_lib.gan import architecture
+from punches_lib.ii_loss import models as ii_models
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default="ii", choices=["ii", "cnn", "discriminator"], help="model to optimize: 'ii' for ResNetCustom trained with II-loss, 'cnn' for a torchvision classifier/backbone, 'discriminator' for the OpenGAN DiscriminatorFunnel (default: ii).")
+    parser.add_argument("--params_path", type=str, required=True, help="path to the params of the model.")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class, for 'ii' and 'cnn' models (default: resnet18).")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes in the dataset (default: 19).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space, for II-loss models (default: 32).")
+    parser.add_argument("--nc", type=int, default=512, help="number of input channels of the discriminator (default: 512).")
+    parser.add_argument("--ndf", type=int, default=64, help="size of feature maps in the discriminator (default: 64).")
+    parser.add_argument("--feature_size", type=int, default=8, help="spatial size of the features fed to the discriminator (default: 8).")
+    parser.add_argument("--mode", type=str, default="eager", choices=["eager", "trace", "compile"], help="optimization mode (default: eager).")
+    parser.add_argument("--no_channels_last", action="store_true", default=False, help="keep the NCHW memory format (default: False).")
+    parser.add_argument("--root_data", type=str, default=None, help="root of the images used for the checks. If None, random inputs are used (default: None).")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size (default: 32).")
+    parser.add_argument("--num_runs", type=int, default=10, help="number of timed runs (default: 10).")
+    parser.add_argument("--cache_dir", type=str, default=None, help="folder where the optimized model is cached (default: None).")
+    parser.add_argument("--device", type=str, default="cpu", help="device to use (default: cpu).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the report is saved (default: None).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.model_type == "ii":
+        net = ii_models.ResNetCustom(args.num_classes, args.model_class, dim_latent=args.dim_latent)
+    elif args.model_type == "cnn":
+        net = cnn_models.get_model(args.model_class, num_classes=args.num_classes)
+    else:
+        net = architecture.DiscriminatorFunnel(nc=args.nc, ndf=args.ndf)
+    net.load_state_dict(torch.load(args.params_path, map_location="cpu"))
+    net = net.to(args.device).eval()
+
+    if args.model_type == "discriminator":
+        X = torch.randn(args.batch_size, args.nc, args.feature_size, args.feature_size)
+    elif args.root_data is not None:
+        X = next(iter(datasets.get_dataloader(args.root_data, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())))[0]
+    else:
+        X = torch.randn(args.batch_size, 3, 256, 256)
+    X = X.to(args.device)
+
+    optimized = inference.optimize_for_inference(net, X, mode=args.mode, channels_last=not args.no_channels_last, cache_dir=args.cache_dir)
+    report = inference.check_equivalence(net, optimized, X)
+    report.update(inference.benchmark(net, optimized, X, num_runs=args.num_runs))
+    report = pd.Series(report)
+    print(report.to_string())
+    if args.report_path is not None:
+        report.to_csv(args.report_path, header=False)
+
+if __name__ == "__main__":
+    main()
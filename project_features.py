@@ -0,0 +1,85 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from matplotlib import pyplot as plt
+
+from punches_lib import decomposition
+from punches_lib.score_cache import ScoreCache
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features_path", type=str, default=None, help="path of the features to project: an .npy file (memory-mapped, e.g. the embeddings.npy of punch_similarity.py or the output of a sharded feature extraction) or a tensor saved with torch.save (e.g. OpenGAN layer4 features) (default: None).")
+    parser.add_argument("--score_cache", type=str, default=None, help="folder of a per-image score cache: the --column of the cache of --cache_fingerprint is projected instead of --features_path (default: None).")
+    parser.add_argument("--cache_fingerprint", type=str, default=None, help="fingerprint of the model whose cached outputs are projected, with --score_cache (default: None).")
+    parser.add_argument("--column", type=str, default="embeddings", help="output of the score cache to project (default: embeddings).")
+    parser.add_argument("--method", type=str, default="randomized", choices=["randomized", "incremental"], help="'randomized' (randomized subspace iteration, a few passes over the features) or 'incremental' (one pass, batch-wise SVD updates) (default: randomized).")
+    parser.add_argument("--num_components", type=int, default=32, help="number of principal components (default: 32).")
+    parser.add_argument("--per_position", action="store_true", default=False, help="for (N, C, H, W) feature maps, project the channels of every spatial position (keeping the layout expected by the OpenGAN discriminator) instead of the flattened maps (default: False).")
+    parser.add_argument("--whiten", action="store_true", default=False, help="scale the projections to unit variance (default: False).")
+    parser.add_argument("--batch_size", type=int, default=1024, help="number of items read at once (default: 1024).")
+    parser.add_argument("--num_power_iters", type=int, default=2, help="number of power iterations of the randomized method (default: 2).")
+    parser.add_argument("--pca_path", type=str, default=None, help="path of the fitted projection. Loaded if it exists, otherwise fitted and saved there (default: None).")
+    parser.add_argument("--out_path", type=str, default=None, help="path where the projected features are saved: written batch by batch if it ends with .npy, saved with torch.save otherwise (default: None).")
+    parser.add_argument("--plot_path", type=str, default=None, help="path of a scatter plot of the first two components (default: None).")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the randomized method (default: 0).")
+    return parser.parse_args()
+
+def load_features(args):
+    if args.score_cache is not None:
+        cache = ScoreCache(args.score_cache, args.cache_fingerprint)
+        assert cache.store is not None and args.column in cache.store.columns, f"No {args.column} cached in {cache.root}"
+        return cache.store.column(args.column)
+    assert args.features_path is not None, "One of --features_path or --score_cache must be specified."
+    if args.features_path.endswith(".npy"):
+        return np.load(args.features_path, mmap_mode="r")
+    return torch.load(args.features_path, map_location="cpu")
+
+def main():
+    args = get_args()
+    features = load_features(args)
+    print(f"Features of shape {tuple(features.shape)}")
+
+    if args.pca_path is not None and os.path.exists(args.pca_path):
+        pca = decomposition.load_pca(args.pca_path)
+    else:
+        start = time.perf_counter()
+        if args.method == "randomized":
+            pca = decomposition.randomized_pca(features, args.num_components, args.batch_size, num_power_iters=args.num_power_iters, per_position=args.per_position, whiten=args.whiten, seed=args.seed)
+        else:
+            pca = decomposition.incremental_pca(features, args.num_components, args.batch_size, per_position=args.per_position, whiten=args.whiten)
+        print(f"Fitted {args.num_components} components ({args.method}) in {time.perf_counter() - start:.1f} s")
+        ratios = pca.explained_variance_ratio(decomposition.total_variance(features, args.batch_size, args.per_position))
+        print(f"Explained variance: {ratios.sum().item():.4f} (first components: {', '.join(f'{r:.4f}' for r in ratios[:5].tolist())})")
+        if args.pca_path is not None:
+            torch.save(pca.state_dict(), args.pca_path)
+            print(f"Projection saved to {args.pca_path}")
+
+    if args.out_path is None and args.plot_path is None:
+        return
+    if args.out_path is not None and args.out_path.endswith(".npy"):
+        shape = tuple(pca(torch.from_numpy(np.array(features[:1])).float()).shape[1:])
+        out = np.lib.format.open_memmap(args.out_path, mode="w+", dtype=np.float32, shape=(len(features),) + shape)
+        projected = torch.from_numpy(decomposition.transform(pca, features, args.batch_size, out=out))
+        out.flush()
+    else:
+        projected = decomposition.transform(pca, features, args.batch_size)
+        if args.out_path is not None:
+            torch.save(projected, args.out_path)
+    if args.out_path is not None:
+        print(f"Projected features of shape {tuple(projected.shape)} saved to {args.out_path}")
+
+    if args.plot_path is not None:
+        points = projected.reshape(len(projected), projected.shape[1], -1).mean(2) if projected.dim() == 4 else projected
+        plt.figure(figsize=(6, 6))
+        plt.scatter(points[:, 0], points[:, 1], s=2, alpha=0.5)
+        plt.xlabel("PC 1")
+        plt.ylabel("PC 2")
+        plt.savefig(args.plot_path, bbox_inches="tight")
+        print(f"Plot saved to {args.plot_path}")
+
+if __name__ == "__main__":
+    main()
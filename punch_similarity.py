@@ -0,0 +1,81 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import torch
+
+from punches_lib import datasets, similarity
+from punches_lib.cnn import models as cnn_models
+from punches_lib.ii_loss import models as ii_models
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_corpus", type=str, required=True, help="root of the corpus of crops, with one folder per painting (laid out like an ImageFolder root).")
+    parser.add_argument("--out_dir", type=str, required=True, help="folder where the embeddings, the nearest-neighbour graph and the per-painting links are saved.")
+    parser.add_argument("--model_type", type=str, default="ii", choices=["ii", "cnn"], help="'ii' embeds the crops with ResNetCustom trained with II-loss, 'cnn' with the penultimate layer of a torchvision classifier (default: ii).")
+    parser.add_argument("--params_path", type=str, required=True, help="path to the params of the model.")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class (default: resnet18).")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes the model was trained on (default: 19).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space, for II-loss models (default: 32).")
+    parser.add_argument("--metric", type=str, default=None, choices=["cosine", "euclidean"], help="similarity between embeddings (default: None -> euclidean for 'ii', cosine for 'cnn').")
+    parser.add_argument("--k", type=int, default=10, help="number of nearest neighbours retained per crop (default: 10).")
+    parser.add_argument("--row_block_size", type=int, default=4096, help="number of crops compared with the corpus at once (default: 4096).")
+    parser.add_argument("--col_block_size", type=int, default=16384, help="number of crops of the corpus each block of rows is compared with at once (default: 16384).")
+    parser.add_argument("--batch_size", type=int, default=128, help="batch size for the embeddings (default: 128).")
+    parser.add_argument("--num_procs", type=int, default=1, help="number of CPU processes the embedding is sharded across; 0 to choose the split between processes and threads automatically (default: 1).")
+    parser.add_argument("--device", type=str, default=None, help="device to use for the embeddings (default: None -> use CUDA if available).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.device is None:
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.metric is None:
+        args.metric = "euclidean" if args.model_type == "ii" else "cosine"
+    os.makedirs(args.out_dir, exist_ok=True)
+    corpus = datasets.get_dataset(args.root_corpus, transforms=datasets.get_bare_transforms())
+    crops = pd.DataFrame({"path": [path for path, _ in corpus.samples], "painting": [corpus.classes[target] for target in corpus.targets]})
+    crops.to_csv(os.path.join(args.out_dir, "crops.csv"), index_label="index")
+
+    embeddings_path = os.path.join(args.out_dir, "embeddings.npy")
+    if os.path.exists(embeddings_path):
+        print(f"Loading the embeddings from {embeddings_path}")
+        embeddings = torch.from_numpy(np.load(embeddings_path, mmap_mode="r"))
+        assert len(embeddings) == len(corpus), f"{embeddings_path} has {len(embeddings)} embeddings, but the corpus has {len(corpus)} crops: delete it to recompute them."
+    else:
+        if args.model_type == "ii":
+            net = ii_models.ResNetCustom(args.num_classes, args.model_class, dim_latent=args.dim_latent)
+            net.load_state_dict(torch.load(args.params_path, map_location="cpu"))
+        else:
+            net = cnn_models.get_model(args.model_class, num_classes=args.num_classes)
+            net.load_state_dict(torch.load(args.params_path, map_location="cpu"))
+            net = similarity.penultimate(net)
+        start = time.perf_counter()
+        # with several processes, the embeddings are written directly to a temporary folder, moved to embeddings.npy once complete,
+        # so that an interrupted run does not leave a partially written file behind
+        tmp_dir = os.path.join(args.out_dir, "embeddings.tmp")
+        embeddings = similarity.compute_embeddings(net, corpus, args.device, args.batch_size, args.num_procs, out_dir=tmp_dir)
+        if args.num_procs == 1:
+            np.save(embeddings_path, embeddings.numpy())
+        else:
+            os.replace(os.path.join(tmp_dir, "embeddings.npy"), embeddings_path)
+            os.rmdir(tmp_dir)
+            embeddings = torch.from_numpy(np.load(embeddings_path, mmap_mode="r"))
+        print(f"Embedded {len(corpus)} crops in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    similarities, indices = similarity.all_pairs_topk(embeddings, args.k, args.metric, args.row_block_size, args.col_block_size)
+    elapsed = time.perf_counter() - start
+    print(f"Compared {len(embeddings)**2:.3g} pairs of crops in {elapsed:.1f} s ({len(embeddings)**2 / elapsed:.3g} pairs/s)")
+    scipy.sparse.save_npz(os.path.join(args.out_dir, "knn_graph.npz"), similarity.knn_graph(similarities, indices))
+
+    paintings = similarity.aggregate_by_group(similarities, indices, np.array(corpus.targets), corpus.classes)
+    paintings.to_csv(os.path.join(args.out_dir, "paintings.csv"), index=False)
+    print(paintings.head(20).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+from typing import Collection, Dict
+
+import torch
+
+def _order_statistic_thresholds(sorted_scores:torch.Tensor, starts:torch.Tensor, counts:torch.Tensor, sensitivity:float) -> torch.Tensor:
+    # for each segment [start, start + count) of ascending scores, the smallest threshold leaving at least ceil(sensitivity * count) scores
+    # strictly below it: between the k-th and the (k+1)-th score of the segment, or just above the last one
+    k = torch.ceil(sensitivity * counts.double()).long().clamp(min=1)
+    last = (starts + k - 1).clamp(0, max(len(sorted_scores) - 1, 0))
+    following = (starts + k).clamp(0, max(len(sorted_scores) - 1, 0))
+    kth, next_score = sorted_scores[last], sorted_scores[following]
+    above = torch.nextafter(kth, torch.full_like(kth, float("inf")))
+    midpoints = torch.maximum((kth + next_score) / 2, above)
+    return torch.where(k < counts, midpoints, above)
+
+class ClassThresholds(torch.nn.Module):
+    '''
+    Per-class outlier thresholds: an image predicted as class c is in-distribution if its outlier score is lower than the threshold of c.
+    Predictions outside of the calibrated classes (e.g., -1 for a missing prediction, or classes registered after the calibration) use the
+    global threshold. Called on (scores, preds), it returns the in-distribution mask with a single gather.
+    '''
+    def __init__(self, thresholds:torch.Tensor, global_threshold:float, sensitivity:float=None, classes:Collection[str]=None, counts:torch.Tensor=None):
+        '''
+        Parameters
+        ----------
+        thresholds: a tensor of shape (C) with the threshold of each class.
+        global_threshold: the threshold of the predictions outside of range(C), and of the classes with too few calibration scores.
+        sensitivity: the target per-class sensitivity used for the calibration, stored for reference.
+        classes: the names of the C classes (e.g., the punch ids), stored for reference.
+        counts: the number of calibration scores of each class, stored for reference.
+        '''
+        super(ClassThresholds, self).__init__()
+        thresholds = torch.as_tensor(thresholds)
+        # the global threshold is appended as an extra class, so that applying the thresholds is one gather
+        self.register_buffer("table", torch.cat((thresholds, torch.tensor([global_threshold], dtype=thresholds.dtype))))
+        self.sensitivity = sensitivity
+        self.classes = None if classes is None else list(classes)
+        self.counts = counts
+
+    @property
+    def thresholds(self) -> torch.Tensor:
+        return self.table[:-1]
+
+    @property
+    def global_threshold(self) -> float:
+        return self.table[-1].item()
+
+    def lookup(self, preds:torch.Tensor) -> torch.Tensor:
+        '''
+        Returns the threshold applying to each prediction.
+        '''
+        preds = torch.as_tensor(preds, device=self.table.device).long()
+        num_classes = len(self.table) - 1
+        return self.table[torch.where((preds >= 0) & (preds < num_classes), preds, num_classes)]
+
+    def forward(self, scores:torch.Tensor, preds:torch.Tensor) -> torch.Tensor:
+        scores = torch.as_tensor(scores, device=self.table.device)
+        return scores < self.lookup(preds).to(scores.dtype)
+
+    def state(self) -> Dict[str, object]:
+        '''
+        Returns the arguments to rebuild the thresholds, ClassThresholds(**thresholds.state()).
+        '''
+        return {"thresholds": self.thresholds.cpu(), "global_threshold": self.global_threshold, "sensitivity": self.sensitivity, "classes": self.classes, "counts": self.counts}
+
+def calibrate_thresholds(scores:torch.Tensor, preds:torch.Tensor, num_classes:int, sensitivity:float=0.95, min_samples:int=10, classes:Collection[str]=None) -> ClassThresholds:
+    '''
+    Calibrates one outlier threshold per predicted class on the scores of in-distribution data (e.g., the validation set), so that a fraction
+    sensitivity of the images predicted as each class is accepted. The (pred, score) pairs are sorted once, lexicographically, so that the
+    scores of each class form a contiguous ascending segment; the threshold of every class is then gathered at once from its order statistic.
+
+    Parameters
+    ----------
+    scores: a tensor of shape (N) with the outlier scores (higher is more likely OOD).
+    preds: a tensor of shape (N) with the predicted classes. Predictions outside of range(num_classes) and NaN scores are ignored.
+    num_classes: the number of classes C.
+    sensitivity: the target fraction of in-distribution images accepted in each class.
+    min_samples: the classes with fewer calibration scores get the global threshold, calibrated on all the scores.
+    classes: the names of the classes, stored in the result.
+
+    Returns
+    -------
+    a ClassThresholds.
+    '''
+    scores = torch.as_tensor(scores).reshape(-1)
+    preds = torch.as_tensor(preds).reshape(-1).long()
+    keep = (preds >= 0) & (preds < num_classes) & ~torch.isnan(scores)
+    scores, preds = scores[keep], preds[keep]
+    assert len(scores) > 0, f"No scores with a prediction in range({num_classes}) to calibrate the thresholds on"
+    order = torch.argsort(scores, stable=True)
+    order = order[torch.argsort(preds[order], stable=True)]
+    sorted_scores = scores[order]
+
+    counts = torch.bincount(preds, minlength=num_classes)
+    starts = counts.cumsum(0) - counts
+    thresholds = _order_statistic_thresholds(sorted_scores, starts, counts, sensitivity)
+    global_threshold = _order_statistic_thresholds(sorted_scores.sort().values, torch.zeros(1, dtype=torch.long), torch.tensor([len(scores)]), sensitivity)
+    thresholds = torch.where(counts >= max(min_samples, 1), thresholds, global_threshold)
+    return ClassThresholds(thresholds, global_threshold.item(), sensitivity, classes, counts)
+
+def load_thresholds(path:str) -> ClassThresholds:
+    '''
+    Loads the ClassThresholds saved (as a state dict, see ClassThresholds.state) at path.
+    '''
+    return ClassThresholds(**torch.load(path, map_location="cpu"))
+
+def load_or_calibrate_thresholds(thresholds_path:str, scores:torch.Tensor, preds:torch.Tensor, num_classes:int, sensitivity:float=0.95, min_samples:int=10, classes:Collection[str]=None) -> ClassThresholds:
+    '''
+    Loads the thresholds saved at thresholds_path if it exists, otherwise calibrates them and saves them there (if thresholds_path is not None).
+    '''
+    if thresholds_path is not None and os.path.exists(thresholds_path):
+        return load_thresholds(thresholds_path)
+    thresholds = calibrate_thresholds(scores, preds, num_classes, sensitivity, min_samples, classes)
+    if thresholds_path is not None:
+        torch.save(thresholds.state(), thresholds_path)
+    return thresholds
@@ -0,0 +1,160 @@
+from typing import Dict, Union
+
+import torch
+from tqdm import tqdm
+
+from .. import metrics, score_cache, utils
+from ..ii_loss import eval as eval_ii
+
+class DistillationLoss(torch.nn.Module):
+    '''
+    Loss for distilling a teacher into a student: alpha * T^2 * KL(teacher || student) on the temperature-softened logits, plus
+    (1 - alpha) * cross-entropy on the labels, plus beta * MSE between student and teacher embeddings (if the teacher has embeddings).
+
+    Attributes
+    ----------
+    temperature: the softmax temperature applied to both teacher and student logits.
+    alpha: the weight of the distillation term with respect to the cross-entropy.
+    beta: the weight of the embedding matching term.
+    '''
+    def __init__(self, temperature:float=4.0, alpha:float=0.9, beta:float=1.0):
+        super().__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+        self.beta = beta
+
+    def forward(self, embeddings:torch.Tensor, logits:torch.Tensor, labels:torch.Tensor, teacher_logits:torch.Tensor, teacher_embeddings:torch.Tensor=None) -> torch.Tensor:
+        T = self.temperature
+        kd = torch.nn.functional.kl_div(
+            torch.nn.functional.log_softmax(logits / T, dim=1),
+            torch.nn.functional.log_softmax(teacher_logits / T, dim=1),
+            reduction="batchmean", log_target=True
+        ) * T**2
+        loss = self.alpha * kd + (1 - self.alpha) * torch.nn.functional.cross_entropy(logits, labels)
+        if teacher_embeddings is not None and self.beta > 0:
+            loss = loss + self.beta * torch.nn.functional.mse_loss(embeddings, teacher_embeddings)
+        return loss
+
+def get_teacher_outputs(dataloader:torch.utils.data.DataLoader, teacher:torch.nn.Module, device:Union[torch.device, str]) -> Dict[str, torch.Tensor]:
+    '''
+    Runs the teacher over a (non-shuffled) dataloader.
+
+    Returns
+    -------
+    a dict with key "logits" and, if the teacher outputs (embeddings, logits) as ii_loss.models.ResNetCustom, "embeddings", in the order of the dataset.
+    '''
+    teacher.to(device)
+    teacher.eval()
+    outputs = {"logits": [], "embeddings": []}
+    with torch.no_grad():
+        for X, _ in tqdm(dataloader):
+            out = teacher(X.to(device))
+            if isinstance(out, tuple):
+                outputs["embeddings"].append(out[0].cpu())
+                out = out[1]
+            outputs["logits"].append(out.cpu())
+    return {name: torch.cat(values) for name, values in outputs.items() if len(values) > 0}
+
+def cached_teacher_outputs(dataloader:torch.utils.data.DataLoader, teacher:torch.nn.Module, device:Union[torch.device, str], cache:score_cache.ScoreCache=None) -> Dict[str, torch.Tensor]:
+    '''
+    Same as get_teacher_outputs, but if a ScoreCache is passed (e.g., keyed by utils.fingerprint(teacher)) the outputs are read from it and only
+    the images which are new or modified are run through the teacher.
+    The dataset must use deterministic transforms, as the outputs are computed once for each image.
+    '''
+    if cache is not None and hasattr(dataloader.dataset, "samples"):
+        return score_cache.cached_outputs(dataloader, lambda loader: get_teacher_outputs(loader, teacher, device), cache)
+    return get_teacher_outputs(dataloader, teacher, device)
+
+def train_model(
+    model:torch.nn.Module,
+    dataloader:torch.utils.data.DataLoader,
+    teacher_outputs:Dict[str, torch.Tensor],
+    loss_fn:DistillationLoss,
+    optimizer:torch.optim.Optimizer,
+    num_epochs:int,
+    lr_scheduler:torch.optim.lr_scheduler._LRScheduler=None,
+    device:Union[torch.device, str]=None
+):
+    '''
+    Trains a student model from the precomputed outputs of a teacher, so that the teacher is never run during training.
+
+    Parameters
+    ----------
+    model: the student, a torch.nn.Module returning (embeddings, logits), e.g. cnn.models.StudentNet.
+    dataloader: a torch.utils.data.DataLoader on a datasets.IndexedDataset, yielding (X, y, index) triplets.
+    teacher_outputs: a dict with keys "logits" and optionally "embeddings", indexed as the dataset (see cached_teacher_outputs).
+    loss_fn: a DistillationLoss instance.
+    optimizer: a torch.optim.Optimizer instance.
+    num_epochs: an integer indicating the number of epochs to train.
+    lr_scheduler: a learning rate scheduler - torch.optim.lr_scheduler._LRScheduler instance.
+    device: a torch.device instance or a string indicating the device to use. If None, will use CUDA if available.
+    '''
+    if device is None:
+        device = utils.use_cuda_if_possible()
+
+    model = model.to(device)
+    model.train()
+
+    for epoch in range(num_epochs):
+        loss_meter = utils.AverageMeter()
+        performance_meter = utils.AverageMeter()
+
+        print(f"Epoch {epoch+1} --- learning rate {optimizer.param_groups[0]['lr']:.5f}")
+
+        for X, y, idx in tqdm(dataloader):
+            X = X.to(device)
+            y = y.to(device)
+            teacher_logits = teacher_outputs["logits"][idx].to(device)
+            teacher_embeddings = teacher_outputs["embeddings"][idx].to(device) if "embeddings" in teacher_outputs else None
+            optimizer.zero_grad()
+            embeddings, y_hat = model(X)
+            loss = loss_fn(embeddings, y_hat, y, teacher_logits, teacher_embeddings)
+            loss.backward()
+            optimizer.step()
+            acc = utils.accuracy(y_hat, y)
+            loss_meter.update(val=loss.item(), n=X.shape[0])
+            performance_meter.update(val=acc, n=X.shape[0])
+
+        print(f"Epoch {epoch+1} completed. Average loss: {loss_meter.avg:.4f}; Performance: {performance_meter.avg:.4f}")
+
+        if lr_scheduler is not None:
+            lr_scheduler.step()
+
+def compare_models(teacher:torch.nn.Module, student:torch.nn.Module, trainloader:torch.utils.data.DataLoader, validloader:torch.utils.data.DataLoader, oodloader:torch.utils.data.DataLoader=None, device:Union[torch.device, str]=None, num_timing_runs:int=10) -> Dict[str, float]:
+    '''
+    Reports the accuracy/AUROC vs. throughput trade-off of a student with respect to its teacher.
+    Accuracies are computed on validloader; for models returning (embeddings, logits), the mean embeddings are computed on trainloader and the
+    AUROC of the outlier scores (OOD vs. validation) is computed on oodloader. Latency and throughput are measured on the CPU.
+
+    Returns
+    -------
+    a dict containing, for "teacher" and "student", accuracy, latency, throughput and (if available) AUROC, plus the speedup of the student.
+    '''
+    if device is None:
+        device = utils.use_cuda_if_possible()
+    report = {}
+    for name, model in (("teacher", teacher), ("student", student)):
+        model.to(device)
+        model.eval()
+        X = next(iter(validloader))[0]
+        with torch.no_grad():
+            is_ii = isinstance(model(X[:1].to(device)), tuple)
+        if is_ii:
+            means = eval_ii.get_mean_embeddings(trainloader, model, device)
+            valid_outputs = eval_ii.get_outputs(validloader, model, means, device)
+        else:
+            valid_outputs = get_teacher_outputs(validloader, model, device)
+        labels = torch.as_tensor([y for _, y in validloader.dataset.samples]) if hasattr(validloader.dataset, "samples") else torch.cat([y for _, y in validloader])
+        report[f"{name}_accuracy"] = utils.accuracy(valid_outputs["logits"], labels)
+        if is_ii and oodloader is not None:
+            ood_scores = eval_ii.get_outputs(oodloader, model, means, device)["outlier_scores"]
+            report[f"{name}_auroc"] = metrics.auroc(ood_scores, valid_outputs["outlier_scores"])
+        timing = utils.time_inference(model.cpu(), X, num_runs=num_timing_runs)
+        report[f"{name}_latency_ms"] = timing["latency_ms"]
+        report[f"{name}_throughput"] = timing["throughput"]
+        report[f"{name}_num_params"] = sum(p.numel() for p in model.parameters())
+    report["accuracy_drop"] = report["teacher_accuracy"] - report["student_accuracy"]
+    report["speedup"] = report["teacher_latency_ms"] / report["student_latency_ms"]
+    if "teacher_auroc" in report and "student_auroc" in report:
+        report["auroc_drift"] = report["student_auroc"] - report["teacher_auroc"]
+    return report
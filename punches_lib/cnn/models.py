@@ -17,4 +17,53 @@ def get_model(model_class:str, pretrained:bool=False, num_classes:int=19) -> tor
     '''
     net = getattr(models, model_class)(pretrained=pretrained)
     net.fc = torch.nn.Linear(net.fc.in_features, num_classes)
-    return net
\ No newline at end of file
+    return net
+
+STUDENT_ARCHITECTURES = ["mobilenet_v3_small", "shufflenet_v2_x0_5", "shufflenet_v2_x1_0", "resnet10"]
+
+class StudentNet(torch.nn.Module):
+    '''
+    A compact network for distillation (see cnn.distill), exposing the same (embeddings, logits) interface as ii_loss.models.ResNetCustom,
+    so that it can be used wherever outlier scores are computed.
+    '''
+    def __init__(self, num_classes:int, architecture:str="mobilenet_v3_small", dim_latent:int=32):
+        '''
+        Parameters
+        ----------
+        num_classes: an integer indicating the number of classes.
+        architecture: a string indicating the feature extractor: "mobilenet_v3_small", "shufflenet_v2_x0_5", "shufflenet_v2_x1_0" or "resnet10" (a ResNet with one BasicBlock per stage).
+        dim_latent: the dimension of the embeddings. Use the same as the teacher to distill its embeddings.
+        '''
+        super().__init__()
+        if architecture == "mobilenet_v3_small":
+            net = models.mobilenet_v3_small()
+            self.features = net.features
+            num_features = 576
+        elif architecture in ("shufflenet_v2_x0_5", "shufflenet_v2_x1_0"):
+            net = getattr(models, architecture)()
+            self.features = torch.nn.Sequential(net.conv1, net.maxpool, net.stage2, net.stage3, net.stage4, net.conv5)
+            num_features = net.fc.in_features
+        elif architecture == "resnet10":
+            net = models.ResNet(models.resnet.BasicBlock, [1, 1, 1, 1])
+            self.features = torch.nn.Sequential(net.conv1, net.bn1, net.relu, net.maxpool, net.layer1, net.layer2, net.layer3, net.layer4)
+            num_features = 512
+        else:
+            raise ValueError(f"Unknown architecture {architecture}")
+        self.avgpool = torch.nn.AdaptiveAvgPool2d(1)
+        self.fc1 = torch.nn.Linear(num_features, dim_latent)
+        self.fc2 = torch.nn.Linear(dim_latent, num_classes)
+
+    def forward(self, x):
+        '''
+        Forward pass of the model.
+
+        Returns
+        -------
+        out_z: a two-dimensional torch.Tensor of shape (num_datapoints x dim_latent)
+        out_y: a two-dimensional torch.Tensor of shape (num_datapoints x num_classes)
+        '''
+        out = self.avgpool(self.features(x))
+        out = out.reshape(out.shape[0], -1)
+        out_z = self.fc1(out)
+        out_y = self.fc2(out_z)
+        return out_z, out_y
@@ -0,0 +1,170 @@
+import os
+from typing import Dict, Union
+
+import numpy as np
+import scipy.stats
+import torch
+from tqdm import tqdm
+
+def _logits(model:torch.nn.Module, X:torch.Tensor) -> torch.Tensor:
+    outputs = model(X)
+    # models trained with II-loss return (embeddings, logits)
+    return outputs[1] if isinstance(outputs, tuple) else outputs
+
+def activation_distances(logits:torch.Tensor, mavs:torch.Tensor, distance:str="euclidean") -> torch.Tensor:
+    '''
+    Returns the distances (N x C) between the activation vectors (N x C logits) and the mean activation vector of each class (C x C).
+    "euclidean" is the Euclidean distance, "eucos" the combination of Euclidean and cosine distance of the OpenMax paper (euclidean / 200 + cosine).
+    '''
+    assert distance in ("euclidean", "eucos"), f"Unknown distance {distance}"
+    euclidean = torch.cdist(logits.float(), mavs.float())
+    if distance == "euclidean":
+        return euclidean
+    cosine = 1 - torch.nn.functional.normalize(logits.float(), dim=1) @ torch.nn.functional.normalize(mavs.float(), dim=1).T
+    return euclidean / 200 + cosine
+
+def fit_weibull(distances:np.ndarray, tail_size:int=20) -> np.ndarray:
+    '''
+    Fits a two-parameter Weibull distribution (location fixed at 0) by maximum likelihood to the tail_size largest distances, as libMR's fit_high.
+
+    Returns
+    -------
+    a numpy array (shape, scale). With fewer than 2 distances, the scale is infinite, so that every W-score is 0.
+    '''
+    if len(distances) < 2:
+        return np.array([1.0, np.inf])
+    tail = np.sort(np.asarray(distances, dtype=np.float64))[-tail_size:]
+    shape, _, scale = scipy.stats.weibull_min.fit(tail, floc=0)
+    return np.array([shape, scale])
+
+class OpenMax(torch.nn.Module):
+    '''
+    OpenMax (Bendale & Boult, 2016): the logits are recalibrated by the W-scores of their distances to the mean activation vector of each
+    class, under a per-class Weibull model of the distances of the correctly classified training images; the mass removed from the known classes
+    goes to an additional "unknown" class.
+    The recalibration is vectorized over the batch and the classes: one distance matrix, one Weibull CDF and one sort per batch.
+    '''
+    def __init__(self, mavs:torch.Tensor, weibull_params:torch.Tensor, alpha_rank:int=10, distance:str="euclidean"):
+        '''
+        Parameters
+        ----------
+        mavs: the mean activation vectors of the classes (C x C).
+        weibull_params: the (shape, scale) of the Weibull model of each class (C x 2), see fit_weibull.
+        alpha_rank: the number of top classes of each image whose logits are recalibrated.
+        distance: the distance between activation vectors, see activation_distances.
+        '''
+        super().__init__()
+        self.register_buffer("mavs", mavs.float())
+        self.register_buffer("weibull_params", torch.as_tensor(weibull_params, dtype=torch.float64))
+        self.alpha_rank = min(alpha_rank, len(mavs))
+        self.distance = distance
+
+    def w_scores(self, logits:torch.Tensor) -> torch.Tensor:
+        '''
+        Returns the probability (N x C) that each image is an outlier of each class, i.e. the Weibull CDF of its distance to the class MAV.
+        '''
+        distances = activation_distances(logits, self.mavs, self.distance).double()
+        shape, scale = self.weibull_params[:, 0], self.weibull_params[:, 1]
+        return (1 - torch.exp(-(distances / scale) ** shape)).float()
+
+    def recalibrate(self, logits:torch.Tensor) -> torch.Tensor:
+        '''
+        Returns the OpenMax probabilities (N x (C + 1)): the unknown class first, then the known classes.
+        '''
+        logits = logits.float()
+        num_classes = logits.shape[1]
+        # the top alpha_rank classes of each image are weighted (alpha - rank) / alpha, the others 0
+        ranks = logits.argsort(dim=1, descending=True).argsort(dim=1)
+        rank_weights = ((self.alpha_rank - ranks) / self.alpha_rank).clamp(min=0)
+        removed = logits * self.w_scores(logits) * rank_weights
+        recalibrated = torch.cat([removed.sum(1, keepdim=True), logits - removed], dim=1)
+        return torch.softmax(recalibrated, dim=1)
+
+    def forward(self, logits:torch.Tensor) -> torch.Tensor:
+        '''
+        Returns the outlier scores, the OpenMax probability of the unknown class (higher is more likely OOD).
+        '''
+        return self.recalibrate(logits)[:, 0]
+
+    def predict(self, logits:torch.Tensor) -> torch.Tensor:
+        '''
+        Returns the predicted classes, -1 for the images whose most probable class is the unknown class.
+        '''
+        return self.recalibrate(logits).argmax(1) - 1
+
+def fit_openmax(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, device:Union[torch.device, str], tail_size:int=20, alpha_rank:int=10, distance:str="euclidean") -> OpenMax:
+    '''
+    Fits OpenMax on a (training) dataloader in one streaming pass over the model: the per-class sums of the logits of the correctly classified
+    images are accumulated batch by batch (their logits, C floats per image, are kept for the distances), then a Weibull model is fitted to the
+    tail of the distances of each class to its mean activation vector.
+
+    Parameters
+    ----------
+    dataloader: a torch.utils.data.DataLoader yielding (X, y) pairs.
+    model: a torch.nn.Module returning logits (e.g., cnn.models.get_model) or (embeddings, logits) (e.g., ii_loss.models.ResNetCustom).
+    device: a torch.device instance or a string indicating the device to use.
+    tail_size: the number of largest distances per class the Weibull models are fitted to.
+    alpha_rank: the number of top classes recalibrated per image.
+    distance: the distance between activation vectors, see activation_distances.
+    '''
+    model.to(device)
+    model.eval()
+    sums, counts = None, None
+    correct_logits, correct_labels = [], []
+    with torch.no_grad():
+        for X, y in tqdm(dataloader):
+            logits = _logits(model, X.to(device)).float().cpu()
+            if sums is None:
+                sums = torch.zeros(logits.shape[1], logits.shape[1], dtype=torch.float64)
+                counts = torch.zeros(logits.shape[1], dtype=torch.float64)
+            correct = logits.argmax(1) == y
+            sums.index_add_(0, y[correct], logits[correct].double())
+            counts.index_add_(0, y[correct], torch.ones(int(correct.sum()), dtype=torch.float64))
+            correct_logits.append(logits[correct])
+            correct_labels.append(y[correct])
+    mavs = (sums / counts.clamp(min=1).unsqueeze(1)).float()
+    correct_logits, correct_labels = torch.cat(correct_logits), torch.cat(correct_labels)
+    # distance of each correctly classified image to the MAV of its class
+    distances = activation_distances(correct_logits, mavs, distance).gather(1, correct_labels.unsqueeze(1)).squeeze(1).numpy()
+    weibull_params = np.stack([fit_weibull(distances[correct_labels.numpy() == c], tail_size) for c in range(len(mavs))])
+    return OpenMax(mavs, torch.from_numpy(weibull_params), alpha_rank, distance)
+
+def state(openmax:OpenMax) -> Dict[str, object]:
+    '''
+    Returns the arguments to rebuild an OpenMax instance, OpenMax(**state(openmax)).
+    '''
+    return {"mavs": openmax.mavs, "weibull_params": openmax.weibull_params, "alpha_rank": openmax.alpha_rank, "distance": openmax.distance}
+
+def load_or_fit_openmax(openmax_path:str, dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, device:Union[torch.device, str], tail_size:int=20, alpha_rank:int=10, distance:str="euclidean") -> OpenMax:
+    '''
+    Loads the OpenMax parameters saved at openmax_path if it exists, otherwise fits them on the dataloader (e.g., on the trainset) and saves them
+    there (if openmax_path is not None).
+    '''
+    if openmax_path is not None and os.path.exists(openmax_path):
+        return OpenMax(**torch.load(openmax_path))
+    assert dataloader is not None, f"No OpenMax parameters found at {openmax_path}: a dataloader on the trainset is needed to fit them."
+    openmax = fit_openmax(dataloader, model, device, tail_size, alpha_rank, distance)
+    if openmax_path is not None:
+        torch.save(state(openmax), openmax_path)
+    return openmax
+
+def get_outputs(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, openmax:OpenMax, device:Union[torch.device, str]) -> Dict[str, torch.Tensor]:
+    '''
+    Runs the model over a (non-shuffled) dataloader and recalibrates its logits with OpenMax.
+
+    Returns
+    -------
+    a dict with keys "logits", "outlier_scores" (probability of the unknown class) and "preds" (-1 for unknown), in the order of the dataset.
+    '''
+    model.to(device)
+    model.eval()
+    openmax.to(device)
+    outputs = {"logits": [], "outlier_scores": [], "preds": []}
+    with torch.no_grad():
+        for X, _ in tqdm(dataloader):
+            logits = _logits(model, X.to(device)).float()
+            probabilities = openmax.recalibrate(logits)
+            outputs["logits"].append(logits.cpu())
+            outputs["outlier_scores"].append(probabilities[:, 0].cpu())
+            outputs["preds"].append((probabilities.argmax(1) - 1).cpu())
+    return {name: torch.cat(values) for name, values in outputs.items()}
@@ -2,7 +2,7 @@ from typing import Union
 import torch
 from tqdm import tqdm
 
-from .. import utils
+from .. import distributed, utils
 
 def train_model(
     model:torch.nn.Module,
@@ -34,13 +34,16 @@ def train_model(
     model.train()
 
     for epoch in range(num_epochs):
+        # reshuffle the shards of the DistributedSampler, if any
+        distributed.set_sampler_epoch(dataloader, epoch)
         loss_meter = utils.AverageMeter()
         performance_meter = utils.AverageMeter()
 
         # added print for LR
-        print(f"Epoch {epoch+1} --- learning rate {optimizer.param_groups[0]['lr']:.5f}")
+        if distributed.is_main_process():
+            print(f"Epoch {epoch+1} --- learning rate {optimizer.param_groups[0]['lr']:.5f}")
 
-        for X, y in tqdm(dataloader):
+        for X, y in tqdm(dataloader, disable=not distributed.is_main_process()):
             X = X.to(device)
             y = y.to(device)
             # 1. reset the gradients previously accumulated by the optimizer
@@ -59,7 +62,8 @@ def train_model(
             loss_meter.update(val=loss.item(), n=X.shape[0])
             performance_meter.update(val=acc, n=X.shape[0])
 
-        print(f"Epoch {epoch+1} completed. Average loss: {loss_meter.avg:.4f}; Performance: {performance_meter.avg:.4f}")
+        if distributed.is_main_process():
+            print(f"Epoch {epoch+1} completed. Average loss: {loss_meter.avg:.4f}; Performance: {performance_meter.avg:.4f}")
 
         # update the state of the lr scheduler if provided
         if lr_scheduler is not None:
@@ -0,0 +1,140 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Collection, Dict, List
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+import torch
+import torch.multiprocessing as mp
+
+from . import metrics
+from .cnn import models as cnn_models, openmax, train as cnn_train
+from .ii_loss import eval as eval_ii, ii_loss, models as ii_models, train as train_ii
+from .radam import RAdam
+from .sweep import CachedImageFolder
+
+def stratified_folds(targets:Collection[int], num_folds:int=5, seed:int=0) -> List[np.ndarray]:
+    '''
+    Splits a dataset into num_folds folds with the same proportion of every class: the images of each class are shuffled and dealt to the
+    folds in turn, continuing from the fold where the previous class stopped, so that the folds also have (almost) the same size.
+
+    Returns
+    -------
+    a list of num_folds arrays with the (sorted) indices of the images of each fold.
+    '''
+    rng = np.random.default_rng(seed)
+    targets = np.asarray(targets)
+    assignment = np.empty(len(targets), dtype=np.int64)
+    offset = 0
+    for c in np.unique(targets):
+        indices = rng.permutation(np.flatnonzero(targets == c))
+        assignment[indices] = (offset + np.arange(len(indices))) % num_folds
+        offset += len(indices)
+    return [np.flatnonzero(assignment == fold) for fold in range(num_folds)]
+
+def _midpoints(scores_id:torch.Tensor, scores_ood:torch.Tensor) -> torch.Tensor:
+    # the best W is reached between two consecutive distinct scores: their midpoints (and two outer values) are the only thresholds to try
+    values = torch.unique(torch.cat((scores_id, scores_ood)).double())
+    return torch.cat((values[:1] - 1, (values[1:] + values[:-1]) / 2, values[-1:] + 1))
+
+def _train_cnn(config:dict, trainset:CachedImageFolder, device:str):
+    net = cnn_models.get_model(config["model_class"], config["use_pretrained"], num_classes=len(trainset.classes))
+    optimizer = torch.optim.RAdam(net.parameters(), lr=config["lr"])
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=config["lr_decay_epochs"], gamma=config["lr_decay_gamma"])
+    trainloader = torch.utils.data.DataLoader(trainset, batch_size=config["batch_size"], shuffle=True)
+    cnn_train.train_model(net, trainloader, torch.nn.CrossEntropyLoss(), optimizer, config["epochs"], scheduler, device=device)
+    # the outlier scores of the CNN are the probabilities of the unknown class of OpenMax, fitted on the training folds
+    scorer = openmax.fit_openmax(torch.utils.data.DataLoader(trainset, batch_size=config["batch_size"], shuffle=False), net, device, config["tail_size"], config["alpha_rank"])
+    return lambda loader: openmax.get_outputs(loader, net, scorer, device)
+
+def _train_ii(config:dict, trainset:CachedImageFolder, device:str):
+    net = ii_models.ResNetCustom(len(trainset.classes), config["model_class"], dim_latent=config["dim_latent"])
+    if config["pretrained_params_path"] is not None:
+        net.load_state_dict(torch.load(config["pretrained_params_path"], map_location="cpu"), strict=False)
+    optimizer = RAdam(net.parameters(), lr=config["lr"])
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=config["lr_decay_epochs"], gamma=config["lr_decay_gamma"])
+    trainloader = torch.utils.data.DataLoader(trainset, batch_size=config["batch_size"], shuffle=True)
+    train_ii.train_model(net, trainloader, ii_loss.IILoss(delta=config["delta_ii"]), torch.nn.CrossEntropyLoss(), config["epochs"], optimizer, scheduler, device, lambda_scale=config["lambda_ii"])
+    train_means = eval_ii.get_mean_embeddings(torch.utils.data.DataLoader(trainset, batch_size=config["batch_size"], shuffle=False), net, device)
+    return lambda loader: eval_ii.get_outputs(loader, net, train_means, device)
+
+def run_fold(config:dict, fold:int, train_indices:np.ndarray, test_indices:np.ndarray, num_threads:int) -> dict:
+    '''
+    Trains a model (config["model"], "cnn" as main_cnn.py or "ii" as main_ii.py) on the images of the cache config["image_cache"] outside of
+    the fold and evaluates it on the held-out fold (in-distribution) and on the open set config["open_cache"] (OOD).
+
+    Returns
+    -------
+    a dict with the accuracy on the fold, the accuracy of each class (accuracy_<class>), the AUROC of the outlier scores between open set
+    and fold, the best weighted sensitivity/specificity W (see metrics.weighted_accuracies) with its threshold, and the training time.
+    '''
+    num_threads_before = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    start = time.perf_counter()
+    try:
+        device = config["device"]
+        trainset = CachedImageFolder(config["image_cache"], train_indices)
+        testset = CachedImageFolder(config["image_cache"], test_indices)
+        torch.manual_seed(config["seed"] + fold)
+        evaluate = (_train_cnn if config["model"] == "cnn" else _train_ii)(config, trainset, device)
+        loader = lambda dataset: torch.utils.data.DataLoader(dataset, batch_size=config["batch_size"], shuffle=False)
+        outputs_test = evaluate(loader(testset))
+        scores_open = evaluate(loader(CachedImageFolder(config["open_cache"])))["outlier_scores"]
+    finally:
+        torch.set_num_threads(num_threads_before)
+
+    targets = torch.tensor(testset.targets)
+    correct = (outputs_test["logits"].argmax(1) == targets).float()
+    scores_test = outputs_test["outlier_scores"]
+    W, threshold = metrics.best_weighted_accuracy(scores_test, scores_open, _midpoints(scores_test, scores_open))
+    return {
+        "fold": fold,
+        "accuracy": correct.mean().item(),
+        **{f"accuracy_{name}": correct[targets == c].mean().item() for c, name in enumerate(testset.classes)},
+        "auroc": metrics.auroc(scores_open, scores_test),
+        "W": W,
+        "threshold": threshold,
+        "seconds": time.perf_counter() - start,
+    }
+
+def cross_validate(config:dict, num_folds:int=5, num_procs:int=1, num_threads:int=None, seed:int=0) -> pd.DataFrame:
+    '''
+    Runs a stratified k-fold cross-validation (see stratified_folds and run_fold), the folds being trained concurrently by num_procs processes
+    with num_threads threads each. All the processes memory-map the same decoded images (see sweep.cache_images).
+
+    Returns
+    -------
+    a pandas DataFrame with one row per fold (see run_fold).
+    '''
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // num_procs)
+    folds = stratified_folds(CachedImageFolder(config["image_cache"]).targets, num_folds, seed)
+    tasks = [(config, fold, np.concatenate(folds[:fold] + folds[fold+1:]), test_indices, num_threads) for fold, test_indices in enumerate(folds)]
+    if num_procs == 1:
+        results = [run_fold(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=num_procs, mp_context=mp.get_context("spawn")) as executor:
+            results = list(executor.map(run_fold, *zip(*tasks)))
+    return pd.DataFrame(results)
+
+def confidence_interval(values:Collection[float], confidence:float=0.95) -> Dict[str, float]:
+    '''
+    Returns the mean of values (e.g., a metric over the folds), their standard deviation and the Student's t confidence interval of the mean.
+    '''
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    mean = values.mean() if len(values) > 0 else float("nan")
+    if len(values) < 2:
+        return {"mean": mean, "std": float("nan"), "ci_low": float("nan"), "ci_high": float("nan")}
+    std = values.std(ddof=1)
+    half_width = scipy.stats.t.ppf((1 + confidence) / 2, len(values) - 1) * std / np.sqrt(len(values))
+    return {"mean": mean, "std": std, "ci_low": mean - half_width, "ci_high": mean + half_width}
+
+def summarize_folds(results:pd.DataFrame, confidence:float=0.95) -> pd.DataFrame:
+    '''
+    Aggregates the metrics of the folds (the output of cross_validate) into one row per metric, with mean, std and confidence interval.
+    '''
+    metric_names = [name for name in results.columns if name not in ("fold", "seconds")]
+    return pd.DataFrame([{"metric": name, **confidence_interval(results[name], confidence)} for name in metric_names])
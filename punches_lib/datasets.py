@@ -76,4 +76,18 @@ class BasicDatasetLabels(torch.utils.data.Dataset):
         curdata = self.data[idx]
         if self.transform is not None:
             return self.transform(curdata)
-        return curdata, self.label
\ No newline at end of file
+        return curdata, self.label
+
+class IndexedDataset(torch.utils.data.Dataset):
+    '''
+    Wraps a dataset of (X, y) pairs so that it also returns the index of each datapoint, e.g. for retrieving precomputed outputs.
+    '''
+    def __init__(self, dataset:torch.utils.data.Dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        X, y = self.dataset[idx]
+        return X, y, idx
@@ -0,0 +1,210 @@
+from typing import Iterator, Tuple, Union
+
+import numpy as np
+import torch
+
+Features = Union[torch.Tensor, np.ndarray]
+
+def iter_batches(features:Features, batch_size:int=1024, per_position:bool=False) -> Iterator[torch.Tensor]:
+    '''
+    Yields the features in batches of batch_size items as float64 matrices, reading only one batch at a time, so that memory-mapped features
+    (e.g., an .npy file opened with mmap_mode="r", the output of parallel.run_sharded or a column of a ScoreCache) are streamed from disk.
+
+    Parameters
+    ----------
+    features: a tensor or array of shape (N, D) or (N, C, H, W), e.g. the layer4 features of the OpenGAN backbone.
+    batch_size: the number of items per batch.
+    per_position: if True, every spatial position of an (N, C, H, W) feature map is a sample of dimension C (B*H*W x C per batch); otherwise
+        the items are flattened (B x C*H*W per batch).
+    '''
+    for start in range(0, len(features), batch_size):
+        batch = torch.from_numpy(np.array(features[start:start+batch_size])).double()
+        if per_position and batch.dim() == 4:
+            yield batch.permute(0, 2, 3, 1).reshape(-1, batch.shape[1])
+        else:
+            yield batch.reshape(len(batch), -1)
+
+def _flip_signs(components:torch.Tensor) -> torch.Tensor:
+    # deterministic signs: the largest coefficient (in absolute value) of each component is positive
+    signs = torch.sign(components.gather(1, components.abs().argmax(1, keepdim=True)))
+    return components * signs
+
+class PCA(torch.nn.Module):
+    '''
+    A fitted linear projection onto the principal components, usable as a module in front of a downstream model.
+    Inputs of shape (N, D) are projected to (N, num_components); feature maps of shape (N, C, H, W) are projected per spatial position if the
+    components have dimension C (a 1x1 convolution, keeping the spatial layout expected by the OpenGAN discriminator), otherwise flattened.
+    '''
+    def __init__(self, num_components:int, dim:int, whiten:bool=False):
+        super().__init__()
+        self.register_buffer("whiten", torch.tensor(whiten))
+        self.register_buffer("mean", torch.zeros(dim, dtype=torch.float64))
+        self.register_buffer("components", torch.zeros(num_components, dim, dtype=torch.float64))
+        self.register_buffer("explained_variance", torch.zeros(num_components, dtype=torch.float64))
+        self.register_buffer("num_samples", torch.zeros((), dtype=torch.long))
+
+    def _projection(self, dtype:torch.dtype) -> Tuple[torch.Tensor, torch.Tensor]:
+        components = self.components
+        if self.whiten:
+            components = components / self.explained_variance.clamp(min=1e-12).sqrt().unsqueeze(1)
+        return components.to(dtype), (components @ self.mean).to(dtype)
+
+    def forward(self, X:torch.Tensor) -> torch.Tensor:
+        components, offset = self._projection(X.dtype if X.is_floating_point() else torch.float32)
+        if X.dim() == 4 and X.shape[1] == components.shape[1]:
+            return torch.einsum("kc,nchw->nkhw", components, X) - offset.view(1, -1, 1, 1)
+        return X.reshape(len(X), -1) @ components.T - offset
+
+    def inverse_transform(self, Y:torch.Tensor) -> torch.Tensor:
+        '''
+        Maps projected (N, num_components) inputs back to the original (flattened) space.
+        '''
+        components = self.components
+        if self.whiten:
+            components = components * self.explained_variance.sqrt().unsqueeze(1)
+        return (Y.double() @ components + self.mean).to(Y.dtype)
+
+    def explained_variance_ratio(self, total_variance:float) -> torch.Tensor:
+        return self.explained_variance / total_variance
+
+class IncrementalPCA(PCA):
+    '''
+    PCA fitted batch by batch (Ross et al., 2008): the current components, scaled by their singular values, are stacked with each new centered
+    batch and a mean correction, and a thin SVD of this (num_components + batch_size + 1) x D matrix gives the updated components.
+    The memory is O((num_components + batch_size) x D), independently of the number of samples.
+    '''
+    def __init__(self, num_components:int, dim:int, whiten:bool=False):
+        super().__init__(num_components, dim, whiten)
+        self.register_buffer("singular_values", torch.zeros(num_components, dtype=torch.float64))
+
+    def partial_fit(self, X:torch.Tensor) -> "IncrementalPCA":
+        X = X.double().reshape(len(X), -1)
+        num_seen, num_batch = self.num_samples.item(), len(X)
+        num_total = num_seen + num_batch
+        batch_mean = X.mean(0)
+        if num_seen == 0:
+            assert num_batch >= len(self.components), f"The first batch must contain at least {len(self.components)} samples, got {num_batch}."
+            stacked = X - batch_mean
+        else:
+            mean_correction = np.sqrt(num_seen * num_batch / num_total) * (self.mean - batch_mean)
+            stacked = torch.cat([self.singular_values.unsqueeze(1) * self.components, X - batch_mean, mean_correction.unsqueeze(0)])
+        _, S, Vt = torch.linalg.svd(stacked, full_matrices=False)
+        num_components = len(self.components)
+        self.components.copy_(_flip_signs(Vt[:num_components]))
+        self.singular_values.copy_(S[:num_components])
+        self.explained_variance.copy_(S[:num_components]**2 / max(num_total - 1, 1))
+        self.mean.copy_((num_seen * self.mean + num_batch * batch_mean) / num_total)
+        self.num_samples.fill_(num_total)
+        return self
+
+def randomized_svd(X:torch.Tensor, rank:int, num_oversamples:int=10, num_power_iters:int=2, seed:int=0) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    '''
+    Truncated SVD of an in-memory matrix (Halko et al., 2011): the range of X is captured by multiplying it with a random Gaussian matrix of
+    rank + num_oversamples columns (refined by num_power_iters power iterations), and the SVD is computed on the projection onto that range.
+    The cost is O(N x D x (rank + num_oversamples)) instead of O(min(N, D)^2 x max(N, D)).
+
+    Returns
+    -------
+    a tuple (U, S, Vt) with U of shape (N, rank), S of shape (rank), Vt of shape (rank, D).
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    num_columns = min(rank + num_oversamples, *X.shape)
+    Q = torch.linalg.qr(X @ torch.randn(X.shape[1], num_columns, generator=generator, dtype=X.dtype)).Q
+    for _ in range(num_power_iters):
+        Q = torch.linalg.qr(X.T @ Q).Q
+        Q = torch.linalg.qr(X @ Q).Q
+    U, S, Vt = torch.linalg.svd(Q.T @ X, full_matrices=False)
+    return (Q @ U)[:, :rank], S[:rank], Vt[:rank]
+
+def randomized_pca(features:Features, num_components:int, batch_size:int=1024, num_oversamples:int=10, num_power_iters:int=2, per_position:bool=False, whiten:bool=False, seed:int=0) -> PCA:
+    '''
+    Randomized PCA over streamed features: randomized subspace iteration on the covariance matrix, whose product with the D x (num_components +
+    num_oversamples) basis is accumulated batch by batch, so that neither the covariance (D x D) nor the N x D features are ever in memory.
+    It takes num_power_iters + 3 passes over the features (mean, range, power iterations, projected covariance).
+
+    Parameters
+    ----------
+    features: see iter_batches.
+    num_components: the number of principal components.
+    batch_size: the number of items per batch.
+    num_oversamples: the number of additional random directions, which improve the accuracy of the last components.
+    num_power_iters: the number of power iterations, which improve the accuracy when the spectrum decays slowly.
+    per_position: see iter_batches.
+    whiten: whether the projection scales the components to unit variance.
+    seed: the seed of the random basis.
+    '''
+    num_samples, total = 0, None
+    for batch in iter_batches(features, batch_size, per_position):
+        total = batch.sum(0) if total is None else total + batch.sum(0)
+        num_samples += len(batch)
+    mean = total / num_samples
+    dim = len(mean)
+    num_columns = min(num_components + num_oversamples, dim)
+
+    def covariance_product(Q:torch.Tensor) -> torch.Tensor:
+        # (X - mean)^T (X - mean) Q, one batch at a time
+        product = torch.zeros(dim, Q.shape[1], dtype=torch.float64)
+        for batch in iter_batches(features, batch_size, per_position):
+            centered = batch - mean
+            product += centered.T @ (centered @ Q)
+        return product
+
+    generator = torch.Generator().manual_seed(seed)
+    Q = torch.linalg.qr(covariance_product(torch.randn(dim, num_columns, generator=generator, dtype=torch.float64))).Q
+    for _ in range(num_power_iters):
+        Q = torch.linalg.qr(covariance_product(Q)).Q
+    eigenvalues, eigenvectors = torch.linalg.eigh(Q.T @ covariance_product(Q))
+    order = eigenvalues.argsort(descending=True)[:num_components]
+    pca = PCA(num_components, dim, whiten)
+    pca.mean.copy_(mean)
+    pca.components.copy_(_flip_signs((Q @ eigenvectors[:, order]).T))
+    pca.explained_variance.copy_(eigenvalues[order].clamp(min=0) / max(num_samples - 1, 1))
+    pca.num_samples.fill_(num_samples)
+    return pca
+
+def incremental_pca(features:Features, num_components:int, batch_size:int=1024, per_position:bool=False, whiten:bool=False) -> IncrementalPCA:
+    '''
+    Incremental PCA over streamed features, in a single pass (see IncrementalPCA and iter_batches).
+    '''
+    pca = None
+    for batch in iter_batches(features, batch_size, per_position):
+        if pca is None:
+            pca = IncrementalPCA(num_components, batch.shape[1], whiten)
+        pca.partial_fit(batch)
+    return pca
+
+def total_variance(features:Features, batch_size:int=1024, per_position:bool=False) -> float:
+    '''
+    Returns the total variance (trace of the covariance) of the features in one streaming pass, to compute the explained variance ratios.
+    '''
+    num_samples, sums, sums_of_squares = 0, 0.0, 0.0
+    for batch in iter_batches(features, batch_size, per_position):
+        num_samples += len(batch)
+        sums = sums + batch.sum(0)
+        sums_of_squares = sums_of_squares + (batch**2).sum(0)
+    return ((sums_of_squares - sums**2 / num_samples).sum() / max(num_samples - 1, 1)).item()
+
+def transform(pca:PCA, features:Features, batch_size:int=1024, out:np.ndarray=None) -> Features:
+    '''
+    Projects the features batch by batch. If out is given (e.g., an .npy file opened with np.lib.format.open_memmap), the projections are
+    written there; otherwise they are returned as a tensor.
+    '''
+    projected = []
+    with torch.no_grad():
+        for start in range(0, len(features), batch_size):
+            batch = pca(torch.from_numpy(np.array(features[start:start+batch_size])).float())
+            if out is not None:
+                out[start:start+len(batch)] = batch.numpy()
+            else:
+                projected.append(batch)
+    return out if out is not None else torch.cat(projected)
+
+def load_pca(path:str) -> PCA:
+    '''
+    Loads a PCA (or IncrementalPCA) saved with torch.save(pca.state_dict(), path).
+    '''
+    state_dict = torch.load(path, map_location="cpu")
+    num_components, dim = state_dict["components"].shape
+    pca = IncrementalPCA(num_components, dim) if "singular_values" in state_dict else PCA(num_components, dim)
+    pca.load_state_dict(state_dict)
+    return pca
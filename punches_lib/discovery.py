@@ -0,0 +1,131 @@
+import os
+from typing import Dict, Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+
+from . import search
+from .calibration import ClassThresholds
+from .score_cache import ScoreCache
+from .storage import ScoreStore
+
+def rejected_crops(store:ScoreStore, split:str, threshold:float, column:str="outlier_score", model:str=None, thresholds:ClassThresholds=None) -> Dict[str, np.ndarray]:
+    '''
+    Returns the crops of a split of the score store flagged as OOD: those with an II-loss outlier score at least threshold ("outlier_score") or
+    with an OpenGAN discriminator output below threshold ("disc_score"). If a crop was scored more than once, its most recent score is used.
+    If per-class thresholds are passed (II-loss outlier scores only), they replace threshold, applied to the predictions of the store.
+
+    Returns
+    -------
+    a dict with keys "path" and "score", numpy arrays in the order of the store.
+    '''
+    assert column in ("outlier_score", "disc_score"), f"Unknown score column {column}"
+    assert thresholds is None or column == "outlier_score", "Per-class thresholds are calibrated on II-loss outlier scores"
+    conditions = {"split": split} if model is None else {"split": split, "model": model}
+    selected = store.take(store.latest(store.where(**conditions)), ["path", column] if thresholds is None else ["path", column, "pred"])
+    paths, scores = selected["path"], selected[column]
+    if thresholds is not None:
+        rejected = ~thresholds(torch.from_numpy(scores), torch.from_numpy(selected["pred"])).numpy()
+    else:
+        rejected = scores >= threshold if column == "outlier_score" else scores < threshold
+    return {"path": paths[rejected], "score": scores[rejected]}
+
+def iter_chunks(embeddings:np.ndarray, rows:np.ndarray, chunk_size:int) -> Iterator[Tuple[int, torch.Tensor]]:
+    '''
+    Yields (offset, chunk) pairs, where chunk holds the embeddings (e.g., a memory-mapped column of a ScoreCache) at rows[offset:offset+chunk_size].
+    Only one chunk is in memory at a time; the rows of each chunk are read in increasing order, which is sequential on disk.
+    '''
+    for offset in range(0, len(rows), chunk_size):
+        chunk_rows = rows[offset:offset+chunk_size]
+        order = np.argsort(chunk_rows, kind="stable")
+        chunk = np.empty((len(chunk_rows),) + embeddings.shape[1:], dtype=np.float32)
+        chunk[order] = embeddings[chunk_rows[order]]
+        yield offset, torch.from_numpy(chunk)
+
+def fit_clusters(embeddings:np.ndarray, rows:np.ndarray, num_clusters:int, chunk_size:int=65536, num_epochs:int=1, seed:int=0) -> search.MiniBatchKMeans:
+    '''
+    Clusters the embeddings at the given rows with mini-batch k-means, streaming over chunks of chunk_size rows, in an order shuffled once
+    per epoch.
+    '''
+    rng = np.random.default_rng(seed)
+    kmeans = search.MiniBatchKMeans(num_clusters, seed)
+    for epoch in range(num_epochs):
+        for _, chunk in iter_chunks(embeddings, rows[rng.permutation(len(rows))], chunk_size):
+            kmeans.partial_fit(chunk)
+    return kmeans
+
+def assign_clusters(embeddings:np.ndarray, rows:np.ndarray, kmeans:search.MiniBatchKMeans, num_exemplars:int=10, chunk_size:int=65536) -> Dict[str, np.ndarray]:
+    '''
+    Assigns the embeddings at the given rows to their closest cluster, streaming over chunks, and retains the num_exemplars embeddings closest
+    to each prototype.
+
+    Returns
+    -------
+    a dict with keys "cluster" and "distance" (squared distance to the prototype), one entry per row, and "exemplars", an array of shape
+    (num_clusters, num_exemplars) with the positions in rows of the exemplars of each cluster (sorted by increasing distance, -1 if the cluster
+    has fewer members).
+    '''
+    num_clusters = len(kmeans.centers)
+    clusters = np.empty(len(rows), dtype=np.int64)
+    distances = np.empty(len(rows), dtype=np.float32)
+    best_distances = torch.full((num_clusters, num_exemplars), float("inf"))
+    best_positions = torch.full((num_clusters, num_exemplars), -1, dtype=torch.long)
+    for offset, chunk in iter_chunks(embeddings, rows, chunk_size):
+        chunk_clusters, chunk_distances = kmeans.predict(chunk)
+        clusters[offset:offset+len(chunk)] = chunk_clusters.numpy()
+        distances[offset:offset+len(chunk)] = chunk_distances.numpy()
+        # running top-k per cluster: the num_exemplars closest members of each cluster within the chunk are merged with the best so far
+        order = np.lexsort((chunk_distances.numpy(), chunk_clusters.numpy()))
+        sorted_clusters = chunk_clusters[order]
+        ranks = torch.arange(len(chunk)) - torch.searchsorted(sorted_clusters, sorted_clusters)
+        keep = torch.from_numpy(order)[ranks < num_exemplars]
+        candidates = torch.full((num_clusters, num_exemplars), float("inf"))
+        candidate_positions = torch.full((num_clusters, num_exemplars), -1, dtype=torch.long)
+        candidates[chunk_clusters[keep], ranks[ranks < num_exemplars]] = chunk_distances[keep]
+        candidate_positions[chunk_clusters[keep], ranks[ranks < num_exemplars]] = keep + offset
+        best_distances, merged = torch.cat([best_distances, candidates], 1).topk(num_exemplars, dim=1, largest=False)
+        best_positions = torch.cat([best_positions, candidate_positions], 1).gather(1, merged)
+    best_positions[torch.isinf(best_distances)] = -1
+    return {"cluster": clusters, "distance": distances, "exemplars": best_positions.numpy()}
+
+def write_report(out_dir:str, kmeans:search.MiniBatchKMeans, paths:np.ndarray, scores:np.ndarray, assignments:Dict[str, np.ndarray], traindata_means:torch.Tensor=None, class_names:list=None):
+    '''
+    Writes the result of the clustering for expert review in out_dir:
+    prototypes.npy (the cluster centers), clusters.csv (one row per cluster, sorted by decreasing size), exemplars.csv (the exemplars of each
+    cluster, closest to the prototype first) and assignments.csv (the cluster of every rejected crop).
+    If the mean embeddings of the known classes are given, clusters.csv also reports the closest known class of each prototype and its
+    squared distance, as clusters far from all known classes are the best candidates for new punch types.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, "prototypes.npy"), kmeans.centers.numpy())
+    num_clusters = len(kmeans.centers)
+    sizes = np.bincount(assignments["cluster"], minlength=num_clusters)
+    summary = pd.DataFrame({
+        "cluster": np.arange(num_clusters),
+        "size": sizes,
+        "mean_distance": np.bincount(assignments["cluster"], weights=assignments["distance"], minlength=num_clusters) / np.maximum(sizes, 1),
+        "mean_score": np.bincount(assignments["cluster"], weights=scores, minlength=num_clusters) / np.maximum(sizes, 1),
+    })
+    if traindata_means is not None:
+        closest, distances = search.ExactIndex(traindata_means).classify(kmeans.centers)
+        summary["closest_known_class"] = [class_names[c] if class_names is not None else int(c) for c in closest]
+        summary["distance_to_known_class"] = distances.numpy()
+    summary = summary[summary["size"] > 0].sort_values("size", ascending=False)
+    summary.to_csv(os.path.join(out_dir, "clusters.csv"), index=False)
+
+    exemplars = []
+    for cluster in summary["cluster"]:
+        for rank, position in enumerate(assignments["exemplars"][cluster]):
+            if position >= 0:
+                exemplars.append({"cluster": cluster, "rank": rank, "path": paths[position], "distance": assignments["distance"][position], "score": scores[position]})
+    pd.DataFrame(exemplars).to_csv(os.path.join(out_dir, "exemplars.csv"), index=False)
+    pd.DataFrame({"path": paths, "cluster": assignments["cluster"], "distance": assignments["distance"], "score": scores}).to_csv(os.path.join(out_dir, "assignments.csv"), index=False)
+
+def cached_embeddings(cache:ScoreCache, paths:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Returns the memory-mapped "embeddings" column of a ScoreCache (filled by ii_outscores.py or ii_test.py with --score_cache) and the rows
+    of the given paths in it (-1 for the paths not cached).
+    '''
+    assert cache.store is not None and "embeddings" in cache.store.columns, f"No embeddings cached in {cache.root}: the fingerprint must be the one of an II-loss model run by ii_outscores.py or ii_test.py with --score_cache"
+    return cache.store.column("embeddings"), cache.lookup_paths(paths)
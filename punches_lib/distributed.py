@@ -0,0 +1,110 @@
+import os
+from typing import Callable, Tuple
+
+import torch
+import torch.distributed as dist
+import torch.distributed.nn
+import torch.multiprocessing as mp
+
+def is_distributed() -> bool:
+    '''
+    Returns True if the current process belongs to an initialized process group.
+    '''
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process() -> bool:
+    '''
+    Returns True for the process of rank 0, or if not running distributed. Use it to guard printing and checkpointing.
+    '''
+    return get_rank() == 0
+
+def setup(rank:int, world_size:int, backend:str="gloo", master_addr:str="127.0.0.1", master_port:int=29500, num_threads:int=None):
+    '''
+    Initializes the process group for the current process.
+
+    Parameters
+    ----------
+    rank: the rank of the current process.
+    world_size: the total number of processes.
+    backend: the torch.distributed backend ("gloo" for CPU, "nccl" for GPUs).
+    master_addr, master_port: the address of the process of rank 0.
+    num_threads: the number of intra-op threads of the current process. If None, the cores are split evenly among the local processes.
+    '''
+    os.environ["MASTER_ADDR"] = master_addr
+    os.environ["MASTER_PORT"] = str(master_port)
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // world_size)
+    torch.set_num_threads(num_threads)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def launch(fn:Callable, world_size:int, *args):
+    '''
+    Runs fn(rank, world_size, *args) in world_size local processes and waits for all of them to complete.
+    fn is expected to call setup at the beginning and cleanup at the end.
+    '''
+    mp.spawn(fn, args=(world_size, *args), nprocs=world_size, join=True)
+
+def get_dataloader(dataset:torch.utils.data.Dataset, batch_size:int=32, num_workers:int=4, shuffle:bool=True, seed:int=0) -> torch.utils.data.DataLoader:
+    '''
+    Returns a dataloader yielding the shard of the dataset of the current process, as partitioned by a torch.utils.data.DistributedSampler.
+    batch_size is per process. Call set_sampler_epoch at the beginning of each epoch to reshuffle the shards.
+    '''
+    sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, sampler=sampler)
+
+def set_sampler_epoch(dataloader:torch.utils.data.DataLoader, epoch:int):
+    '''
+    Sets the epoch of the sampler or batch sampler of a dataloader if it supports it (e.g., DistributedSampler, samplers.ClassBalancedBatchSampler),
+    so that each epoch uses a different shuffling.
+    '''
+    for sampler in (dataloader.sampler, dataloader.batch_sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+
+def wrap_model(model:torch.nn.Module, find_unused_parameters:bool=False) -> torch.nn.Module:
+    '''
+    Wraps a model in DistributedDataParallel (gradients are all-reduced during the backward pass) if running distributed.
+    Set find_unused_parameters if some params do not contribute to the loss at some steps (e.g., the classification head with alternate_backprop in ii_loss.train).
+    '''
+    if is_distributed():
+        return torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=find_unused_parameters)
+    return model
+
+def unwrap_model(model:torch.nn.Module) -> torch.nn.Module:
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+def save_on_main(model:torch.nn.Module, path:str):
+    '''
+    Saves the state_dict of a (possibly wrapped) model from the process of rank 0 only, then waits for all processes.
+    '''
+    if is_main_process():
+        torch.save(unwrap_model(model).state_dict(), path)
+        print(f"Model saved to {path}")
+    if is_distributed():
+        dist.barrier()
+
+def all_reduce_bucket_mean(embeddings:torch.Tensor, labels:torch.Tensor, num_classes:int) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Same as utils.bucket_mean, but the per-class sums and counts are summed over all processes, so that the means are those of the global mini-batch.
+    The reduction is differentiable: the gradients flow back to the embeddings of every process.
+
+    Returns
+    -------
+    a tensor of shape (num_classes x embedding_dim) with the means (NaN for classes missing from all processes) and a tensor of shape (num_classes) with the counts.
+    '''
+    tot = torch.zeros(num_classes, embeddings.shape[1], device=embeddings.device, dtype=embeddings.dtype).index_add(0, labels, embeddings)
+    count = torch.zeros(num_classes, device=embeddings.device, dtype=embeddings.dtype).index_add(0, labels, torch.ones_like(labels, dtype=embeddings.dtype))
+    if is_distributed():
+        tot = torch.distributed.nn.functional.all_reduce(tot)
+        dist.all_reduce(count)
+    return tot / count.unsqueeze(1), count
@@ -67,21 +67,38 @@ class Generator(nn.Module):
 
 
 
+def funnel_kernel_sizes(spatial_size=8):
+    '''
+    Returns the kernel sizes of the four convolutions of DiscriminatorFunnel which reduce a spatial_size x spatial_size input to 1 x 1
+    (3, 3, 3, 2 for the 8 x 8 layer4 maps, 3, 2, 1, 1 for maps pooled to 4 x 4).
+    '''
+    assert 1 <= spatial_size <= 8, f"DiscriminatorFunnel supports inputs up to 8 x 8, got {spatial_size} x {spatial_size}"
+    kernel_sizes = []
+    remaining = spatial_size - 1
+    for max_reduction in (2, 2, 2, 1):
+        reduction = min(max_reduction, remaining)
+        kernel_sizes.append(reduction + 1)
+        remaining -= reduction
+    return kernel_sizes
+
+
 class DiscriminatorFunnel(nn.Module):
-    def __init__(self, nc=512, ndf=64):
+    def __init__(self, nc=512, ndf=64, spatial_size=8):
         super(DiscriminatorFunnel, self).__init__()
         self.nc = nc
         self.ndf = ndf
+        self.spatial_size = spatial_size
+        k1, k2, k3, k4 = funnel_kernel_sizes(spatial_size)
         self.main = nn.Sequential(
-            nn.Conv2d(self.nc, self.ndf*8, 3, 1, 0, bias=False),
+            nn.Conv2d(self.nc, self.ndf*8, k1, 1, 0, bias=False),
             nn.LeakyReLU(0.2, inplace=True),
-            nn.Conv2d(self.ndf*8, self.ndf*4, 3, 1, 0, bias=False),
+            nn.Conv2d(self.ndf*8, self.ndf*4, k2, 1, 0, bias=False),
             nn.BatchNorm2d(self.ndf*4),
             nn.LeakyReLU(0.2, inplace=True),
-            nn.Conv2d(self.ndf*4, self.ndf*2, 3, 1, 0, bias=False),
+            nn.Conv2d(self.ndf*4, self.ndf*2, k3, 1, 0, bias=False),
             nn.BatchNorm2d(self.ndf*2),
             nn.LeakyReLU(0.2, inplace=True),
-            nn.Conv2d(self.ndf*2, self.ndf, 2, 1, 0, bias=False),
+            nn.Conv2d(self.ndf*2, self.ndf, k4, 1, 0, bias=False),
             nn.BatchNorm2d(self.ndf),
             nn.LeakyReLU(0.2, inplace=True),
             nn.Conv2d(self.ndf, 1, 1, 1, 0, bias=False),
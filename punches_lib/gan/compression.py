@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .. import decomposition
+
+
+class FeatureCompressor(nn.Module):
+    '''
+    Compresses the layer4 feature maps of the backbone for training and evaluating the OpenGAN in a reduced space: average pooling to
+    spatial_size x spatial_size, then a 1x1 linear projection of the channels (weight, bias), and optionally float16 storage.
+    Pooling and projection are both linear, so they commute: pooling first makes the projection cheaper.
+    '''
+    def __init__(self, weight=None, bias=None, spatial_size=8, half=False):
+        '''
+        Parameters:
+        -----------
+        weight: the (num_channels x C) projection of the channels, or None to keep the C channels.
+        bias: the (num_channels) offset added after the projection, or None.
+        spatial_size: the spatial size of the compressed maps.
+        half: whether the compressed features are stored in float16 (see compress).
+        '''
+        super(FeatureCompressor, self).__init__()
+        self.spatial_size = spatial_size
+        self.half = half
+        self.register_buffer("weight", None if weight is None else torch.as_tensor(weight).float())
+        self.register_buffer("bias", None if bias is None else torch.as_tensor(bias).float())
+
+    def num_channels(self, input_channels=512):
+        '''
+        Returns the number of channels of the compressed maps, i.e. the nc of the Generator and DiscriminatorFunnel trained on them.
+        '''
+        return input_channels if self.weight is None else self.weight.shape[0]
+
+    def forward(self, features):
+        features = features.float()
+        if features.shape[-1] != self.spatial_size:
+            features = nn.functional.adaptive_avg_pool2d(features, self.spatial_size)
+        if self.weight is not None:
+            features = torch.einsum("kc,nchw->nkhw", self.weight, features)
+            if self.bias is not None:
+                features = features + self.bias.view(1, -1, 1, 1)
+        return features
+
+    def compress(self, features, batch_size=256):
+        '''
+        Compresses features (a tensor or a, possibly memory-mapped, array of shape N x C x H x W) batch by batch.
+
+        Returns:
+        -----------
+        a tensor of shape N x num_channels x spatial_size x spatial_size, in float16 if half, float32 otherwise.
+        '''
+        dtype = torch.float16 if self.half else torch.float32
+        compressed = []
+        with torch.no_grad():
+            for start in range(0, len(features), batch_size):
+                batch = torch.as_tensor(np.array(features[start:start+batch_size]))
+                compressed.append(self(batch.to(self.weight.device if self.weight is not None else "cpu")).to(dtype).cpu())
+        return torch.cat(compressed)
+
+    def state(self):
+        '''
+        Returns the arguments to rebuild the compressor, FeatureCompressor(**compressor.state()).
+        '''
+        return {"weight": self.weight, "bias": self.bias, "spatial_size": self.spatial_size, "half": self.half}
+
+
+def fit_compressor(features, num_channels=None, projection="pca", spatial_size=8, half=False, batch_size=256, seed=0):
+    '''
+    Fits a FeatureCompressor once on the training features.
+
+    Parameters:
+    -----------
+    features: the training features, a tensor or a (possibly memory-mapped) array of shape N x C x H x W.
+    num_channels: the number of channels after the projection. If None, the channels are not projected.
+    projection: "pca", the principal components of the channels at every (pooled) spatial position, fitted incrementally
+        (see decomposition.IncrementalPCA), or "random", a random orthonormal 1x1 projection which does not depend on the data.
+    spatial_size: the spatial size of the compressed maps (8 keeps the 8 x 8 layer4 maps, 4 pools them to 4 x 4).
+    half: whether the compressed features are stored in float16.
+    batch_size: the number of feature maps read at once.
+    seed: the seed of the random projection.
+    '''
+    assert projection in ("pca", "random"), f"Unknown projection {projection}"
+    input_channels = features.shape[1]
+    if num_channels is None or num_channels == input_channels:
+        return FeatureCompressor(spatial_size=spatial_size, half=half)
+    if projection == "random":
+        generator = torch.Generator().manual_seed(seed)
+        basis = torch.linalg.qr(torch.randn(input_channels, num_channels, generator=generator)).Q
+        return FeatureCompressor(basis.T, None, spatial_size, half)
+    pooling = FeatureCompressor(spatial_size=spatial_size)
+    pca = decomposition.IncrementalPCA(num_channels, input_channels)
+    with torch.no_grad():
+        for start in range(0, len(features), batch_size):
+            pooled = pooling(torch.as_tensor(np.array(features[start:start+batch_size])))
+            pca.partial_fit(pooled.permute(0, 2, 3, 1).reshape(-1, input_channels))
+    return FeatureCompressor(pca.components, -(pca.components @ pca.mean), spatial_size, half)
+
+
+def load_compressor(compressor_path):
+    '''
+    Loads the compressor saved at compressor_path (e.g., by main_gan.py with --compressor_path).
+    '''
+    return FeatureCompressor(**torch.load(compressor_path, map_location="cpu"))
+
+def load_or_fit_compressor(compressor_path, features, num_channels=None, projection="pca", spatial_size=8, half=False, batch_size=256):
+    '''
+    Loads the compressor saved at compressor_path if it exists, otherwise fits it on the (training) features and saves it there
+    (if compressor_path is not None).
+    '''
+    if compressor_path is not None and os.path.exists(compressor_path):
+        return load_compressor(compressor_path)
+    compressor = fit_compressor(features, num_channels, projection, spatial_size, half, batch_size)
+    if compressor_path is not None:
+        torch.save(compressor.state(), compressor_path)
+    return compressor
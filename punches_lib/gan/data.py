@@ -7,6 +7,9 @@ from skimage import transform
 from torch.utils.data import Dataset, DataLoader
 
 
+from .. import inference, parallel
+
+
 def load_pretrained_backbone(network_backbone, weights_location, device="cuda:0",
                              final_layer_weights: str = "fc.weight"):
     '''
@@ -93,7 +96,17 @@ class FeatDataset(Dataset):
         return curdata
 
 
-def get_hidden_features(dataloader, device, backbone=None):
+def compute_layer4_features(backbone, X):
+    features = []
+    handle = backbone.layer4.register_forward_hook(lambda module, input_, output: features.append(output))
+    _ = backbone(X)
+    handle.remove()
+    return {"features": features[0]}
+
+def get_hidden_features(dataloader, device, backbone=None, num_procs=1):
+    if num_procs != 1:
+        # sharded across CPU processes, see parallel.run_sharded (num_procs=0 chooses the split automatically)
+        return parallel.run_sharded(backbone, dataloader.dataset, compute_layer4_features, batch_size=dataloader.batch_size, num_procs=num_procs or None)["features"], backbone
     features = []
     def get_features(module, input_, output):
         features.append(output.cpu().detach())
@@ -104,10 +117,11 @@ def get_hidden_features(dataloader, device, backbone=None):
         for i, (data, _) in enumerate(dataloader):
             print(f"Done {i+1}/{len(dataloader)}")
             _ = backbone(data.to(device))
+    handle.remove()
 
     return torch.cat(features, dim=0), backbone
 
-def create_backbone(name_modelpth, model, device):
+def create_backbone(name_modelpth, model, device, optimize=False):
     backbone_weights = torch.load(name_modelpth, map_location='cpu')
     backbone_weights.keys()
     backbone_weights["fc.weight"].shape
@@ -116,6 +130,9 @@ def create_backbone(name_modelpth, model, device):
     backbone = backbone_class(num_classes=backbone_weights["fc.weight"].shape[0])
     backbone.load_state_dict(backbone_weights)
     backbone = backbone.to(device).eval()
+    if optimize:
+        # BatchNorm folded and channels-last: the modules up to layer4 are kept, so the feature hook still works
+        backbone = inference.optimize_for_inference(backbone, mode="eager")
 
     return backbone
 
@@ -0,0 +1,187 @@
+import copy
+import os
+
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+from . import architecture
+
+
+class StackedModules(nn.Module):
+    '''
+    M modules of the same architecture whose parameters and buffers are stacked along a leading dimension, evaluated all at once with
+    torch.func.vmap. Optimizers see one tensor per parameter of the architecture: since Adam (and SGD) act element-wise, stepping the stacked
+    tensors is equivalent to stepping M independent optimizers.
+    '''
+    def __init__(self, modules):
+        super(StackedModules, self).__init__()
+        params, buffers = stack_module_state(modules)
+        self.num_members = len(modules)
+        self.param_names = list(params)
+        self.buffer_names = list(buffers)
+        self.params = nn.ParameterList([nn.Parameter(params[name].detach()) for name in self.param_names])
+        for i, name in enumerate(self.buffer_names):
+            self.register_buffer(f"buffer_{i}", buffers[name])
+        # the architecture without storage, not registered as a submodule
+        self.__dict__["base"] = copy.deepcopy(modules[0]).to("meta")
+
+    def _state(self):
+        params = dict(zip(self.param_names, self.params))
+        buffers = {name: getattr(self, f"buffer_{i}") for i, name in enumerate(self.buffer_names)}
+        return params, buffers
+
+    def forward(self, x, shared_input=True):
+        '''
+        Returns the outputs of the M modules stacked along the first dimension. If shared_input, x is fed to every module; otherwise x has a
+        leading dimension of size M and each module gets its own slice.
+        '''
+        # BatchNorm follows the mode of the stack; its running statistics are updated in the stacked buffers
+        self.base.train(self.training)
+        params, buffers = self._state()
+        call = lambda p, b, inputs: functional_call(self.base, (p, b), (inputs,))
+        return vmap(call, in_dims=(0, 0, None if shared_input else 0))(params, buffers, x)
+
+    def member_state_dict(self, member):
+        '''
+        Returns the state_dict of one member, loadable into the original architecture.
+        '''
+        params, buffers = self._state()
+        return {name: tensor[member].detach().clone() for name, tensor in {**params, **buffers}.items()}
+
+
+class GANEnsemble(nn.Module):
+    '''
+    An ensemble of M Generator/DiscriminatorFunnel pairs with independently seeded initializations, trained simultaneously (see
+    train_ensemble). Called on features, it returns the mean discriminator output of the members with the shape of a single
+    DiscriminatorFunnel (N x 1 x 1 x 1), so that it can replace the discriminator in the evaluation functions.
+    '''
+    def __init__(self, num_members, nz=100, ngf=64, nc=512, ndf=64, spatial_size=8, seed=0):
+        super(GANEnsemble, self).__init__()
+        self.nz = nz
+        self.spatial_size = spatial_size
+        generators, discriminators = [], []
+        for member in range(num_members):
+            torch.manual_seed(seed + member)
+            netG = architecture.Generator(nz=nz, ngf=ngf, nc=nc)
+            netG.apply(architecture.weights_init)
+            netD = architecture.DiscriminatorFunnel(nc=nc, ndf=ndf, spatial_size=spatial_size)
+            netD.apply(architecture.weights_init)
+            generators.append(netG)
+            discriminators.append(netD)
+        self.generators = StackedModules(generators)
+        self.discriminators = StackedModules(discriminators)
+
+    @property
+    def num_members(self):
+        return self.generators.num_members
+
+    def member_outputs(self, features):
+        '''
+        Returns the discriminator outputs of every member, M x N.
+        '''
+        return self.discriminators(features).reshape(self.num_members, len(features))
+
+    def scores(self, features):
+        '''
+        Returns a dict with the mean ("disc_scores") and the variance ("disc_variance") of the discriminator outputs of the members, of shape N.
+        A high variance flags the features on which the members disagree.
+        '''
+        outputs = self.member_outputs(features)
+        return {"disc_scores": outputs.mean(0), "disc_variance": outputs.var(0, unbiased=False)}
+
+    def forward(self, features):
+        return self.member_outputs(features).mean(0).view(-1, 1, 1, 1)
+
+    def member_state_dicts(self):
+        '''
+        Returns, for each member, the state_dicts of its Generator and DiscriminatorFunnel.
+        '''
+        return [(self.generators.member_state_dict(m), self.discriminators.member_state_dict(m)) for m in range(self.num_members)]
+
+
+def is_ensemble_state_dict(state_dict):
+    '''
+    Returns whether a state_dict is the one of a GANEnsemble (e.g., ensemble.pth saved by train_ensemble) rather than of a single discriminator.
+    '''
+    return any(key.startswith("discriminators.") for key in state_dict)
+
+def load_ensemble(state_dict, nc=512, ndf=64, spatial_size=8):
+    '''
+    Rebuilds a GANEnsemble for evaluation from its state_dict (e.g., ensemble.pth saved by train_ensemble). The number of members is read from
+    the state_dict and only the discriminators are loaded, so that the sizes of the generators need not be known.
+    '''
+    num_members = state_dict["discriminators.params.0"].shape[0]
+    ensemble = GANEnsemble(num_members, nc=nc, ndf=ndf, spatial_size=spatial_size)
+    prefix = "discriminators."
+    ensemble.discriminators.load_state_dict({key[len(prefix):]: value for key, value in state_dict.items() if key.startswith(prefix)})
+    return ensemble
+
+
+def train_ensemble(num_epochs, dataloader, ensemble, optimizerG, optimizerD, device, save_dir=None, real_label=1, fake_label=0, label_smoothing_factor=0.15):
+    '''
+    Trains all the members of a GANEnsemble at once, as train.train_model trains one pair: every batch of (cached) features is shared by the
+    members, while the noise and the label smoothing are drawn independently for each member. The losses of the members are summed, so that
+    each member receives the gradients of its own loss.
+
+    Parameters:
+    -----------
+    num_epochs: the number of epochs.
+    dataloader: a DataLoader over the training features (e.g., a data.FeatDataset).
+    ensemble: a GANEnsemble.
+    optimizerG, optimizerD: optimizers over ensemble.generators.parameters() and ensemble.discriminators.parameters().
+    device: the device to use.
+    save_dir: if not None, the state_dict of the ensemble is saved there as ensemble.pth after training.
+    label_smoothing_factor: the maximum amount by which the real and fake labels are smoothed (0 for no smoothing).
+
+    Returns:
+    -----------
+    the lists of the generator and discriminator losses (averaged over the members) of each iteration.
+    '''
+    G_losses = []
+    D_losses = []
+    ensemble.to(device)
+    ensemble.train()
+    num_members = ensemble.num_members
+    bce = nn.functional.binary_cross_entropy
+
+    print(f"Starting Training Loop ({num_members} members)...")
+    for epoch in range(num_epochs):
+        for i, data in enumerate(dataloader, 0):
+            ## (1) Update the discriminators with all-real and all-fake batches
+            ensemble.discriminators.zero_grad()
+            real = data.to(device).float()
+            b_size = real.size(0)
+            label = torch.full((num_members, b_size), real_label, dtype=torch.float, device=device)
+            label -= (torch.rand(num_members, b_size, device=device) * label_smoothing_factor * (1 if real_label == 1 else -1))
+            output = ensemble.discriminators(real).view(num_members, b_size)
+            errD_real = bce(output, label, reduction="none").mean(1).sum()
+            errD_real.backward()
+
+            noise = torch.randn(num_members, b_size, ensemble.nz, ensemble.spatial_size, ensemble.spatial_size, device=device)
+            fake = ensemble.generators(noise, shared_input=False)
+            label.fill_(fake_label)
+            label += (torch.rand(num_members, b_size, device=device) * label_smoothing_factor * (1 if fake_label == 0 else -1))
+            output = ensemble.discriminators(fake.detach(), shared_input=False).view(num_members, b_size)
+            errD_fake = bce(output, label, reduction="none").mean(1).sum()
+            errD_fake.backward()
+            errD = errD_real + errD_fake
+            optimizerD.step()
+
+            ## (2) Update the generators
+            ensemble.generators.zero_grad()
+            label.fill_(real_label)
+            output = ensemble.discriminators(fake, shared_input=False).view(num_members, b_size)
+            errG = bce(output, label, reduction="none").mean(1).sum()
+            errG.backward()
+            optimizerG.step()
+
+            if i % 200 == 0:
+                print('[%d/%d][%d/%d]\tLoss_D: %.4f\tLoss_G: %.4f (mean over members)'
+                      % (epoch, num_epochs, i, len(dataloader), errD.item() / num_members, errG.item() / num_members))
+            G_losses.append(errG.item() / num_members)
+            D_losses.append(errD.item() / num_members)
+
+    if save_dir is not None:
+        torch.save(ensemble.state_dict(), os.path.join(save_dir, "ensemble.pth"))
+    return G_losses, D_losses
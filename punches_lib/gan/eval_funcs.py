@@ -22,6 +22,8 @@ from torchvision import models, transforms
 
 import sklearn.metrics 
 
+from .. import decomposition
+
 def F_measure(preds, labels, openset=False, theta=None):
     if openset:
         # f1 score for openset evaluation
@@ -97,15 +99,16 @@ class CosCentroid(nn.Module):
 def pca(X=np.array([]), no_dims=50):
     """
         Runs PCA on the NxD array X in order to reduce its dimensionality to
-        no_dims dimensions.
+        no_dims dimensions, with a randomized SVD of the centered data
+        (see decomposition.randomized_svd). The components are sorted by
+        decreasing variance.
     """
 
     print("Preprocessing the data using PCA...")
-    (n, d) = X.shape
     m = np.mean(X, 0)
-    X = X - np.tile(m, (n, 1))
-    (l, M) = np.linalg.eig(np.dot(X.T, X))
-    P = M[:, 0:no_dims]
+    X = X - m
+    _, _, Vt = decomposition.randomized_svd(torch.from_numpy(X).double(), no_dims)
+    P = Vt.T.numpy()
     Y = np.dot(X, P)
     return Y, m, P
 
@@ -289,98 +292,3 @@ def plot_xy(x, y, x_axis="X", y_axis="Y", title="Plot"):
     plot.set_ylabel(y_axis)
     plot.set_xlabel(x_axis)
     return plot
-
-
-def backup_Weibull():
-    print("Weibull: computing features for all correctly-classified training data")
-    activation_vectors = {}
-    for images, labels in dataloader_train_closeset:         
-        images = images.to(device)
-        labels = labels.type(torch.long).view(-1).to(device)
-
-        embFeature = encoder(images)
-        logits = clsModel(embFeature)
-        #logits =  F.softmax(logits, dim=1)
-
-        correctly_labeled = (logits.data.max(1)[1] == labels)
-        labels_np = labels.cpu().numpy()
-        logits_np = logits.data.cpu().numpy()
-        for i, label in enumerate(labels_np):
-            if not correctly_labeled[i]:
-                continue
-            if label not in activation_vectors:
-                activation_vectors[label] = []
-            activation_vectors[label].append(logits_np[i])
-
-    print("Computed activation_vectors for {} known classes".format(len(activation_vectors)))
-    for class_idx in activation_vectors:
-        print("Class {}: {} images".format(class_idx, len(activation_vectors[class_idx])))    
-        
-    # Compute a mean activation vector for each class
-    print("Weibull computing mean activation vectors...")
-    mean_activation_vectors = {}
-    for class_idx in activation_vectors:
-        mean_activation_vectors[class_idx] = np.array(activation_vectors[class_idx]).mean(axis=0)        
-        
-    WEIBULL_TAIL_SIZE = 20
-    # Initialize one libMR Wiebull object for each class
-    print("Fitting Weibull to distance distribution of each class")
-    weibulls = {}
-    for class_idx in activation_vectors:
-        distances = []
-        mav = mean_activation_vectors[class_idx]
-        for v in activation_vectors[class_idx]:
-            distances.append(np.linalg.norm(v - mav))
-        mr = libmr.MR()
-        tail_size = min(len(distances), WEIBULL_TAIL_SIZE)
-        mr.fit_high(distances, tail_size)
-        weibulls[class_idx] = mr
-        print("Weibull params for class {}: {}".format(class_idx, mr.get_params()))
-        
-        
-    # Apply Weibull score to every logit
-    weibull_scores_closeset = []
-    logits_closeset = []
-    classes = activation_vectors.keys()
-    for images, labels in dataloader_test_closeset:
-        images = images.to(device)
-        labels = labels.type(torch.long).view(-1).to(device)    
-        embFeature = encoder(images)
-        batch_logits = clsModel(embFeature).data.cpu().numpy()    
-        batch_weibull = np.zeros(shape=batch_logits.shape)
-        for activation_vector in batch_logits:
-            weibull_row = np.ones(len(classes))
-            for class_idx in classes:
-                mav = mean_activation_vectors[class_idx]
-                dist = np.linalg.norm(activation_vector - mav)
-                weibull_row[class_idx] = 1 - weibulls[class_idx].w_score(dist)
-            weibull_scores_closeset.append(weibull_row)
-            logits_closeset.append(activation_vector)
-
-    weibull_scores_closeset = np.array(weibull_scores_closeset)
-    logits_closeset = np.array(logits_closeset)
-    openmax_scores_closeset = -np.log(np.sum(np.exp(logits_closeset * weibull_scores_closeset), axis=1))        
-        
-
-    # Apply Weibull score to every logit
-    weibull_scores_openset = []
-    logits_openset = []
-    classes = activation_vectors.keys()
-    for images, labels in dataloader_test_openset:
-        images = images.to(device)
-        labels = labels.type(torch.long).view(-1).to(device)    
-        embFeature = encoder(images)
-        batch_logits = clsModel(embFeature).data.cpu().numpy()    
-        batch_weibull = np.zeros(shape=batch_logits.shape)
-        for activation_vector in batch_logits:
-            weibull_row = np.ones(len(classes))
-            for class_idx in classes:
-                mav = mean_activation_vectors[class_idx]
-                dist = np.linalg.norm(activation_vector - mav)
-                weibull_row[class_idx] = 1 - weibulls[class_idx].w_score(dist)
-            weibull_scores_openset.append(weibull_row)
-            logits_openset.append(activation_vector)
-
-    weibull_scores_openset = np.array(weibull_scores_openset)
-    logits_openset = np.array(logits_openset)
-    openmax_scores_openset = -np.log(np.sum(np.exp(logits_openset * weibull_scores_openset), axis=1))
\ No newline at end of file
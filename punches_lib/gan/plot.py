@@ -30,4 +30,16 @@ def plot_hist(outputs_open, outputs_close, modelFlag, label_hist_open="punzoni e
     plt.legend(loc='upper right')
     plt.title('Overlapping')
     plt.savefig('hist_{}.png'.format(modelFlag), bbox_inches='tight',transparent=True)
-    plt.close()
\ No newline at end of file
+    plt.close()
+
+def plot_hist_outputs(outputs, save_path, title='Discriminator outputs'):
+    '''
+    Plots the overlapping histograms of the discriminator outputs of several datasets, passed as a dict {label: outputs}; None outputs are skipped.
+    '''
+    for label, values in outputs.items():
+        if values is not None:
+            plt.hist(values, label=label, density=True, alpha=0.5)
+    plt.legend(loc='upper right')
+    plt.title(title)
+    plt.savefig(save_path, bbox_inches='tight')
+    plt.close()
@@ -1,4 +1,9 @@
+from functools import partial
+
+import pandas as pd
 import torch
+from .. import metrics, parallel, score_cache
+from . import data
 
 def evalutate_data(netD, dataloader, device):
     correct = 0
@@ -6,13 +11,13 @@ def evalutate_data(netD, dataloader, device):
     outputs = []
     with torch.no_grad():
         for data in dataloader:
-            output = netD(data.to(device)).view(-1)
+            output = netD(data.to(device).float()).view(-1)
             outputs += [output.cpu()]
             correct += (output >= .5).sum().item()
 
     return torch.cat(outputs), correct
 
-def test_model(backbone, testloader, netD, device):
+def test_model(backbone, testloader, netD, device, projection=None):
 
     x = next(iter(testloader)).to(device)
     (netD(x).view(-1) >= .5).sum().item() / x.size(0)
@@ -36,6 +41,9 @@ def test_model(backbone, testloader, netD, device):
             _ = backbone(noiseimg)
             feats = features[0].to(device)
             assert feats.shape == (100, 512, 8, 8), f"Features shape is {feats.shape}, expected (100, 512, 8, 8)"
+            if projection is not None:
+                # e.g., the compression.FeatureCompressor the training features were compressed with
+                feats = projection.to(device)(feats)
             output = netD(feats).view(-1)
             outputs_open.append(output.cpu())
             correct_fake += (output < .5).sum().item()
@@ -44,3 +52,112 @@ def test_model(backbone, testloader, netD, device):
     print("Correctly identified fakes:", correct_fake/1000)
 
     return outputs_open, outputs_close
+
+def discriminator_scores(netD, feats, projection=None):
+    '''
+    Returns the dict of the discriminator outputs ("disc_scores") for a batch of layer4 features, compressed with projection if not None.
+    For a GANEnsemble, the outputs are the mean over its members and the dict also holds their variance ("disc_variance").
+    '''
+    if projection is not None:
+        feats = projection(feats)
+    if hasattr(netD, "scores"):
+        return netD.scores(feats.float())
+    return {"disc_scores": netD(feats.float()).view(-1)}
+
+def compute_discriminator_outputs(models, X, rescale_factor=1.0):
+    backbone, netD, *projection = models
+    feats = data.compute_layer4_features(backbone, X)["features"]
+    if rescale_factor != 1.0:
+        feats = torch.nn.functional.interpolate(feats, scale_factor=rescale_factor, mode='bilinear')
+    return discriminator_scores(netD, feats, projection[0] if len(projection) > 0 else None)
+
+def get_discriminator_outputs(dataloader, backbone, netD, device, rescale_factor=1.0, cache=None, num_procs=1, projection=None):
+    '''
+    Computes the discriminator outputs for the images of a dataloader, passing them through the layer4 of the backbone first.
+    The discriminator is used in eval mode, so that the output for an image does not depend on the rest of the batch.
+
+    Parameters:
+    -----------
+    dataloader: a torch.utils.data.DataLoader of (image, label) pairs
+    backbone: the torchvision ResNet used for obtaining the features
+    netD: the discriminator, or a GANEnsemble
+    device: the device to use
+    rescale_factor: the factor used for interpolating the features before feeding them to the discriminator
+    cache: a score_cache.ScoreCache. If passed and the dataset is an ImageFolder, only the images missing from the cache are evaluated
+    num_procs: if not 1, the images are evaluated on the CPU by num_procs processes (0 to choose automatically), see parallel.run_sharded
+    projection: e.g., the compression.FeatureCompressor the training features of the discriminator were compressed with
+
+    Returns:
+    -----------
+    a dict of torch.Tensors in the order of the dataloader (see discriminator_scores): the discriminator outputs ("disc_scores") and,
+    for a GANEnsemble, their variance across the members ("disc_variance")
+    '''
+    if cache is not None and hasattr(dataloader.dataset, "samples"):
+        compute_fn = lambda loader: get_discriminator_outputs(loader, backbone, netD, device, rescale_factor, num_procs=num_procs, projection=projection)
+        return score_cache.cached_outputs(dataloader, compute_fn, cache)
+    if num_procs != 1:
+        models = torch.nn.ModuleList([backbone, netD] + ([projection] if projection is not None else []))
+        return parallel.run_sharded(models, dataloader.dataset, partial(compute_discriminator_outputs, rescale_factor=rescale_factor), batch_size=dataloader.batch_size, num_procs=num_procs or None)
+
+    features = []
+    handle = backbone.layer4.register_forward_hook(lambda module, input_, output: features.append(output))
+    backbone.to(device).eval()
+    netD.to(device).eval()
+    if projection is not None:
+        projection.to(device)
+    outputs = []
+    with torch.no_grad():
+        for X, _ in dataloader:
+            features.clear()
+            _ = backbone(X.to(device))
+            feats = features[0]
+            if rescale_factor != 1.0:
+                feats = torch.nn.functional.interpolate(feats, scale_factor=rescale_factor, mode='bilinear')
+            outputs.append({name: values.cpu() for name, values in discriminator_scores(netD, feats, projection).items()})
+    handle.remove()
+    return {name: torch.cat([batch[name] for batch in outputs]) for name in outputs[0]}
+
+def get_feature_outputs(netD, features, device, batch_size=128, projection=None):
+    '''
+    Computes the discriminator outputs for precomputed (layer4) features. The discriminator is used in eval mode, as in get_discriminator_outputs.
+
+    Parameters:
+    -----------
+    netD: the discriminator, or a GANEnsemble
+    features: a torch.Tensor of shape (N, C, H, W)
+    device: the device to use
+    batch_size: the number of features evaluated at once
+    projection: e.g., the compression.FeatureCompressor the training features of the discriminator were compressed with
+
+    Returns:
+    -----------
+    a dict of torch.Tensors of shape (N), as get_discriminator_outputs
+    '''
+    netD.to(device).eval()
+    if projection is not None:
+        projection.to(device)
+    outputs = []
+    with torch.no_grad():
+        for batch in torch.split(features, batch_size):
+            outputs.append({name: values.cpu() for name, values in discriminator_scores(netD, batch.to(device), projection).items()})
+    return {name: torch.cat([batch[name] for batch in outputs]) for name in outputs[0]}
+
+def get_performance(outputs_valid, outputs_open, increment=0.05, additional_outputs=None):
+    '''
+    Computes, for thresholds spaced by increment in [0, 1], the fraction of validation (ID) outputs above the threshold, the fraction of open (OOD)
+    outputs below it and their weighted combination W (see metrics.weighted_accuracies). If additional OOD outputs are passed (e.g., crops and
+    random images), also the fraction of all the OOD outputs below the threshold and the corresponding AW.
+
+    Returns:
+    -----------
+    a pandas.DataFrame with one row per threshold
+    '''
+    thresholds = torch.arange(0, 1 + increment / 2, increment)
+    # the discriminator outputs are higher for ID data: negated, they are outlier scores, and so are the thresholds
+    accuracies = metrics.weighted_accuracies(-outputs_valid, -outputs_open, -thresholds)
+    performance = pd.DataFrame({"threshold": thresholds.numpy(), "valid_pct": accuracies["id_pct"].numpy(), "open_pct": accuracies["ood_pct"].numpy(), "W": accuracies["W"].numpy()})
+    if additional_outputs is not None:
+        accuracies = metrics.weighted_accuracies(-outputs_valid, -torch.cat((outputs_open, additional_outputs)), -thresholds)
+        performance["all_pct"] = accuracies["ood_pct"].numpy()
+        performance["AW"] = accuracies["W"].numpy()
+    return performance
@@ -3,8 +3,41 @@ import torchvision.utils as vutils
 import os
 import copy
 
+import pandas as pd
+
+from .. import metrics
+
+def validate(netD, features_valid, features_open, increment=0.05):
+    '''
+    Scores the discriminator on cached validation (ID) and open (OOD) features with a single batched forward pass (BatchNorm in eval mode).
+
+    Returns:
+    -----------
+    a dict with the AUROC, the best weighted sensitivity/specificity W over thresholds spaced by increment in [0, 1] (as in gan_eval.py) and
+    the threshold achieving it.
+    '''
+    was_training = netD.training
+    netD.eval()
+    with torch.no_grad():
+        outputs = netD(torch.cat((features_valid, features_open))).view(-1).cpu()
+    netD.train(was_training)
+    outputs_valid, outputs_open = outputs[:len(features_valid)], outputs[len(features_valid):]
+    # the discriminator outputs are higher for ID data: negate them to get outlier scores
+    thresholds = torch.arange(0, 1 + increment / 2, increment)
+    W, threshold = metrics.best_weighted_accuracy(-outputs_valid, -outputs_open, -thresholds)
+    return {"auroc": metrics.auroc(-outputs_open, -outputs_valid), "W": W, "threshold": -threshold}
+
 # Training Loop
-def train_model(num_epochs, dataloader, netG, netD, real_label, fake_label, optimizerG, optimizerD, nz, fixed_noise, criterion, device, save_dir):
+def train_model(num_epochs, dataloader, netG, netD, real_label, fake_label, optimizerG, optimizerD, nz, fixed_noise, criterion, device, save_dir, spatial_size=8,
+                validation_features=None, validate_every=5, patience=10, monitor="auroc", label_smoothing_factor=0.15):
+    '''
+    Trains the OpenGAN. Without validation_features, it runs num_epochs epochs and saves the params of every epoch after the 850th.
+    With validation_features, a pair (valid, open) of cached feature tensors, the discriminator is validated every validate_every epochs
+    (see validate); training stops when the monitored metric ("auroc" or "W") has not improved for patience validations, the best
+    discriminator (and its generator) are kept in memory, loaded back into netD/netG at the end and saved as best.DNet/best.GNet in save_dir,
+    along with the validation history (validation.csv). The real and fake labels are smoothed by a uniform random amount up to
+    label_smoothing_factor (0 for no smoothing).
+    '''
     # Lists to keep track of progress
     img_list = []
     G_losses = []
@@ -13,7 +46,13 @@ def train_model(num_epochs, dataloader, netG, netD, real_label, fake_label, opti
     netG.to(device)
     netD.to(device)
     fixed_noise.to(device)
-    label_smoothing_factor = 0.15
+    if validation_features is not None:
+        assert monitor in ("auroc", "W"), f"Unknown metric to monitor {monitor}"
+        # cached once on the device, so that each validation is a single forward pass
+        features_valid, features_open = (f.to(device).float() for f in validation_features)
+        history = []
+        best_metric, best_epoch, num_bad_validations = -1.0, None, 0
+        best_wts = None
 
     print("Starting Training Loop...")
     # For each epoch
@@ -26,8 +65,8 @@ def train_model(num_epochs, dataloader, netG, netD, real_label, fake_label, opti
             ###########################
             ## Train with all-real batch
             netD.zero_grad()
-            # Format batch
-            real_cpu = data.to(device)
+            # Format batch (features may be stored in float16, see gan.compression)
+            real_cpu = data.to(device).float()
             b_size = real_cpu.size(0)
             label = torch.full((b_size,), real_label, dtype=torch.float, device=device)
             # labels smoothing
@@ -42,7 +81,7 @@ def train_model(num_epochs, dataloader, netG, netD, real_label, fake_label, opti
 
             ## Train with all-fake batch
             # Generate batch of latent vectors
-            noise = torch.randn(b_size, nz, 8, 8, device=device)
+            noise = torch.randn(b_size, nz, spatial_size, spatial_size, device=device)
             # Generate fake image batch with G
             fake = netG(noise)
             label.fill_(fake_label)
@@ -93,7 +132,19 @@ def train_model(num_epochs, dataloader, netG, netD, real_label, fake_label, opti
                 img_list.append(vutils.make_grid(fake, padding=2, normalize=True))
 
             iters += 1
-        if epoch > 850:
+        if validation_features is not None and (epoch + 1) % validate_every == 0:
+            performance = validate(netD, features_valid, features_open)
+            history.append({"epoch": epoch + 1, **performance})
+            print('[%d/%d] validation: AUROC %.4f\tW %.4f (threshold %.2f)' % (epoch, num_epochs, performance["auroc"], performance["W"], performance["threshold"]))
+            if performance[monitor] > best_metric:
+                best_metric, best_epoch, num_bad_validations = performance[monitor], epoch + 1, 0
+                best_wts = (copy.deepcopy(netG.state_dict()), copy.deepcopy(netD.state_dict()))
+            else:
+                num_bad_validations += 1
+                if num_bad_validations >= patience:
+                    print('Early stopping: no improvement of the %s for %d validations' % (monitor, patience))
+                    break
+        if validation_features is None and epoch > 850:
           cur_model_wts = copy.deepcopy(netG.state_dict())
           path_to_save_paramOnly = os.path.join(save_dir, 'epoch-{}.GNet'.format(epoch + 1))
           torch.save(cur_model_wts, path_to_save_paramOnly)
@@ -102,4 +153,12 @@ def train_model(num_epochs, dataloader, netG, netD, real_label, fake_label, opti
           path_to_save_paramOnly = os.path.join(save_dir, 'epoch-{}.DNet'.format(epoch + 1))
           torch.save(cur_model_wts, path_to_save_paramOnly)
 
+    if validation_features is not None and best_wts is not None:
+        print('Best %s %.4f at epoch %d' % (monitor, best_metric, best_epoch))
+        netG.load_state_dict(best_wts[0])
+        netD.load_state_dict(best_wts[1])
+        torch.save(best_wts[0], os.path.join(save_dir, 'best.GNet'))
+        torch.save(best_wts[1], os.path.join(save_dir, 'best.DNet'))
+        pd.DataFrame(history).to_csv(os.path.join(save_dir, 'validation.csv'), index=False)
+
     return G_losses, D_losses
@@ -1,9 +1,10 @@
 from collections import OrderedDict
-from typing import Collection, List, Union
+from functools import partial
+from typing import Collection, Dict, List, Union
 import torch
 from tqdm import tqdm
-from .ii_loss import outlier_score
-from .. import utils
+from .scorers import score
+from .. import parallel, score_cache, utils
 
 def get_mean_embeddings(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, device:torch.device) -> torch.Tensor:
     '''
@@ -24,20 +25,63 @@ def get_mean_embeddings(dataloader:torch.utils.data.DataLoader, model:torch.nn.M
     labels = torch.cat(labels)
     return utils.bucket_mean(full_embeddings, labels, num_classes=labels.max().item()+1)
 
-def eval_outlier_scores(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, traindata_means:torch.Tensor, device:torch.device) -> torch.Tensor:
+def _compute_outputs(model:torch.nn.Module, X:torch.Tensor, traindata_means:torch.Tensor) -> Dict[str, torch.Tensor]:
+    embeddings, y_hat = model(X)
+    return {"embeddings": embeddings, "logits": y_hat, "outlier_scores": score(embeddings, traindata_means)}
+
+def get_outputs(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, traindata_means:torch.Tensor, device:torch.device, num_procs:int=1) -> Dict[str, torch.Tensor]:
+    '''
+    Computes the embeddings, the logits and the outlier scores of a model on a dataloader.
+    traindata_means can be the mean embeddings of the trainset (Euclidean outlier score) or a scorer from scorers.get_scorer.
+    If num_procs is not 1, the dataset is evaluated on the CPU by num_procs processes (0 to choose automatically) with parallel.run_sharded.
+
+    Returns
+    -------
+    a dict with keys "embeddings" (N x D), "logits" (N x K) and "outlier_scores" (N), in the order of the dataloader.
+    '''
+    if num_procs != 1:
+        return parallel.run_sharded(model, dataloader.dataset, partial(_compute_outputs, traindata_means=traindata_means.cpu()), batch_size=dataloader.batch_size, num_procs=num_procs or None)
+    model.to(device)
+    model.eval()
+    traindata_means = traindata_means.to(device)
+    outputs = {"embeddings": [], "logits": [], "outlier_scores": []}
+    with torch.no_grad():
+        for X, _ in tqdm(dataloader):
+            X = X.to(device)
+            embeddings, y_hat = model(X)
+            outputs["embeddings"].append(embeddings.cpu())
+            outputs["logits"].append(y_hat.cpu())
+            outputs["outlier_scores"].append(score(embeddings, traindata_means).cpu())
+    return {name: torch.cat(values) for name, values in outputs.items()}
+
+def eval_outputs(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, traindata_means:torch.Tensor, device:torch.device, cache:score_cache.ScoreCache=None, num_procs:int=1) -> Dict[str, torch.Tensor]:
+    '''
+    Same as get_outputs, but if a ScoreCache is passed and the dataset is an ImageFolder, only the images missing from the cache are evaluated.
+    '''
+    if cache is not None and hasattr(dataloader.dataset, "samples"):
+        return score_cache.cached_outputs(dataloader, lambda loader: get_outputs(loader, model, traindata_means, device, num_procs), cache)
+    return get_outputs(dataloader, model, traindata_means, device, num_procs)
+
+def eval_outlier_scores(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, traindata_means:torch.Tensor, device:torch.device, cache:score_cache.ScoreCache=None, num_procs:int=1) -> torch.Tensor:
     '''
     Evaluates the outlier scores for a model on a dataloader.
+    If a ScoreCache is passed and the dataset is an ImageFolder, only the images missing from the cache are evaluated.
+    If num_procs is not 1, the evaluation is sharded across processes (see get_outputs).
     '''
+    if (cache is not None and hasattr(dataloader.dataset, "samples")) or num_procs != 1:
+        return eval_outputs(dataloader, model, traindata_means, device, cache, num_procs)["outlier_scores"]
     model.to(device)
     model.eval()
+    traindata_means = traindata_means.to(device)
     with torch.no_grad():
         outlier_scores = torch.zeros(len(dataloader.dataset))
-        for i, (X, y) in enumerate(tqdm(dataloader)):
+        offset = 0
+        for X, y in tqdm(dataloader):
             X = X.to(device)
-            y = y.to(device)
             embeddings, y_hat = model(X)
-            outlier_scores_batch = outlier_score(embeddings, traindata_means)
-            outlier_scores[i*X.shape[0]:(i+1)*X.shape[0]] = outlier_scores_batch
+            outlier_scores_batch = score(embeddings, traindata_means)
+            outlier_scores[offset:offset+X.shape[0]] = outlier_scores_batch.cpu()
+            offset += X.shape[0]
     return outlier_scores
 
 def eval_on_threshold(outlier_scores:torch.Tensor, threshold:float, comparison_fn=torch.gt) -> float:
@@ -1,4 +1,5 @@
 import torch
+from .. import distributed as dist_utils
 from .. import utils
 
 class IILoss(torch.nn.Module):
@@ -11,10 +12,44 @@ class IILoss(torch.nn.Module):
     Attributes
     ----------
     delta: a float representing the maximum inter_separation between classes. It is used to prevent the inter_separation term from dominating the intra_spread term and other losses such as cross-entropy.
+    distributed: a boolean indicating whether to compute the class means over the mini-batches of all the processes (data-parallel training) instead of the local one.
+    momentum: if not None, a float in [0, 1) enabling a memory of the class centroids (the "centroids" buffer, K x D), updated at each step as
+        momentum * centroid + (1 - momentum) * mini-batch mean for the classes in the mini-batch. The inter_separation is then computed among all the
+        centroids seen so far (with gradients flowing through the classes of the current mini-batch), so that it does not depend on which classes are
+        sampled. At the end of training the centroids can be used as the mean embeddings of the trainset (see export_means).
     '''
-    def __init__(self, delta:float=float("inf")):
+    def __init__(self, delta:float=float("inf"), distributed:bool=False, momentum:float=None):
         super().__init__()
         self.delta = delta
+        self.distributed = distributed
+        self.momentum = momentum
+        # allocated at the first step, when the number of classes and the embedding dimension are known
+        self.register_buffer("centroids", None)
+        self.register_buffer("centroids_initialized", None)
+
+    def export_means(self) -> torch.Tensor:
+        '''
+        Returns a copy of the centroid memory (K x D), to be used in place of the mean embeddings of the trainset (see eval.get_mean_embeddings).
+        The centroids average the embeddings over the last training steps, hence they lag slightly behind the final params.
+        '''
+        assert self.centroids is not None, "The centroid memory is empty: set momentum and train the model first."
+        return self.centroids.detach().clone()
+
+    def _memory_inter_separation(self, class_mean:torch.Tensor, present:torch.Tensor) -> torch.Tensor:
+        if self.centroids is None:
+            self.centroids = torch.zeros_like(class_mean.detach())
+            self.centroids_initialized = torch.zeros(len(class_mean), dtype=torch.bool, device=class_mean.device)
+        updated = torch.where(self.centroids_initialized.unsqueeze(1), self.momentum * self.centroids + (1 - self.momentum) * class_mean, class_mean)
+        current = torch.where(present.unsqueeze(1), updated, self.centroids)
+        # not in place: the previous buffers are needed by the backward pass
+        self.centroids = current.detach().clone()
+        self.centroids_initialized = self.centroids_initialized | present
+        current = current[self.centroids_initialized]
+        if len(current) < 2:
+            return torch.tensor(float("inf"), device=class_mean.device)
+        squared_distances = ((current.unsqueeze(0) - current.unsqueeze(1))**2).sum(dim=2)
+        squared_distances = squared_distances + torch.diag(torch.full((len(current),), float("inf"), device=class_mean.device))
+        return squared_distances.min()
 
     def forward(self, embeddings:torch.Tensor, labels:torch.Tensor, num_classes:int) -> torch.Tensor:
         '''
@@ -34,13 +69,17 @@ class IILoss(torch.nn.Module):
         device = embeddings.device
         intra_spread = torch.Tensor([0]).to(device)
         inter_separation = torch.Tensor([float("inf")]).to(device)
-        class_mean = utils.bucket_mean(embeddings, labels, num_classes)
+        if self.distributed:
+            class_mean, class_count = dist_utils.all_reduce_bucket_mean(embeddings, labels, num_classes)
+        else:
+            class_mean, class_count = utils.bucket_mean(embeddings, labels, num_classes), None
         empty_classes = []
 
         for j in range(num_classes):
             # update intra_spread
             data_class = embeddings[labels == j]
-            if len(data_class) == 0:
+            # in distributed mode a class is empty only if it is missing from the mini-batches of all processes
+            if (class_count[j] == 0) if class_count is not None else (len(data_class) == 0):
                 empty_classes.append(j)
                 continue
             difference_from_mean = data_class - class_mean[j]
@@ -51,7 +90,11 @@ class IILoss(torch.nn.Module):
             if class_mean_previous.shape[0] > 0:
                 norm_from_previous_means = (class_mean_previous - class_mean[j]).norm(dim=1)**2
                 inter_separation = min(inter_separation, norm_from_previous_means.min())
-        
+
+        if self.momentum is not None:
+            present = class_count > 0 if class_count is not None else torch.bincount(labels, minlength=num_classes) > 0
+            inter_separation = self._memory_inter_separation(class_mean, present)
+
         return intra_spread/n_datapoints - min(self.delta, inter_separation)
 
 def outlier_score(embeddings:torch.Tensor, train_class_means:torch.Tensor):
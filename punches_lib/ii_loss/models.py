@@ -1,6 +1,12 @@
 import torch
 import torchvision
 
+from ..cnn import models as cnn_models
+
+RESNET_ARCHITECTURES = ["resnet18", "resnet34", "resnet50"]
+# the architectures accepted by get_model: the ResNets trained with II-loss and the students distilled from them by main_distill.py
+MODEL_CLASSES = RESNET_ARCHITECTURES + cnn_models.STUDENT_ARCHITECTURES
+
 class ResNetCustom(torchvision.models.ResNet):
     def __init__(self, num_classes:int, architecture:str="resnet18", dim_latent:int=32):
         if architecture == "resnet18":
@@ -47,4 +53,13 @@ class ResNetCustom(torchvision.models.ResNet):
         out_z = self.fc1(out)
         out_y = self.fc2(out_z)
 
-        return out_z, out_y
\ No newline at end of file
+        return out_z, out_y
+
+def get_model(num_classes:int, model_class:str="resnet18", dim_latent:int=32) -> torch.nn.Module:
+    '''
+    Instantiates a model returning (embeddings, logits): a ResNetCustom for the ResNet architectures, or a cnn.models.StudentNet for the
+    architectures of the students distilled by main_distill.py (see MODEL_CLASSES).
+    '''
+    if model_class in RESNET_ARCHITECTURES:
+        return ResNetCustom(num_classes, model_class, dim_latent=dim_latent)
+    return cnn_models.StudentNet(num_classes, model_class, dim_latent=dim_latent)
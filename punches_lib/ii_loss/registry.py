@@ -0,0 +1,155 @@
+import json
+import os
+from typing import Collection, Dict, List, Tuple
+
+import torch
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader
+
+from .. import datasets
+
+def classes_path(means_path:str) -> str:
+    '''
+    Returns the path of the JSON file listing the punch id of each row of the mean embeddings saved at means_path, written by older versions
+    of main_ii.py before the classes were saved along with the means.
+    '''
+    return os.path.splitext(means_path)[0] + "_classes.json"
+
+def save_means(means_path:str, means:torch.Tensor, classes:List[str]=None):
+    '''
+    Saves the mean embeddings and the punch id of each row in a single file, replaced atomically, so that readers never see means and classes
+    of different versions.
+    '''
+    assert classes is None or len(classes) == len(means), f"Got {len(classes)} classes for {len(means)} mean embeddings"
+    tmp_path = means_path + ".tmp"
+    torch.save({"means": means, "classes": None if classes is None else list(classes)}, tmp_path)
+    os.replace(tmp_path, means_path)
+
+def _load_state(means_path:str) -> Tuple[torch.Tensor, List[str]]:
+    # the means are either saved by save_means with their classes, or as a bare tensor, with the classes (if any) in classes_path
+    state = torch.load(means_path, map_location="cpu")
+    if isinstance(state, dict):
+        return state["means"], state["classes"]
+    path = classes_path(means_path)
+    if not os.path.exists(path):
+        return state, None
+    with open(path) as f:
+        return state, json.load(f)
+
+def load_means(means_path:str) -> torch.Tensor:
+    '''
+    Returns the mean embeddings (K x D) saved at means_path, by save_means or as a bare tensor.
+    '''
+    return _load_state(means_path)[0]
+
+def load_classes(means_path:str) -> List[str]:
+    '''
+    Returns the punch ids of the rows of the mean embeddings saved at means_path, or None if they were not saved.
+    '''
+    return _load_state(means_path)[1]
+
+def list_images(paths:Collection[str]) -> List[str]:
+    '''
+    Expands a collection of image files and directories (searched recursively) into a sorted list of image files.
+    '''
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                images += [os.path.join(dirpath, f) for f in filenames if f.lower().endswith(IMG_EXTENSIONS)]
+        else:
+            images.append(path)
+    return sorted(images)
+
+def embed_images(model:torch.nn.Module, image_paths:Collection[str], device:torch.device, batch_size:int=32, transforms=None) -> torch.Tensor:
+    '''
+    Computes the embeddings (N x D) of a list of image files with a model returning (embeddings, logits), e.g. a ResNetCustom.
+    '''
+    transforms = transforms if transforms is not None else datasets.get_bare_transforms()
+    model.to(device)
+    model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for i in range(0, len(image_paths), batch_size):
+            X = torch.stack([transforms(default_loader(path)) for path in image_paths[i:i+batch_size]])
+            embeddings.append(model(X.to(device))[0].cpu())
+    return torch.cat(embeddings)
+
+class ClassRegistry(object):
+    '''
+    The mean embeddings of the known punch classes (the "_means.pth" file saved by main_ii.py) along with the punch id of each row (saved in the
+    same file by save_means), to which new classes can be appended without retraining: the exemplars of a new class are embedded with the frozen
+    model and their mean becomes a new row, while the existing rows are left untouched.
+    Scorers holding a registry can call refresh() to pick up the classes registered by other processes.
+
+    Attributes
+    ----------
+    means_path: the path of the mean embeddings.
+    means: a torch.Tensor of shape (K, D).
+    classes: the punch id of each row of means. If the classes were not saved, defaults to the class indices as strings.
+    '''
+    def __init__(self, means_path:str, classes:List[str]=None):
+        '''
+        Parameters
+        ----------
+        means_path: the path of the mean embeddings.
+        classes: the punch ids to use if none were saved along with the means, e.g. the ImageFolder.classes of the trainset.
+        '''
+        self.means_path = means_path
+        self._mtime = None
+        self._load(classes)
+
+    def _load(self, classes:List[str]=None):
+        self._mtime = os.stat(self.means_path).st_mtime_ns
+        self.means, saved_classes = _load_state(self.means_path)
+        self.classes = saved_classes if saved_classes is not None else (list(classes) if classes is not None else [str(i) for i in range(len(self.means))])
+        assert len(self.classes) == len(self.means), f"Got {len(self.classes)} classes for {len(self.means)} mean embeddings"
+
+    @property
+    def class_to_idx(self) -> Dict[str, int]:
+        return {name: idx for idx, name in enumerate(self.classes)}
+
+    def refresh(self) -> bool:
+        '''
+        Reloads the means and the classes if the means file was modified since they were loaded.
+
+        Returns
+        -------
+        True if they were reloaded.
+        '''
+        if os.stat(self.means_path).st_mtime_ns == self._mtime:
+            return False
+        self._load()
+        return True
+
+    def register(self, name:str, embeddings:torch.Tensor) -> int:
+        '''
+        Appends a new class whose centroid is the mean of the given embeddings (N x D) and returns its class index. Call save() to persist it.
+        '''
+        assert name not in self.classes, f"Class {name} is already registered with index {self.classes.index(name)}"
+        assert embeddings.shape[1] == self.means.shape[1], f"Expected embeddings of dimension {self.means.shape[1]}, got {embeddings.shape[1]}"
+        self.means = torch.cat([self.means, embeddings.to(self.means).mean(0, keepdim=True)])
+        self.classes.append(name)
+        return len(self.classes) - 1
+
+    def save(self):
+        '''
+        Saves the means and the classes, in a single file replaced atomically.
+        '''
+        save_means(self.means_path, self.means, self.classes)
+        self._mtime = os.stat(self.means_path).st_mtime_ns
+
+def register_class(registry:ClassRegistry, name:str, model:torch.nn.Module, image_paths:Collection[str], device:torch.device, batch_size:int=32, transforms=None) -> int:
+    '''
+    Embeds the exemplars of a new punch class with the frozen model, appends their centroid to the registry and saves it. The cost is a forward
+    pass over the new images only.
+
+    Returns
+    -------
+    the class index of the new class.
+    '''
+    image_paths = list_images(image_paths)
+    assert len(image_paths) > 0, f"No images found for class {name}"
+    class_idx = registry.register(name, embed_images(model, image_paths, device, batch_size, transforms))
+    registry.save()
+    print(f"Registered class {name} with index {class_idx} from {len(image_paths)} images")
+    return class_idx
@@ -0,0 +1,233 @@
+import os
+from typing import Dict, Union
+
+import torch
+from tqdm import tqdm
+
+from .ii_loss import outlier_score
+from .. import search
+
+class MomentAccumulator(object):
+    '''
+    Accumulates, in one pass over the embeddings of the trainset, the per-class counts, sums and sums of outer products (in float64),
+    from which the class means and the shared, per-class diagonal and per-class full covariances are derived.
+    '''
+    def __init__(self, num_classes:int, dim:int):
+        self.counts = torch.zeros(num_classes, dtype=torch.float64)
+        self.sums = torch.zeros(num_classes, dim, dtype=torch.float64)
+        self.outer_sums = torch.zeros(num_classes, dim, dim, dtype=torch.float64)
+
+    def update(self, embeddings:torch.Tensor, labels:torch.Tensor):
+        embeddings = embeddings.detach().cpu().double()
+        labels = labels.cpu().long()
+        self.counts.index_add_(0, labels, torch.ones(len(labels), dtype=torch.float64))
+        self.sums.index_add_(0, labels, embeddings)
+        self.outer_sums.index_add_(0, labels, embeddings.unsqueeze(2) * embeddings.unsqueeze(1))
+
+    def means(self) -> torch.Tensor:
+        return self.sums / self.counts.unsqueeze(1)
+
+    def class_covariances(self) -> torch.Tensor:
+        '''
+        Returns the (unbiased) covariance matrix of each class, K x D x D.
+        '''
+        means = self.means()
+        scatter = self.outer_sums - self.counts.view(-1, 1, 1) * means.unsqueeze(2) * means.unsqueeze(1)
+        return scatter / (self.counts.view(-1, 1, 1) - 1).clamp(min=1)
+
+    def shared_covariance(self) -> torch.Tensor:
+        '''
+        Returns the pooled within-class covariance matrix, D x D.
+        '''
+        means = self.means()
+        scatter = self.outer_sums - self.counts.view(-1, 1, 1) * means.unsqueeze(2) * means.unsqueeze(1)
+        return scatter.sum(0) / (self.counts.sum() - len(self.counts))
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return {"counts": self.counts, "sums": self.sums, "outer_sums": self.outer_sums}
+
+    def load_state_dict(self, state:Dict[str, torch.Tensor]):
+        self.counts, self.sums, self.outer_sums = state["counts"], state["sums"], state["outer_sums"]
+
+def accumulate_moments(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, device:torch.device) -> MomentAccumulator:
+    '''
+    Runs a model returning (embeddings, logits) over a labelled dataloader (e.g., on the trainset) and accumulates the moments of the embeddings.
+    '''
+    model.to(device)
+    model.eval()
+    accumulator = None
+    with torch.no_grad():
+        for X, y in tqdm(dataloader):
+            embeddings, _ = model(X.to(device))
+            if accumulator is None:
+                accumulator = MomentAccumulator(len(dataloader.dataset.classes), embeddings.shape[1])
+            accumulator.update(embeddings, y)
+    return accumulator
+
+def _regularized_cholesky(covariances:torch.Tensor, eps:float) -> torch.Tensor:
+    # a ridge relative to the average variance keeps the factorization stable for the (nearly) singular covariances of small classes
+    dim = covariances.shape[-1]
+    scale = covariances.diagonal(dim1=-2, dim2=-1).mean()
+    return torch.linalg.cholesky(covariances + eps * scale * torch.eye(dim, dtype=covariances.dtype))
+
+class EuclideanScorer(torch.nn.Module):
+    '''
+    The outlier score of the II-loss paper: squared Euclidean distance to the closest class mean (see ii_loss.outlier_score).
+    '''
+    def __init__(self, means:torch.Tensor):
+        super().__init__()
+        self.register_buffer("means", means.float())
+
+    def forward(self, embeddings:torch.Tensor) -> torch.Tensor:
+        return outlier_score(embeddings, self.means)
+
+class MahalanobisScorer(torch.nn.Module):
+    '''
+    Squared Mahalanobis distance to the closest class mean, with a covariance matrix shared among the classes.
+    Embeddings and means are whitened with the Cholesky factor L of the covariance (one triangular solve per batch), after which the distance is Euclidean.
+    '''
+    def __init__(self, means:torch.Tensor, covariance:torch.Tensor, eps:float=1e-3):
+        super().__init__()
+        cholesky = _regularized_cholesky(covariance.double(), eps)
+        self.register_buffer("cholesky", cholesky.float())
+        self.register_buffer("whitened_means", torch.linalg.solve_triangular(cholesky, means.double().T, upper=False).T.float())
+
+    def forward(self, embeddings:torch.Tensor) -> torch.Tensor:
+        whitened = torch.linalg.solve_triangular(self.cholesky, embeddings.T, upper=False).T
+        return outlier_score(whitened, self.whitened_means)
+
+class DiagonalScorer(torch.nn.Module):
+    '''
+    Squared distance to the closest class mean, each dimension being scaled by the variance of the class: sum_d (z_d - m_kd)^2 / var_kd.
+    '''
+    def __init__(self, means:torch.Tensor, variances:torch.Tensor, eps:float=1e-3):
+        super().__init__()
+        variances = variances + eps * variances.mean()
+        self.register_buffer("means", means.float())
+        self.register_buffer("inv_std", variances.rsqrt().float())
+
+    def forward(self, embeddings:torch.Tensor) -> torch.Tensor:
+        # N x K x D
+        scaled = (embeddings.unsqueeze(1) - self.means) * self.inv_std
+        return (scaled**2).sum(2).min(1).values
+
+class ClassCovarianceScorer(torch.nn.Module):
+    '''
+    Squared Mahalanobis distance to the closest class mean, with a full covariance matrix per class.
+    The per-class Cholesky factors are precomputed, so that scoring is a single batched triangular solve (K x D x D against K x D x N).
+    '''
+    def __init__(self, means:torch.Tensor, covariances:torch.Tensor, eps:float=1e-3):
+        super().__init__()
+        self.register_buffer("means", means.float())
+        self.register_buffer("cholesky", _regularized_cholesky(covariances.double(), eps).float())
+
+    def forward(self, embeddings:torch.Tensor) -> torch.Tensor:
+        # K x D x N
+        differences = embeddings.T.unsqueeze(0) - self.means.unsqueeze(2)
+        solved = torch.linalg.solve_triangular(self.cholesky, differences, upper=False)
+        return (solved**2).sum(1).min(0).values
+
+class KNNScorer(search.ExactIndex):
+    '''
+    Distance to the k-th nearest neighbour among the embeddings of the trainset (the gallery), which, unlike the distance to the class means,
+    accounts for the spread and shape of each class. The gallery is stored in float16 and searched by blocked matrix multiplications with a running
+    top-k, the block size being chosen so that the float32 distances of a batch and the converted gallery block fit in memory_budget_mb.
+
+    Attributes
+    ----------
+    embeddings: a torch.Tensor of shape (M, D) with the embeddings of the trainset, i.e. the gallery (see build_gallery).
+    labels: optionally, the class of each embedding of the gallery (M), returned by search.
+    k: the neighbour whose squared distance is the outlier score.
+    memory_budget_mb: the memory of the float32 distances and gallery block computed at once, in MB.
+    '''
+    def __init__(self, embeddings:torch.Tensor, labels:torch.Tensor=None, k:int=1, memory_budget_mb:float=16):
+        super().__init__(embeddings, labels, dtype=torch.float16)
+        self.k = k
+        self.memory_budget_mb = memory_budget_mb
+
+    def _get_block_size(self, num_queries:int) -> int:
+        # float32 distances (num_queries x block) plus the float32 copy of the gallery block (block x D)
+        return max(self.k, int(self.memory_budget_mb * 2**20) // (4 * (num_queries + self.centroids.shape[1])))
+
+    def forward(self, embeddings:torch.Tensor) -> torch.Tensor:
+        return self.search(embeddings, self.k)[0][:, -1]
+
+def build_gallery(dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, device:torch.device) -> Dict[str, torch.Tensor]:
+    '''
+    Computes the embeddings of a model returning (embeddings, logits) over a labelled dataloader (e.g., on the trainset).
+
+    Returns
+    -------
+    a dict with keys "embeddings" (N x D, float16) and "labels" (N).
+    '''
+    model.to(device)
+    model.eval()
+    embeddings, labels = [], []
+    with torch.no_grad():
+        for X, y in tqdm(dataloader):
+            embeddings.append(model(X.to(device))[0].half().cpu())
+            labels.append(y)
+    return {"embeddings": torch.cat(embeddings), "labels": torch.cat(labels)}
+
+def load_or_build_gallery(gallery_path:str, dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, device:torch.device) -> Dict[str, torch.Tensor]:
+    '''
+    Loads the gallery saved at gallery_path if it exists, otherwise builds it on the dataloader (e.g., on the trainset) and saves it there
+    (if gallery_path is not None).
+    '''
+    if gallery_path is not None and os.path.exists(gallery_path):
+        return torch.load(gallery_path)
+    assert dataloader is not None, f"No gallery found at {gallery_path}: a dataloader on the trainset is needed to compute it."
+    gallery = build_gallery(dataloader, model, device)
+    if gallery_path is not None:
+        torch.save(gallery, gallery_path)
+    return gallery
+
+SCORERS = ["euclidean", "mahalanobis", "diagonal", "class_covariance"]
+
+def get_scorer(name:str, moments:MomentAccumulator, eps:float=1e-3) -> torch.nn.Module:
+    '''
+    Instantiates a scorer from the moments of the trainset.
+
+    Parameters
+    ----------
+    name: one of "euclidean", "mahalanobis" (shared covariance), "diagonal" (per-class variances), "class_covariance" (per-class full covariance).
+    moments: a MomentAccumulator filled with the embeddings of the trainset.
+    eps: the ridge added to the covariances, relative to their average variance.
+
+    Returns
+    -------
+    a torch.nn.Module mapping a batch of embeddings (N x D) to the outlier scores (N). It can be passed to ii_loss.eval functions in place of the mean embeddings.
+    '''
+    means = moments.means()
+    if name == "euclidean":
+        return EuclideanScorer(means)
+    if name == "mahalanobis":
+        return MahalanobisScorer(means, moments.shared_covariance(), eps)
+    if name == "diagonal":
+        return DiagonalScorer(means, moments.class_covariances().diagonal(dim1=1, dim2=2), eps)
+    if name == "class_covariance":
+        return ClassCovarianceScorer(means, moments.class_covariances(), eps)
+    raise ValueError(f"Unknown scorer {name}")
+
+def score(embeddings:torch.Tensor, traindata_means:Union[torch.Tensor, torch.nn.Module]) -> torch.Tensor:
+    '''
+    Computes the outlier scores of a batch of embeddings given either the mean embeddings of the trainset (Euclidean score) or a scorer.
+    '''
+    if isinstance(traindata_means, torch.Tensor):
+        return outlier_score(embeddings, traindata_means)
+    return traindata_means(embeddings)
+
+def load_or_accumulate_moments(moments_path:str, dataloader:torch.utils.data.DataLoader, model:torch.nn.Module, device:torch.device) -> MomentAccumulator:
+    '''
+    Loads the moments saved at moments_path if it exists, otherwise accumulates them on the dataloader (e.g., on the trainset) and saves them
+    there (if moments_path is not None).
+    '''
+    if moments_path is not None and os.path.exists(moments_path):
+        moments = MomentAccumulator(0, 0)
+        moments.load_state_dict(torch.load(moments_path))
+        return moments
+    assert dataloader is not None, f"No moments found at {moments_path}: a dataloader on the trainset is needed to compute them."
+    moments = accumulate_moments(dataloader, model, device)
+    if moments_path is not None:
+        torch.save(moments.state_dict(), moments_path)
+    return moments
@@ -1,7 +1,7 @@
 import torch
-from typing import Union
+from typing import Callable, Union
 from tqdm import tqdm
-from .. import utils
+from .. import distributed, utils
 from .ii_loss import IILoss
 
 def train_model(
@@ -15,6 +15,7 @@ def train_model(
     device:Union[torch.device, str]=None,
     lambda_scale:int=1,
     alternate_backprop:bool=False,
+    epoch_callback:Callable[[int], bool]=None,
 ):
     '''
     Trains a model with the given parameters using a dual loss composed of IILoss and CELoss.
@@ -31,6 +32,7 @@ def train_model(
     device: a torch.device instance or a string indicating the device to use. If None, will use CUDA if available.
     lambda_scale: an integer indicating the scale of the lambda parameter in the IILoss.
     alternate_backprop: a boolean indicating whether to operate an alternate backprop+step for II and CELoss. If False, the backpropagation will be operated at the same time (default: False).
+    epoch_callback: a function called at the end of each epoch with the index of the epoch (e.g., for evaluating the model). If it returns True, the training is stopped.
     '''
 
     if device is None:
@@ -42,14 +44,17 @@ def train_model(
     model.train()
 
     for epoch in range(num_epochs):
+        # reshuffle the shards of the DistributedSampler, if any
+        distributed.set_sampler_epoch(dataloader, epoch)
         ii_loss_meter = utils.AverageMeter()
         ce_loss_meter = utils.AverageMeter()
         performance_meter = utils.AverageMeter()
 
         # added print for LR
-        print(f"Epoch {epoch+1} --- learning rate {optimizer.param_groups[0]['lr']:.5f}")
+        if distributed.is_main_process():
+            print(f"Epoch {epoch+1} --- learning rate {optimizer.param_groups[0]['lr']:.5f}")
 
-        for i, (X, y) in enumerate(tqdm(dataloader)):
+        for i, (X, y) in enumerate(tqdm(dataloader, disable=not distributed.is_main_process())):
             X = X.to(device)
             y = y.to(device)
             # 1. reset the gradients previously accumulated by the optimizer
@@ -59,13 +64,13 @@ def train_model(
             ii_loss = None
             ce_loss = None
             if (alternate_backprop and i%2==0) or (not alternate_backprop):
-                # 3. calculate ii_loss and backpropagate
+                # 3. calculate ii_loss
                 ii_loss = ii_loss_fn(embeddings, y, num_classes) * lambda_scale
-                ii_loss.backward(retain_graph=(not alternate_backprop))
             if (alternate_backprop and i%2==1) or (not alternate_backprop):
-                # 4. calculate ce_loss and backpropagate
+                # 4. calculate ce_loss
                 ce_loss = ce_loss_fn(y_hat, y)
-                ce_loss.backward()
+            # backpropagate the sum of the computed losses in a single backward pass (as required by DistributedDataParallel)
+            sum(loss for loss in (ii_loss, ce_loss) if loss is not None).backward()
             # 5. update the value of the params
             optimizer.step()
             # 6. calculate the accuracy for this mini-batch
@@ -77,8 +82,15 @@ def train_model(
                 ce_loss_meter.update(val=ce_loss.item(), n=X.shape[0])
             performance_meter.update(val=acc, n=X.shape[0])
 
-        print(f"Epoch {epoch+1} completed. Average II loss: {ii_loss_meter.avg}; CE loss: {ce_loss_meter.avg:.4f}; Performance: {performance_meter.avg:.4f}")
+        if distributed.is_main_process():
+            print(f"Epoch {epoch+1} completed. Average II loss: {ii_loss_meter.avg}; CE loss: {ce_loss_meter.avg:.4f}; Performance: {performance_meter.avg:.4f}")
 
         # update the state of the lr scheduler if provided
         if lr_scheduler is not None:
-            lr_scheduler.step()
\ No newline at end of file
+            lr_scheduler.step()
+
+        if epoch_callback is not None:
+            if epoch_callback(epoch):
+                break
+            # the callback may have switched the model to eval mode
+            model.train()
\ No newline at end of file
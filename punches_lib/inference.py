@@ -0,0 +1,138 @@
+import copy
+import os
+import re
+from typing import Dict
+
+import torch
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from . import utils
+
+def fold_batchnorm(model:torch.nn.Module) -> torch.nn.Module:
+    '''
+    Folds (in place) the BatchNorm layers of a model into the weights and bias of the preceding convolutions, replacing them with identities.
+    Handles the conv<i>/bn<i> attribute pairs of torchvision ResNets (ResNetCustom included) and their blocks, and Conv2d layers immediately
+    followed by BatchNorm2d within nn.Sequential containers (e.g., the downsample branches of the ResNets, Generator and DiscriminatorFunnel).
+    The result is equivalent to the original model in eval mode only, as the running statistics are used.
+
+    Parameters
+    ----------
+    model: a torch.nn.Module.
+
+    Returns
+    -------
+    the same model, for convenience.
+    '''
+    model.eval()
+    for module in list(model.modules()):
+        if isinstance(module, torch.nn.Sequential):
+            children = list(module.named_children())
+            for (name_conv, conv), (name_bn, bn) in zip(children[:-1], children[1:]):
+                if isinstance(conv, torch.nn.Conv2d) and isinstance(bn, torch.nn.BatchNorm2d):
+                    setattr(module, name_conv, fuse_conv_bn_eval(conv, bn))
+                    setattr(module, name_bn, torch.nn.Identity())
+            continue
+        for name_bn, bn in list(module.named_children()):
+            match = re.fullmatch(r"bn(\d*)", name_bn)
+            conv = getattr(module, f"conv{match.group(1)}", None) if match is not None else None
+            if isinstance(bn, torch.nn.BatchNorm2d) and isinstance(conv, torch.nn.Conv2d):
+                setattr(module, f"conv{match.group(1)}", fuse_conv_bn_eval(conv, bn))
+                setattr(module, name_bn, torch.nn.Identity())
+    return model
+
+def _channels_last_inputs(module, inputs):
+    # a top-level function rather than a lambda, so that optimized models can be pickled (e.g., by parallel.run_sharded)
+    return (inputs[0].contiguous(memory_format=torch.channels_last),) + tuple(inputs[1:])
+
+def to_channels_last(model:torch.nn.Module) -> torch.nn.Module:
+    '''
+    Converts (in place) the params of a model to the channels-last memory format and registers a forward pre-hook converting the inputs too,
+    so that the convolutions run on NHWC tensors without intermediate layout conversions.
+    The modules of the model are left untouched, hence forward hooks (e.g., on layer4) keep working.
+    '''
+    model.to(memory_format=torch.channels_last)
+    model.register_forward_pre_hook(_channels_last_inputs)
+    return model
+
+def optimize_for_inference(model:torch.nn.Module, example_inputs:torch.Tensor=None, mode:str="eager", channels_last:bool=True, cache_dir:str=None) -> torch.nn.Module:
+    '''
+    Returns a copy of the model optimized for eval-only workloads: BatchNorm layers folded into the convolutions, channels-last memory format and,
+    optionally, TorchScript tracing or torch.compile.
+
+    Parameters
+    ----------
+    model: a torch.nn.Module with loaded params, e.g. ii_loss.models.ResNetCustom, a torchvision ResNet or gan.architecture.DiscriminatorFunnel.
+    example_inputs: a batch of inputs, on the device where the model will run. Required for mode="trace".
+    mode: "eager" to only fold and convert the model (forward hooks keep working), "trace" to additionally trace it with TorchScript, "compile" to additionally wrap it in torch.compile (PyTorch >= 2.0).
+    channels_last: whether to use the channels-last memory format.
+    cache_dir: a folder where the optimized model is cached, keyed by a fingerprint of the params and of the options. If None, nothing is cached. Compiled models are not cached, as torch.compile keeps its own cache.
+
+    Returns
+    -------
+    the optimized model, in eval mode.
+    '''
+    assert mode in ("eager", "trace", "compile"), f"Unknown mode {mode}"
+    assert mode != "trace" or example_inputs is not None, "example_inputs is required for mode='trace'"
+    cache_path = None
+    if cache_dir is not None and mode != "compile":
+        key = utils.fingerprint(model, mode, channels_last, tuple(example_inputs.shape) if mode == "trace" else None)
+        cache_path = os.path.join(cache_dir, f"{type(model).__name__}_{key}.pt")
+
+    optimized = fold_batchnorm(copy.deepcopy(model))
+    if cache_path is not None and os.path.exists(cache_path):
+        if mode == "trace":
+            return torch.jit.load(cache_path, map_location=example_inputs.device).eval()
+        optimized.load_state_dict(torch.load(cache_path, map_location="cpu"))
+
+    if channels_last:
+        optimized = to_channels_last(optimized)
+    if example_inputs is not None:
+        optimized.to(example_inputs.device)
+
+    if mode == "trace":
+        with torch.no_grad():
+            optimized = torch.jit.freeze(torch.jit.trace(optimized, example_inputs))
+    elif mode == "compile":
+        optimized = torch.compile(optimized)
+
+    if cache_path is not None and not os.path.exists(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        if mode == "trace":
+            torch.jit.save(optimized, cache_path)
+        else:
+            torch.save(optimized.state_dict(), cache_path)
+    return optimized
+
+def _as_tuple(outputs):
+    return tuple(outputs) if isinstance(outputs, (tuple, list)) else (outputs,)
+
+def check_equivalence(reference:torch.nn.Module, optimized:torch.nn.Module, X:torch.Tensor, atol:float=1e-4, rtol:float=1e-3) -> Dict[str, float]:
+    '''
+    Checks that an optimized model produces the same outputs as the reference one (in eval mode) on a batch of inputs.
+
+    Returns
+    -------
+    a dict with the maximum absolute difference over all outputs ("max_abs_diff") and whether all outputs are close within the tolerances ("equivalent").
+    '''
+    reference.eval()
+    with torch.no_grad():
+        outputs_reference = _as_tuple(reference(X))
+        outputs_optimized = _as_tuple(optimized(X))
+    max_abs_diff = max((a - b).abs().max().item() for a, b in zip(outputs_reference, outputs_optimized))
+    equivalent = all(torch.allclose(a, b, atol=atol, rtol=rtol) for a, b in zip(outputs_reference, outputs_optimized))
+    return {"max_abs_diff": max_abs_diff, "equivalent": equivalent}
+
+def benchmark(reference:torch.nn.Module, optimized:torch.nn.Module, X:torch.Tensor, num_runs:int=10) -> Dict[str, float]:
+    '''
+    Compares the latency of a reference and an optimized model on a batch of inputs (see utils.time_inference).
+    '''
+    reference.eval()
+    timing_reference = utils.time_inference(reference, X, num_runs=num_runs)
+    timing_optimized = utils.time_inference(optimized, X, num_runs=num_runs)
+    return {
+        "reference_latency_ms": timing_reference["latency_ms"],
+        "optimized_latency_ms": timing_optimized["latency_ms"],
+        "reference_throughput": timing_reference["throughput"],
+        "optimized_throughput": timing_optimized["throughput"],
+        "speedup": timing_reference["latency_ms"] / timing_optimized["latency_ms"],
+    }
@@ -0,0 +1,136 @@
+import torch
+
+def auroc(scores_positive:torch.Tensor, scores_negative:torch.Tensor) -> float:
+    '''
+    Computes the area under the ROC curve for a binary problem where higher scores are expected for the positive class,
+    i.e., the probability that a positive datapoint scores higher than a negative one (ties count 1/2).
+    It is computed in one sort via the Mann-Whitney U statistic.
+
+    Parameters
+    ----------
+    scores_positive: a tensor of shape (N_pos) containing the scores of the positive datapoints (e.g., outlier scores of the OOD set).
+    scores_negative: a tensor of shape (N_neg) containing the scores of the negative datapoints (e.g., outlier scores of the validation set).
+
+    Returns
+    -------
+    a float between 0 and 1.
+    '''
+    scores_positive = torch.as_tensor(scores_positive).reshape(-1).double()
+    scores_negative = torch.as_tensor(scores_negative).reshape(-1).double()
+    n_pos, n_neg = len(scores_positive), len(scores_negative)
+    _, inverse, counts = torch.unique(torch.cat((scores_positive, scores_negative)), return_inverse=True, return_counts=True)
+    # tied scores get the average of the ranks they span (ranks start at 1)
+    average_ranks = counts.cumsum(0).double() - (counts.double() - 1) / 2
+    rank_sum_positive = average_ranks[inverse[:n_pos]].sum().item()
+    return (rank_sum_positive - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+def weighted_accuracies(scores_id:torch.Tensor, scores_ood:torch.Tensor, thresholds:torch.Tensor) -> dict:
+    '''
+    Computes, for every threshold at once, the fraction of in-distribution datapoints scoring below the threshold ("id_pct"), the fraction of
+    OOD datapoints scoring above it ("ood_pct"), and the weighted combination of the two used to select thresholds,
+    W = 5 * id_pct * ood_pct / (4 * id_pct + ood_pct) (see ii_determine_metrics.py and gan_eval.py).
+    The scores are sorted once and each threshold is located by binary search, in O((N + T) log N).
+
+    Parameters
+    ----------
+    scores_id: a tensor of shape (N_id) with the scores of the in-distribution datapoints (higher is more likely OOD, e.g. outlier scores;
+        pass the negated outputs of an OpenGAN discriminator).
+    scores_ood: a tensor of shape (N_ood) with the scores of the OOD datapoints.
+    thresholds: a tensor of shape (T).
+
+    Returns
+    -------
+    a dict with keys "threshold", "id_pct", "ood_pct" and "W", tensors of shape (T).
+    '''
+    scores_id = torch.as_tensor(scores_id).reshape(-1).double().sort().values
+    scores_ood = torch.as_tensor(scores_ood).reshape(-1).double().sort().values
+    thresholds = torch.as_tensor(thresholds).reshape(-1).double()
+    id_pct = torch.searchsorted(scores_id, thresholds, side="left").double() / len(scores_id)
+    ood_pct = 1 - torch.searchsorted(scores_ood, thresholds, side="right").double() / len(scores_ood)
+    W = 5 * id_pct * ood_pct / (4 * id_pct + ood_pct)
+    return {"threshold": thresholds, "id_pct": id_pct, "ood_pct": ood_pct, "W": torch.nan_to_num(W)}
+
+def best_weighted_accuracy(scores_id:torch.Tensor, scores_ood:torch.Tensor, thresholds:torch.Tensor) -> tuple:
+    '''
+    Returns the best W over the thresholds (see weighted_accuracies) and the threshold achieving it.
+    '''
+    accuracies = weighted_accuracies(scores_id, scores_ood, thresholds)
+    best = accuracies["W"].argmax()
+    return accuracies["W"][best].item(), accuracies["threshold"][best].item()
+
+def _prefix_counts(ranks:torch.Tensor, num_values:int, indices:torch.Tensor) -> torch.Tensor:
+    # B x (num_values + 1) matrix whose [b, k] entry is the number of scores of resample b (a row of indices) with rank lower than k
+    num_resamples = len(indices)
+    flat = (ranks[indices] + torch.arange(num_resamples).unsqueeze(1) * num_values).reshape(-1)
+    histograms = torch.bincount(flat, minlength=num_resamples * num_values).view(num_resamples, num_values)
+    return torch.cat((torch.zeros(num_resamples, 1, dtype=histograms.dtype), histograms.cumsum(1)), dim=1)
+
+def bootstrap_metrics(scores_id:torch.Tensor, scores_ood:torch.Tensor, thresholds:torch.Tensor, num_resamples:int=2000, seed:int=0, batch_size:int=1000) -> dict:
+    '''
+    Computes the AUROC and the best weighted accuracy (see weighted_accuracies) on num_resamples bootstrap resamples of the ID and OOD scores.
+    The resamples are drawn as one matrix of indices (batch_size resamples at a time, to bound the memory); the scores are ranked once among
+    their distinct values, so that every resample is summarized by the cumulative counts of its ranks. Both metrics are then read off these
+    counts for all the resamples at once: the AUROC as a Mann-Whitney statistic and the counts below/above each threshold by binary search.
+
+    Parameters
+    ----------
+    scores_id: a tensor of shape (N_id) with the scores of the in-distribution datapoints (higher is more likely OOD).
+    scores_ood: a tensor of shape (N_ood) with the scores of the OOD datapoints.
+    thresholds: a tensor of shape (T) with the thresholds among which the best one is chosen for each resample.
+    num_resamples: the number of bootstrap resamples.
+    seed: the seed of the resampling.
+    batch_size: the number of resamples processed at once.
+
+    Returns
+    -------
+    a dict with keys "auroc", "W", "threshold", "id_pct" and "ood_pct" (the last four at the best threshold of each resample), tensors of
+    shape (num_resamples).
+    '''
+    scores_id = torch.as_tensor(scores_id).reshape(-1).double()
+    scores_ood = torch.as_tensor(scores_ood).reshape(-1).double()
+    thresholds = torch.as_tensor(thresholds).reshape(-1).double()
+    n_id, n_ood = len(scores_id), len(scores_ood)
+    values, inverse = torch.unique(torch.cat((scores_id, scores_ood)), return_inverse=True)
+    ranks_id, ranks_ood = inverse[:n_id], inverse[n_id:]
+    # number of scores strictly below a threshold = prefix count at its left insertion point, at most a threshold = at its right one
+    below = torch.searchsorted(values, thresholds, side="left")
+    at_most = torch.searchsorted(values, thresholds, side="right")
+    generator = torch.Generator().manual_seed(seed)
+
+    results = {"auroc": [], "W": [], "threshold": [], "id_pct": [], "ood_pct": []}
+    for start in range(0, num_resamples, batch_size):
+        size = min(batch_size, num_resamples - start)
+        counts_id = _prefix_counts(ranks_id, len(values), torch.randint(n_id, (size, n_id), generator=generator)).double()
+        counts_ood = _prefix_counts(ranks_ood, len(values), torch.randint(n_ood, (size, n_ood), generator=generator)).double()
+        # each OOD score beats the ID scores of lower rank and ties with those of the same rank
+        histogram_id, histogram_ood = counts_id.diff(dim=1), counts_ood.diff(dim=1)
+        results["auroc"].append((histogram_ood * (counts_id[:, :-1] + histogram_id / 2)).sum(1) / (n_id * n_ood))
+        id_pct = counts_id[:, below] / n_id
+        ood_pct = 1 - counts_ood[:, at_most] / n_ood
+        W = torch.nan_to_num(5 * id_pct * ood_pct / (4 * id_pct + ood_pct))
+        best = W.argmax(1, keepdim=True)
+        results["W"].append(W.gather(1, best).squeeze(1))
+        results["threshold"].append(thresholds[best.squeeze(1)])
+        results["id_pct"].append(id_pct.gather(1, best).squeeze(1))
+        results["ood_pct"].append(ood_pct.gather(1, best).squeeze(1))
+    return {name: torch.cat(values) for name, values in results.items()}
+
+def bootstrap_intervals(scores_id:torch.Tensor, scores_ood:torch.Tensor, thresholds:torch.Tensor, num_resamples:int=2000, confidence:float=0.95, seed:int=0) -> dict:
+    '''
+    Returns, for the AUROC and for the best W, its threshold, and the ID/OOD percentages at that threshold, the estimate on the full scores
+    and the percentile confidence interval over num_resamples bootstrap resamples (see bootstrap_metrics).
+
+    Returns
+    -------
+    a dict mapping each metric to a dict with keys "estimate", "ci_low" and "ci_high".
+    '''
+    accuracies = weighted_accuracies(scores_id, scores_ood, thresholds)
+    best = accuracies["W"].argmax()
+    estimates = {"auroc": auroc(scores_ood, scores_id), **{name: accuracies[name][best].item() for name in ("W", "threshold", "id_pct", "ood_pct")}}
+    resampled = bootstrap_metrics(scores_id, scores_ood, thresholds, num_resamples, seed)
+    quantiles = torch.tensor([(1 - confidence) / 2, (1 + confidence) / 2], dtype=torch.float64)
+    intervals = {}
+    for name, estimate in estimates.items():
+        low, high = torch.quantile(resampled[name], quantiles).tolist()
+        intervals[name] = {"estimate": estimate, "ci_low": low, "ci_high": high}
+    return intervals
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+# best (num_procs, num_threads) found by autotune, keyed by model class, batch size and number of cores
+_AUTOTUNE_CACHE = {}
+
+def shard_bounds(num_items:int, batch_size:int, num_shards:int) -> List[Tuple[int, int]]:
+    '''
+    Partitions range(num_items) into num_shards contiguous [start, end) ranges whose starts are multiples of batch_size, so that each batch
+    of every shard is the same as the corresponding batch of a sequential, non-shuffled DataLoader. Some shards may be empty.
+    '''
+    num_batches = (num_items + batch_size - 1) // batch_size
+    batches_per_shard = [num_batches // num_shards + (1 if i < num_batches % num_shards else 0) for i in range(num_shards)]
+    bounds = []
+    start_batch = 0
+    for n in batches_per_shard:
+        bounds.append((min(start_batch * batch_size, num_items), min((start_batch + n) * batch_size, num_items)))
+        start_batch += n
+    return bounds
+
+def _output_specs(model, dataset:torch.utils.data.Dataset, compute_fn:Callable) -> Dict[str, Tuple[tuple, np.dtype]]:
+    X = dataset[0][0].unsqueeze(0)
+    with torch.no_grad():
+        outputs = compute_fn(model, X)
+    return {name: (tuple(t.shape[1:]), t.cpu().numpy().dtype) for name, t in outputs.items()}
+
+def _worker(rank:int, bounds:List[Tuple[int, int]], model, dataset:torch.utils.data.Dataset, compute_fn:Callable, paths:Dict[str, str], batch_size:int, num_threads:int):
+    torch.set_num_threads(num_threads)
+    start, end = bounds[rank]
+    if start >= end:
+        return
+    outputs = {name: np.load(path, mmap_mode="r+") for name, path in paths.items()}
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(start, end)), batch_size=batch_size, shuffle=False, num_workers=0)
+    offset = start
+    with torch.no_grad():
+        for batch in loader:
+            X = batch[0]
+            for name, values in compute_fn(model, X).items():
+                outputs[name][offset:offset+X.shape[0]] = values.cpu().numpy()
+            offset += X.shape[0]
+    for array in outputs.values():
+        array.flush()
+
+def run_sharded(model, dataset:torch.utils.data.Dataset, compute_fn:Callable, batch_size:int=32, num_procs:int=None, num_threads:int=None, out_dir:str=None) -> Dict[str, torch.Tensor]:
+    '''
+    Runs a model over a dataset on the CPU with several processes, each one evaluating a contiguous shard of the dataset with its own thread budget.
+    The outputs are preallocated as .npy files and every process writes its results directly at the offsets of its shard, so nothing is gathered
+    or pickled back. The shards are aligned to batch_size, hence the batches are the same as those of a sequential run and so are the outputs.
+
+    Parameters
+    ----------
+    model: a picklable model (e.g., a torch.nn.Module, or a torch.nn.ModuleList of several modules). Scripted modules are not supported. Modules are set to eval mode.
+    dataset: a dataset of (X, y) pairs, e.g. an ImageFolder.
+    compute_fn: a picklable function (model, X) -> dict of tensors whose first dimension is len(X), e.g. a top-level function or a functools.partial of one.
+    batch_size: the batch size.
+    num_procs: the number of processes. If None, the split of the cores between processes and threads is chosen with autotune.
+    num_threads: the number of threads per process. If None, the cores are split evenly among the processes.
+    out_dir: the folder where the outputs (<name>.npy) are written. If None, they are written to a temporary folder, removed once they are read back.
+
+    Returns
+    -------
+    a dict mapping the output names to tensors in the order of the dataset: backed by the memory-mapped .npy files of out_dir, or in memory if out_dir is None.
+    '''
+    if isinstance(model, torch.nn.Module):
+        model = model.cpu().eval()
+    num_cpus = os.cpu_count() or 1
+    if num_procs is None:
+        num_procs, num_threads = autotune(model, dataset, compute_fn, batch_size)
+    if num_threads is None:
+        num_threads = max(1, num_cpus // num_procs)
+    if out_dir is None:
+        with tempfile.TemporaryDirectory(prefix="punches_") as tmp_dir:
+            outputs = run_sharded(model, dataset, compute_fn, batch_size, num_procs, num_threads, out_dir=tmp_dir)
+            return {name: values.clone() for name, values in outputs.items()}
+    os.makedirs(out_dir, exist_ok=True)
+
+    paths = {}
+    for name, (shape, dtype) in _output_specs(model, dataset, compute_fn).items():
+        paths[name] = os.path.join(out_dir, f"{name}.npy")
+        np.lib.format.open_memmap(paths[name], mode="w+", dtype=dtype, shape=(len(dataset), *shape)).flush()
+
+    bounds = shard_bounds(len(dataset), batch_size, num_procs)
+    if num_procs == 1:
+        num_threads_before = torch.get_num_threads()
+        _worker(0, bounds, model, dataset, compute_fn, paths, batch_size, num_threads)
+        torch.set_num_threads(num_threads_before)
+    else:
+        mp.spawn(_worker, args=(bounds, model, dataset, compute_fn, paths, batch_size, num_threads), nprocs=num_procs, join=True)
+    return {name: torch.from_numpy(np.load(path, mmap_mode="r+")) for name, path in paths.items()}
+
+def autotune(model, dataset:torch.utils.data.Dataset, compute_fn:Callable, batch_size:int=32, num_batches:int=2) -> Tuple[int, int]:
+    '''
+    Chooses the split of the cores of the machine into processes x threads which maximizes the throughput of run_sharded, by timing
+    num_batches batches per process for each split (num_procs being a power of 2 or the number of cores). The result is cached for the
+    current process, keyed by model class, batch size and number of cores.
+
+    Returns
+    -------
+    a (num_procs, num_threads) tuple.
+    '''
+    num_cpus = os.cpu_count() or 1
+    key = (type(model).__name__, batch_size, num_cpus)
+    if key in _AUTOTUNE_CACHE:
+        return _AUTOTUNE_CACHE[key]
+    candidates = sorted({2**i for i in range(num_cpus.bit_length()) if 2**i <= num_cpus} | {num_cpus})
+    best, best_throughput = (1, num_cpus), 0
+    with tempfile.TemporaryDirectory(prefix="punches_") as tmp_dir:
+        for num_procs in candidates:
+            num_items = min(len(dataset), num_procs * num_batches * batch_size)
+            subset = torch.utils.data.Subset(dataset, range(num_items))
+            start = time.perf_counter()
+            run_sharded(model, subset, compute_fn, batch_size, num_procs, num_cpus // num_procs, out_dir=os.path.join(tmp_dir, str(num_procs)))
+            throughput = num_items / (time.perf_counter() - start)
+            print(f"Autotune: {num_procs} processes x {num_cpus // num_procs} threads -> {throughput:.1f} items/s")
+            if throughput > best_throughput:
+                best, best_throughput = (num_procs, num_cpus // num_procs), throughput
+    _AUTOTUNE_CACHE[key] = best
+    return best
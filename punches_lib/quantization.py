@@ -0,0 +1,126 @@
+import copy
+from typing import Dict
+
+import torch
+from scipy import stats
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from . import metrics, utils
+from .ii_loss.ii_loss import outlier_score
+
+def quantize_model_dynamic(model:torch.nn.Module) -> torch.nn.Module:
+    '''
+    Returns a copy of the model with dynamically quantized (INT8 weights, activations quantized on the fly) linear layers.
+    The convolutions are left in float32, hence the speedup is limited to the heads of the network.
+    '''
+    return quantize_dynamic(copy.deepcopy(model).eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+def quantize_model_static(model:torch.nn.Module, calibration_loader:torch.utils.data.DataLoader, num_batches:int=10, backend:str="x86") -> torch.nn.Module:
+    '''
+    Returns a statically quantized (INT8 weights and activations) copy of the model, for CPU inference.
+    The model is symbolically traced: Conv+BN+ReLU sequences are fused, observers are inserted and calibrated on a few batches of data, then the
+    model is converted to use quantized kernels.
+
+    Parameters
+    ----------
+    model: a float torch.nn.Module (e.g., ii_loss.models.ResNetCustom or the output of cnn.models.get_model).
+    calibration_loader: a torch.utils.data.DataLoader yielding (X, y) pairs, e.g. on a subset of the trainset.
+    num_batches: the number of batches used for calibration.
+    backend: the quantized engine ("x86", "fbgemm" for x86 CPUs, "qnnpack" for ARM CPUs).
+
+    Returns
+    -------
+    the quantized torch.nn.Module, on the CPU.
+    '''
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    example_inputs = (next(iter(calibration_loader))[0],)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs)
+    with torch.no_grad():
+        for i, (X, _) in enumerate(calibration_loader):
+            if i >= num_batches:
+                break
+            prepared(X)
+    return convert_fx(prepared)
+
+def save_quantized_model(model:torch.nn.Module, example_inputs:torch.Tensor, path:str):
+    '''
+    Saves a quantized model as TorchScript, so that it can be loaded with torch.jit.load without re-running the quantization workflow.
+    '''
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, example_inputs)
+    torch.jit.save(scripted, path)
+
+def load_quantized_model(path:str) -> torch.jit.ScriptModule:
+    '''
+    Loads a model saved with save_quantized_model. Quantized models can only be run on the CPU.
+    '''
+    return torch.jit.load(path, map_location="cpu").eval()
+
+def get_outputs(model:torch.nn.Module, dataloader:torch.utils.data.DataLoader, traindata_means:torch.Tensor=None) -> Dict[str, torch.Tensor]:
+    '''
+    Runs a model on the CPU over a dataloader.
+
+    Returns
+    -------
+    a dict with keys "logits" and "labels"; if traindata_means is passed, the model is expected to output (embeddings, logits) as
+    ii_loss.models.ResNetCustom and the dict also contains "outlier_scores".
+    '''
+    outputs = {"logits": [], "labels": [], "outlier_scores": []}
+    with torch.no_grad():
+        for X, y in dataloader:
+            out = model(X)
+            if traindata_means is not None:
+                embeddings, out = out
+                outputs["outlier_scores"].append(outlier_score(embeddings, traindata_means))
+            outputs["logits"].append(out)
+            outputs["labels"].append(y)
+    return {name: torch.cat(values) for name, values in outputs.items() if len(values) > 0}
+
+def compare_models(float_model:torch.nn.Module, quantized_model:torch.nn.Module, validloader:torch.utils.data.DataLoader, oodloader:torch.utils.data.DataLoader=None, traindata_means:torch.Tensor=None, quantized_traindata_means:torch.Tensor=None, num_timing_runs:int=10) -> Dict[str, float]:
+    '''
+    Compares a quantized model against its float counterpart on the CPU.
+
+    Parameters
+    ----------
+    float_model: the float model.
+    quantized_model: the quantized model.
+    validloader: a dataloader on labelled in-distribution data (e.g., the validation set), used for accuracy and for timing.
+    oodloader: a dataloader on OOD data. Used only for II-loss models (i.e., if traindata_means is passed) to compute the AUROC of the outlier scores.
+    traindata_means: the mean embeddings of the trainset obtained with the float model. If None, the models are treated as plain classifiers.
+    quantized_traindata_means: the mean embeddings of the trainset obtained with the quantized model. If None, traindata_means is used.
+    num_timing_runs: the number of batches timed for the latency.
+
+    Returns
+    -------
+    a dict containing accuracy, latency and throughput for both models and, for II-loss models, the shift of the outlier scores
+    (mean absolute difference, relative shift of mean and std, Kolmogorov-Smirnov statistic) and the AUROC (validation vs. OOD) of both models.
+    '''
+    float_model = float_model.cpu().eval()
+    if quantized_traindata_means is None:
+        quantized_traindata_means = traindata_means
+    report = {}
+    results = {}
+    for name, model, means in (("float", float_model, traindata_means), ("quantized", quantized_model, quantized_traindata_means)):
+        valid_outputs = get_outputs(model, validloader, means)
+        report[f"{name}_accuracy"] = utils.accuracy(valid_outputs["logits"], valid_outputs["labels"])
+        timing = utils.time_inference(model, next(iter(validloader))[0], num_runs=num_timing_runs)
+        report[f"{name}_latency_ms"] = timing["latency_ms"]
+        report[f"{name}_throughput"] = timing["throughput"]
+        if means is not None:
+            results[name] = valid_outputs["outlier_scores"]
+            if oodloader is not None:
+                ood_scores = get_outputs(model, oodloader, means)["outlier_scores"]
+                report[f"{name}_auroc"] = metrics.auroc(ood_scores, valid_outputs["outlier_scores"])
+    report["accuracy_drop"] = report["float_accuracy"] - report["quantized_accuracy"]
+    report["speedup"] = report["float_latency_ms"] / report["quantized_latency_ms"]
+    if traindata_means is not None:
+        scores_float, scores_quantized = results["float"], results["quantized"]
+        report["os_mean_abs_diff"] = (scores_float - scores_quantized).abs().mean().item()
+        report["os_mean_shift"] = (scores_quantized.mean() / scores_float.mean() - 1).item()
+        report["os_std_shift"] = (scores_quantized.std() / scores_float.std() - 1).item()
+        report["os_ks_statistic"] = stats.ks_2samp(scores_float.numpy(), scores_quantized.numpy()).statistic
+        if oodloader is not None:
+            report["auroc_drift"] = report["quantized_auroc"] - report["float_auroc"]
+    return report
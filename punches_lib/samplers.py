@@ -0,0 +1,81 @@
+from typing import Collection, Iterator, List
+
+import numpy as np
+import torch
+
+def dataset_labels(dataset:torch.utils.data.Dataset) -> np.ndarray:
+    '''
+    Returns the labels of a dataset without loading the data: supports ImageFolder (targets), TensorDataset (second tensor),
+    datasets.BasicDatasetLabels (constant label) and Subsets of them.
+    '''
+    if isinstance(dataset, torch.utils.data.Subset):
+        return dataset_labels(dataset.dataset)[np.asarray(dataset.indices)]
+    if hasattr(dataset, "targets"):
+        return np.asarray(dataset.targets)
+    if isinstance(dataset, torch.utils.data.TensorDataset):
+        return dataset.tensors[1].cpu().numpy()
+    if hasattr(dataset, "label"):
+        return np.full(len(dataset), dataset.label)
+    raise ValueError(f"Cannot get the labels of a dataset of type {type(dataset).__name__}")
+
+class ClassBalancedBatchSampler(torch.utils.data.Sampler):
+    '''
+    A P x K batch sampler: each batch contains num_samples_per_class (K) datapoints for each of num_classes_per_batch (P) classes.
+    With P equal to the number of classes, every class is represented in every mini-batch, so that IILoss always estimates all the class means.
+    Within a class, datapoints are drawn without replacement from a shuffled pool which is refilled once exhausted (classes with less than K
+    datapoints are drawn with replacement). The sampling is deterministic given the seed and the epoch: call set_epoch at the beginning of each epoch.
+    Use it as the batch_sampler of a torch.utils.data.DataLoader.
+    '''
+    def __init__(self, labels:Collection[int], num_classes_per_batch:int=None, num_samples_per_class:int=4, num_batches:int=None, class_weights:Collection[float]=None, seed:int=0):
+        '''
+        Parameters
+        ----------
+        labels: the labels of the datapoints of the dataset (see dataset_labels).
+        num_classes_per_batch: P, the number of classes in each batch. If None, all the classes.
+        num_samples_per_class: K, the number of datapoints per class in each batch.
+        num_batches: the number of batches per epoch. If None, the size of the dataset divided by P x K.
+        class_weights: the (unnormalized) probabilities of picking each class, when P is smaller than the number of classes. If None, the classes are picked uniformly.
+        seed: the seed of the random generator.
+        '''
+        self.labels = np.asarray(labels)
+        self.classes = np.unique(self.labels)
+        self.indices_per_class = [np.nonzero(self.labels == c)[0] for c in self.classes]
+        self.num_classes_per_batch = len(self.classes) if num_classes_per_batch is None else num_classes_per_batch
+        assert self.num_classes_per_batch <= len(self.classes), f"Cannot sample {self.num_classes_per_batch} classes per batch out of {len(self.classes)}"
+        self.num_samples_per_class = num_samples_per_class
+        self.batch_size = self.num_classes_per_batch * self.num_samples_per_class
+        self.num_batches = num_batches if num_batches is not None else max(1, len(self.labels) // self.batch_size)
+        if class_weights is not None:
+            class_weights = np.asarray(class_weights, dtype=np.float64)[self.classes]
+            class_weights = class_weights / class_weights.sum()
+        self.class_weights = class_weights
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch:int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = np.random.default_rng((self.seed, self.epoch))
+        pools = [rng.permutation(indices) for indices in self.indices_per_class]
+        positions = [0] * len(pools)
+        for _ in range(self.num_batches):
+            if self.num_classes_per_batch == len(self.classes):
+                batch_classes = range(len(self.classes))
+            else:
+                batch_classes = rng.choice(len(self.classes), size=self.num_classes_per_batch, replace=False, p=self.class_weights)
+            batch = []
+            for c in batch_classes:
+                pool = pools[c]
+                if len(pool) < self.num_samples_per_class:
+                    batch.extend(rng.choice(pool, size=self.num_samples_per_class, replace=True).tolist())
+                    continue
+                if positions[c] + self.num_samples_per_class > len(pool):
+                    pools[c] = pool = rng.permutation(pool)
+                    positions[c] = 0
+                batch.extend(pool[positions[c]:positions[c] + self.num_samples_per_class].tolist())
+                positions[c] += self.num_samples_per_class
+            yield batch
@@ -0,0 +1,134 @@
+import os
+from typing import Callable, Collection, Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from .storage import ColumnStore, TEXT
+
+def file_keys(paths:Collection[str]) -> List[Tuple[str, int, int]]:
+    '''
+    Returns the cache keys (path, size in bytes, mtime in nanoseconds) of the given files.
+    '''
+    keys = []
+    for path in paths:
+        stat = os.stat(path)
+        keys.append((path, stat.st_size, stat.st_mtime_ns))
+    return keys
+
+class ScoreCache(object):
+    '''
+    A per-image cache of model outputs (e.g., embeddings, logits, outlier scores, discriminator outputs).
+    Entries are keyed by file path, size and mtime; the cache lives in a sub-folder named after a fingerprint of the model(s) which produced
+    the outputs (see utils.fingerprint), so that changing the params or the mean embeddings automatically starts from an empty cache.
+    The outputs are stored in a ColumnStore: modified files are appended again and the most recent entry wins.
+    '''
+    def __init__(self, root:str, fingerprint:str):
+        '''
+        Parameters
+        ----------
+        root: the folder containing the caches of all models.
+        fingerprint: a string identifying the model(s), e.g. the output of utils.fingerprint(model, traindata_means).
+        '''
+        self.root = os.path.join(root, fingerprint)
+        self.store = ColumnStore(self.root) if os.path.exists(os.path.join(self.root, "meta.json")) else None
+        self._index = None
+
+    def _get_index(self) -> Dict[str, Tuple[int, int, int]]:
+        if self._index is None:
+            self._index = {}
+            if self.store is not None:
+                sizes = self.store.column("size")
+                mtimes = self.store.column("mtime")
+                for row, path in enumerate(self.store.column("path")):
+                    self._index[path] = (row, int(sizes[row]), int(mtimes[row]))
+        return self._index
+
+    def lookup(self, keys:Collection[Tuple[str, int, int]]) -> np.ndarray:
+        '''
+        Returns, for each key (path, size, mtime), the row of the cache holding its outputs, or -1 if the file is not cached (or was modified since).
+        '''
+        index = self._get_index()
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        for i, (path, size, mtime) in enumerate(keys):
+            entry = index.get(path)
+            if entry is not None and entry[1] == size and entry[2] == mtime:
+                rows[i] = entry[0]
+        return rows
+
+    def lookup_paths(self, paths:Collection[str]) -> np.ndarray:
+        '''
+        Returns, for each path, the row of the cache holding its most recent outputs, or -1 if it is not cached. Unlike lookup, the files are
+        not checked for modifications (nor need to exist anymore).
+        '''
+        index = self._get_index()
+        return np.array([index[path][0] if path in index else -1 for path in paths], dtype=np.int64)
+
+    def put(self, keys:Collection[Tuple[str, int, int]], outputs:Dict[str, torch.Tensor]) -> np.ndarray:
+        '''
+        Adds the outputs for the given keys to the cache.
+
+        Parameters
+        ----------
+        keys: a collection of N keys (path, size, mtime).
+        outputs: a dict mapping output names to tensors whose first dimension is N.
+
+        Returns
+        -------
+        the rows of the cache where the outputs have been stored.
+        '''
+        outputs = {name: t.detach().cpu().float().numpy() for name, t in outputs.items()}
+        if self.store is None:
+            schema = {"path": {"dtype": TEXT}, "size": {"dtype": "int64"}, "mtime": {"dtype": "int64"}}
+            for name, array in outputs.items():
+                schema[name] = {"dtype": "float32", "shape": array.shape[1:]}
+            self.store = ColumnStore(self.root, schema)
+        index = self._get_index()
+        first_row = len(self.store)
+        self.store.append({
+            "path": [k[0] for k in keys],
+            "size": [k[1] for k in keys],
+            "mtime": [k[2] for k in keys],
+            **outputs,
+        })
+        rows = np.arange(first_row, first_row + len(keys))
+        for row, key in zip(rows, keys):
+            index[key[0]] = (int(row), key[1], key[2])
+        return rows
+
+    def get(self, rows:np.ndarray, names:Collection[str]=None) -> Dict[str, torch.Tensor]:
+        '''
+        Returns the cached outputs at the given rows.
+
+        Parameters
+        ----------
+        rows: an array of rows, as returned by lookup or put.
+        names: the names of the outputs to return. If None, all outputs are returned.
+        '''
+        if names is None:
+            names = [c for c in self.store.columns if c not in ("path", "size", "mtime")]
+        return {name: torch.from_numpy(np.asarray(self.store.column(name)[rows])) for name in names}
+
+def cached_outputs(dataloader:torch.utils.data.DataLoader, compute_fn:Callable[[torch.utils.data.DataLoader], Dict[str, torch.Tensor]], cache:ScoreCache) -> Dict[str, torch.Tensor]:
+    '''
+    Returns the outputs of a model for all the images of a dataloader, computing only the ones missing from the cache.
+
+    Parameters
+    ----------
+    dataloader: a torch.utils.data.DataLoader whose dataset is an ImageFolder (or any dataset with a "samples" attribute listing (path, target) pairs).
+    compute_fn: a function mapping a dataloader to a dict of output tensors, in the order of the dataset (e.g., ii_loss.eval.get_outputs).
+    cache: a ScoreCache instance.
+
+    Returns
+    -------
+    a dict mapping output names to tensors whose first dimension is the size of the dataset, in the order of the dataset.
+    '''
+    dataset = dataloader.dataset
+    keys = file_keys([path for path, _ in dataset.samples])
+    rows = cache.lookup(keys)
+    missing = np.nonzero(rows < 0)[0]
+    if len(missing) > 0:
+        print(f"Score cache: computing {len(missing)}/{len(keys)} missing entries")
+        subloader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, missing.tolist()), batch_size=dataloader.batch_size, num_workers=dataloader.num_workers, shuffle=False)
+        rows[missing] = cache.put([keys[i] for i in missing], compute_fn(subloader))
+    return cache.get(rows)
@@ -0,0 +1,258 @@
+import math
+from typing import Tuple
+
+import torch
+
+def squared_distances(queries:torch.Tensor, keys:torch.Tensor, keys_sqnorms:torch.Tensor=None) -> torch.Tensor:
+    '''
+    Computes the squared Euclidean distances between two sets of vectors as ||q||^2 + ||k||^2 - 2 q.k, i.e. with a single matrix multiplication
+    instead of materializing the N x K x D differences.
+
+    Parameters
+    ----------
+    queries: a torch.Tensor of shape (N, D).
+    keys: a torch.Tensor of shape (K, D).
+    keys_sqnorms: optionally, the precomputed squared norms of the keys (K).
+
+    Returns
+    -------
+    a torch.Tensor of shape (N, K).
+    '''
+    if keys_sqnorms is None:
+        keys_sqnorms = (keys**2).sum(1)
+    distances = torch.addmm(keys_sqnorms.unsqueeze(0), queries, keys.T, alpha=-2)
+    distances += (queries**2).sum(1, keepdim=True)
+    # the expansion may turn the distance of (nearly) coincident vectors slightly negative
+    return distances.clamp_(min=0)
+
+def kmeans(X:torch.Tensor, num_clusters:int, num_iters:int=20, seed:int=0) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Lloyd's k-means, initialized with num_clusters distinct datapoints drawn at random.
+
+    Returns
+    -------
+    a tuple (centers, assignments) with the centers (num_clusters x D) and the index of the closest center of each datapoint (N).
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    num_clusters = min(num_clusters, len(X))
+    centers = X[torch.randperm(len(X), generator=generator)[:num_clusters].to(X.device)].clone()
+    for _ in range(num_iters):
+        assignments = squared_distances(X, centers).argmin(1)
+        sums = torch.zeros_like(centers).index_add_(0, assignments, X)
+        counts = torch.bincount(assignments, minlength=num_clusters).unsqueeze(1)
+        # empty clusters keep their previous center
+        centers = torch.where(counts > 0, sums / counts.clamp(min=1), centers)
+    assignments = squared_distances(X, centers).argmin(1)
+    return centers, assignments
+
+class MiniBatchKMeans(object):
+    '''
+    Mini-batch k-means (Sculley, 2010) for datasets which do not fit in memory: partial_fit is called on successive chunks and each center moves
+    towards the mean of the datapoints assigned to it with a per-center learning rate of 1 / (number of datapoints assigned so far), i.e. it
+    is the running mean of its datapoints. The centers are initialized by k-means++ on the first chunk.
+
+    Attributes
+    ----------
+    num_clusters: the number of clusters.
+    centers: a torch.Tensor of shape (num_clusters, D), None before the first chunk.
+    counts: the number of datapoints assigned to each center so far.
+    '''
+    def __init__(self, num_clusters:int, seed:int=0):
+        self.num_clusters = num_clusters
+        self.generator = torch.Generator().manual_seed(seed)
+        self.centers = None
+        self.counts = None
+
+    def _init_centers(self, X:torch.Tensor):
+        # k-means++: each new center is drawn with probability proportional to the squared distance to the closest center drawn so far
+        centers = [X[torch.randint(len(X), (1,), generator=self.generator)]]
+        distances = squared_distances(X, centers[0])[:, 0]
+        for _ in range(1, min(self.num_clusters, len(X))):
+            centers.append(X[torch.multinomial(distances + 1e-12, 1, generator=self.generator)])
+            distances = torch.minimum(distances, squared_distances(X, centers[-1])[:, 0])
+        self.centers = torch.cat(centers)
+        self.counts = torch.zeros(len(self.centers))
+
+    def partial_fit(self, X:torch.Tensor) -> "MiniBatchKMeans":
+        X = X.float()
+        if self.centers is None:
+            self._init_centers(X)
+        assignments = squared_distances(X, self.centers).argmin(1)
+        batch_counts = torch.bincount(assignments, minlength=len(self.centers)).float()
+        batch_sums = torch.zeros_like(self.centers).index_add_(0, assignments, X)
+        self.counts += batch_counts
+        learning_rate = (batch_counts / self.counts.clamp(min=1)).unsqueeze(1)
+        self.centers += learning_rate * (batch_sums / batch_counts.clamp(min=1).unsqueeze(1) - self.centers)
+        return self
+
+    def predict(self, X:torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Returns the closest center (N) and the squared distance to it (N) of each datapoint.
+        '''
+        distances, assignments = squared_distances(X.float(), self.centers).min(1)
+        return assignments, distances
+
+def _merge_topk(distances:torch.Tensor, indices:torch.Tensor, k:int) -> Tuple[torch.Tensor, torch.Tensor]:
+    k = min(k, distances.shape[1])
+    distances, positions = distances.topk(k, dim=1, largest=False)
+    return distances, indices.gather(1, positions)
+
+class ExactIndex(torch.nn.Module):
+    '''
+    Exact nearest-centroid search: the squared distances are computed by a matrix multiplication against blocks of block_size centroids, keeping a
+    running top-k, so that memory stays bounded for any number of centroids.
+    Calling the index on a batch of embeddings returns the outlier scores (squared distance to the closest centroid), hence it can be passed to
+    ii_loss.eval functions in place of the mean embeddings.
+
+    Attributes
+    ----------
+    centroids: a torch.Tensor of shape (K, D), e.g. the mean embeddings of the trainset.
+    ids: the class index of each centroid (K). Defaults to range(K).
+    block_size: the number of centroids processed at once.
+    dtype: the dtype the centroids are stored in, e.g. torch.float16 to halve the memory of large galleries. Each block is converted to float32
+        for the distance computation.
+    '''
+    def __init__(self, centroids:torch.Tensor, ids:torch.Tensor=None, block_size:int=4096, dtype:torch.dtype=torch.float32):
+        super().__init__()
+        self.block_size = block_size
+        self.register_buffer("centroids", centroids.to(dtype))
+        self.register_buffer("sqnorms", (self.centroids.float()**2).sum(1))
+        self.register_buffer("ids", torch.arange(len(centroids)) if ids is None else torch.as_tensor(ids).long())
+
+    def _get_block_size(self, num_queries:int) -> int:
+        return self.block_size
+
+    def search(self, queries:torch.Tensor, k:int=1) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Returns the squared distances (N x k) and the ids (N x k) of the k closest centroids of each query, sorted by increasing distance.
+        '''
+        queries = queries.float()
+        best_distances = queries.new_empty(len(queries), 0)
+        best_indices = torch.empty(len(queries), 0, dtype=torch.long, device=queries.device)
+        block_size = self._get_block_size(len(queries))
+        for start in range(0, len(self.centroids), block_size):
+            block = slice(start, start + block_size)
+            # ||q||^2 does not change the ranking of the centroids of a query: it is added to the k best distances only
+            distances = torch.addmm(self.sqnorms[block].unsqueeze(0), queries, self.centroids[block].float().T, alpha=-2)
+            distances, indices = distances.topk(min(k, distances.shape[1]), dim=1, largest=False)
+            best_distances, best_indices = _merge_topk(torch.cat([best_distances, distances], 1), torch.cat([best_indices, indices + start], 1), k)
+        best_distances = (best_distances + (queries**2).sum(1, keepdim=True)).clamp_(min=0)
+        return best_distances, self.ids[best_indices]
+
+    def classify(self, queries:torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Returns the id of the closest centroid (N) and the outlier score (N) of each query.
+        '''
+        distances, ids = self.search(queries, 1)
+        return ids[:, 0], distances[:, 0]
+
+    def forward(self, embeddings:torch.Tensor) -> torch.Tensor:
+        return self.search(embeddings, 1)[0][:, 0]
+
+class IVFIndex(ExactIndex):
+    '''
+    Approximate nearest-centroid search with an inverted file: the centroids are clustered by k-means into num_lists lists and each query is only
+    compared with the centroids of its num_probes closest lists. The search is list-major: the queries probing a list are compared with its
+    members in a single matrix multiplication. Optionally, the centroids are stored as product-quantized (PQ) codes of their residuals from the
+    list center (num_subspaces bytes per centroid) and compared through per-query lookup tables; the rerank best candidates are then re-scored
+    exactly, so that the returned outlier scores are exact whenever the true nearest centroid is among them.
+    Recall grows with num_probes (all lists are probed with num_probes=num_lists) and rerank; see tune_num_probes.
+
+    Attributes
+    ----------
+    centroids, ids, block_size: see ExactIndex.
+    num_lists: the number of lists. Defaults to about sqrt(K).
+    num_probes: the number of lists probed by each query.
+    num_subspaces: if not None, the number of PQ subspaces (it must divide D); None compares the queries with the full centroids.
+    num_codes: the number of codes of each PQ subspace (at most 256).
+    rerank: the number of PQ candidates re-scored with the full centroids; 0 returns the approximate PQ distances.
+    num_iters: the number of k-means iterations used to build the lists and the PQ codebooks.
+    seed: the seed of the k-means initialization.
+    '''
+    def __init__(self, centroids:torch.Tensor, ids:torch.Tensor=None, num_lists:int=None, num_probes:int=8, num_subspaces:int=None, num_codes:int=256, rerank:int=16, num_iters:int=20, seed:int=0, block_size:int=4096):
+        super().__init__(centroids, ids, block_size)
+        if num_lists is None:
+            num_lists = max(1, round(math.sqrt(len(centroids))))
+        self.num_probes = num_probes
+        self.num_subspaces = num_subspaces
+        self.rerank = rerank
+        list_centers, assignments = kmeans(self.centroids.float(), num_lists, num_iters, seed)
+        self.register_buffer("list_centers", list_centers)
+        # the members of list l are list_members[list_offsets[l]:list_offsets[l+1]]
+        self.register_buffer("list_members", assignments.argsort(stable=True))
+        self.register_buffer("list_offsets", torch.cat([torch.zeros(1, dtype=torch.long, device=assignments.device), torch.bincount(assignments, minlength=len(list_centers)).cumsum(0)]))
+        self.register_buffer("codebooks", None)
+        self.register_buffer("codes", None)
+        if num_subspaces is not None:
+            assert self.centroids.shape[1] % num_subspaces == 0, f"The embedding dimension ({self.centroids.shape[1]}) must be divisible by num_subspaces ({num_subspaces})."
+            assert num_codes <= 256, "At most 256 codes per subspace are supported."
+            residuals = (self.centroids.float() - list_centers[assignments]).view(len(centroids), num_subspaces, -1)
+            codebooks, codes = zip(*[kmeans(residuals[:, m], num_codes, num_iters, seed) for m in range(num_subspaces)])
+            # subspaces may have fewer codes than num_codes if there are fewer centroids; the padding codes are never used
+            size = max(len(c) for c in codebooks)
+            self.codebooks = torch.stack([torch.cat([c, c.new_zeros((size - len(c), c.shape[1]))]) for c in codebooks])
+            self.codes = torch.stack(codes, 1).to(torch.uint8)
+
+    def _pq_distances(self, residuals:torch.Tensor, codes:torch.Tensor) -> torch.Tensor:
+        # lookup tables of the squared distances between each subspace of the query residuals and the codes, flattened to N x (S * C)
+        num_subspaces, num_codes = self.codebooks.shape[:2]
+        tables = (residuals.view(len(residuals), num_subspaces, 1, -1) - self.codebooks).pow(2).sum(3).flatten(1)
+        offsets = torch.arange(num_subspaces, device=codes.device) * num_codes
+        # N x M
+        return tables[:, codes.long() + offsets].sum(2)
+
+    def search(self, queries:torch.Tensor, k:int=1) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Returns the squared distances (N x k) and the ids (N x k) of the k closest centroids found for each query, sorted by increasing distance.
+        If fewer than k centroids lie in the probed lists, the missing entries have infinite distance and id -1.
+        '''
+        queries = queries.float()
+        num_probes = min(self.num_probes, len(self.list_centers))
+        probes = squared_distances(queries, self.list_centers).topk(num_probes, dim=1, largest=False).indices
+        keep = max(k, self.rerank) if self.codes is not None else k
+        # best candidates of each (query, probed list) pair
+        distances = queries.new_full((len(queries), num_probes, keep), float("inf"))
+        indices = torch.full((len(queries), num_probes, keep), -1, dtype=torch.long, device=queries.device)
+        for l in probes.unique().tolist():
+            members = self.list_members[self.list_offsets[l]:self.list_offsets[l+1]]
+            if len(members) == 0:
+                continue
+            query_indices, probe_indices = (probes == l).nonzero(as_tuple=True)
+            if self.codes is None:
+                list_distances = squared_distances(queries[query_indices], self.centroids[members].float(), self.sqnorms[members])
+            else:
+                list_distances = self._pq_distances(queries[query_indices] - self.list_centers[l], self.codes[members])
+            list_distances, positions = list_distances.topk(min(keep, len(members)), dim=1, largest=False)
+            distances[query_indices, probe_indices, :positions.shape[1]] = list_distances
+            indices[query_indices, probe_indices, :positions.shape[1]] = members[positions]
+        distances, indices = _merge_topk(distances.flatten(1), indices.flatten(1), keep)
+        if self.codes is not None and self.rerank > 0:
+            exact = (queries.unsqueeze(1) - self.centroids[indices.clamp(min=0)].float()).pow(2).sum(2)
+            distances = torch.where(indices >= 0, exact, distances)
+        distances, indices = _merge_topk(distances, indices, k)
+        ids = torch.where(indices >= 0, self.ids[indices.clamp(min=0)], indices)
+        return distances, ids
+
+def recall_at_k(ids:torch.Tensor, reference_ids:torch.Tensor) -> float:
+    '''
+    Returns the fraction of the reference (e.g., exact) k nearest ids found among the approximate ones, averaged over the queries.
+    '''
+    found = (ids.unsqueeze(2) == reference_ids.unsqueeze(1)).any(1)
+    return found.float().mean().item()
+
+def tune_num_probes(index:IVFIndex, queries:torch.Tensor, target_recall:float=0.95, k:int=1) -> float:
+    '''
+    Sets index.num_probes to the smallest power of 2 (or to the number of lists) reaching target_recall@k against the exact search on a sample of queries.
+
+    Returns
+    -------
+    the recall reached.
+    '''
+    _, reference_ids = ExactIndex.search(index, queries, k)
+    num_probes = 1
+    while True:
+        index.num_probes = min(num_probes, len(index.list_centers))
+        recall = recall_at_k(index.search(queries, k)[1], reference_ids)
+        if recall >= target_recall or index.num_probes == len(index.list_centers):
+            return recall
+        num_probes *= 2
@@ -0,0 +1,132 @@
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import torch
+from tqdm import tqdm
+
+from . import parallel, search
+
+def penultimate(model:torch.nn.Module) -> torch.nn.Module:
+    '''
+    Removes the classification layer of a torchvision ResNet (e.g., from cnn.models.get_model), so that it returns the penultimate features.
+    '''
+    model.fc = torch.nn.Identity()
+    return model
+
+def _compute_embeddings(model:torch.nn.Module, X:torch.Tensor):
+    outputs = model(X)
+    # models trained with II-loss return (embeddings, logits)
+    return {"embeddings": outputs[0] if isinstance(outputs, tuple) else outputs}
+
+def compute_embeddings(model:torch.nn.Module, dataset:torch.utils.data.Dataset, device:torch.device, batch_size:int=128, num_procs:int=1, out_dir:str=None) -> torch.Tensor:
+    '''
+    Embeds every image of a dataset with a model returning either (embeddings, logits), as ResNetCustom, or the features (see penultimate).
+    If num_procs is not 1, the dataset is embedded on the CPU by num_procs processes (0 to choose automatically) with parallel.run_sharded,
+    the embeddings being written to out_dir.
+
+    Returns
+    -------
+    a torch.Tensor of shape (N, D), in the order of the dataset.
+    '''
+    if num_procs != 1:
+        return parallel.run_sharded(model, dataset, _compute_embeddings, batch_size=batch_size, num_procs=num_procs or None, out_dir=out_dir)["embeddings"]
+    model.to(device)
+    model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for X, _ in tqdm(torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=4)):
+            embeddings.append(_compute_embeddings(model, X.to(device))["embeddings"].cpu())
+    return torch.cat(embeddings)
+
+def all_pairs_topk(embeddings:torch.Tensor, k:int=10, metric:str="cosine", row_block_size:int=4096, col_block_size:int=16384, exclude_self:bool=True) -> Tuple[torch.Tensor, torch.Tensor]:
+    '''
+    Finds the k most similar embeddings of every embedding without materializing the N x N similarity matrix: the rows are processed in blocks
+    of row_block_size, each compared with blocks of col_block_size columns by a matrix multiplication, retaining a running top-k per row.
+    The memory is O(row_block_size x col_block_size + N x k).
+
+    Parameters
+    ----------
+    embeddings: a torch.Tensor of shape (N, D).
+    k: the number of neighbours retained per row.
+    metric: "cosine" (cosine similarity) or "euclidean" (negative squared Euclidean distance, e.g. for II-loss embeddings).
+    row_block_size: the number of rows processed at once.
+    col_block_size: the number of columns compared with a block of rows at once.
+    exclude_self: whether to exclude each embedding from its own neighbours.
+
+    Returns
+    -------
+    a tuple (similarities, indices) of tensors of shape (N, k), sorted by decreasing similarity.
+    '''
+    assert metric in ("cosine", "euclidean"), f"Unknown metric {metric}"
+    X = embeddings.float()
+    if metric == "cosine":
+        X = torch.nn.functional.normalize(X, dim=1)
+    index = search.ExactIndex(X, block_size=col_block_size)
+    num_neighbours = min(k + int(exclude_self), len(X))
+    similarities, indices = [], []
+    for start in tqdm(range(0, len(X), row_block_size)):
+        distances, neighbours = index.search(X[start:start+row_block_size], num_neighbours)
+        if exclude_self:
+            rows = torch.arange(start, start + len(neighbours)).unsqueeze(1)
+            distances = distances.masked_fill(neighbours == rows, float("inf"))
+            distances, positions = distances.topk(min(k, len(X) - 1), dim=1, largest=False)
+            neighbours = neighbours.gather(1, positions)
+        # for unit vectors, the squared distance is 2 - 2 * cosine similarity
+        similarities.append(1 - distances / 2 if metric == "cosine" else -distances)
+        indices.append(neighbours)
+    return torch.cat(similarities), torch.cat(indices)
+
+def knn_graph(similarities:torch.Tensor, indices:torch.Tensor) -> scipy.sparse.csr_matrix:
+    '''
+    Builds the sparse (N x N) directed k-nearest-neighbour graph whose row i holds the similarities of the neighbours of embedding i.
+    '''
+    num_items, k = indices.shape
+    rows = np.repeat(np.arange(num_items), k)
+    return scipy.sparse.csr_matrix((similarities.numpy().ravel(), (rows, indices.numpy().ravel())), shape=(num_items, num_items))
+
+def aggregate_by_group(similarities:torch.Tensor, indices:torch.Tensor, groups:np.ndarray, group_names:List[str]=None) -> pd.DataFrame:
+    '''
+    Aggregates the k-nearest-neighbour edges between the embeddings into edges between their groups (e.g., the paintings the crops come from).
+    The edges within a group are discarded and the edges between two groups are counted in both directions.
+
+    Parameters
+    ----------
+    similarities, indices: the output of all_pairs_topk.
+    groups: the group index of each embedding (N).
+    group_names: optionally, the name of each group index.
+
+    Returns
+    -------
+    a pandas.DataFrame with a row per pair of linked groups ("group_a", "group_b"), with the number of edges ("num_edges"), the number of distinct
+    embeddings involved ("num_items"), the fraction of the edges of the two groups linking them ("edge_fraction"), and the mean and max similarity
+    of the edges, sorted by decreasing number of edges.
+    '''
+    num_items, k = indices.shape
+    groups = np.asarray(groups)
+    source = np.repeat(np.arange(num_items), k)
+    target = indices.numpy().ravel()
+    edges = pd.DataFrame({
+        "source": source,
+        "target": target,
+        "group_source": groups[source],
+        "group_target": groups[target],
+        "similarity": similarities.numpy().ravel(),
+    })
+    edges = edges[edges["group_source"] != edges["group_target"]]
+    # undirected pairs of groups
+    edges["group_a"] = np.minimum(edges["group_source"], edges["group_target"])
+    edges["group_b"] = np.maximum(edges["group_source"], edges["group_target"])
+    grouped = edges.groupby(["group_a", "group_b"])
+    aggregated = grouped["similarity"].agg(num_edges="size", mean_similarity="mean", max_similarity="max").reset_index()
+    items = pd.concat([edges[["group_a", "group_b", "source"]].rename(columns={"source": "item"}), edges[["group_a", "group_b", "target"]].rename(columns={"target": "item"})])
+    num_items = items.drop_duplicates().groupby(["group_a", "group_b"]).size()
+    aggregated["num_items"] = num_items.loc[list(zip(aggregated["group_a"], aggregated["group_b"]))].values
+    group_sizes = np.bincount(groups)
+    aggregated["edge_fraction"] = aggregated["num_edges"] / (k * (group_sizes[aggregated["group_a"]] + group_sizes[aggregated["group_b"]]))
+    if group_names is not None:
+        aggregated["group_a"] = [group_names[g] for g in aggregated["group_a"]]
+        aggregated["group_b"] = [group_names[g] for g in aggregated["group_b"]]
+    columns = ["group_a", "group_b", "num_edges", "num_items", "edge_fraction", "mean_similarity", "max_similarity"]
+    return aggregated[columns].sort_values("num_edges", ascending=False, ignore_index=True)
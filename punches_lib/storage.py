@@ -0,0 +1,354 @@
+import json
+import os
+from typing import Dict, List, Sequence
+
+import numpy as np
+import torch
+
+TEXT = "text"
+CATEGORY = "category"
+
+def _write_json_atomic(obj, path:str):
+    '''
+    Writes a JSON file by first dumping it to a temporary file and then replacing the target, so that readers never see a partially written file.
+    '''
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+class ColumnStore(object):
+    '''
+    An append-only columnar store backed by a directory containing one flat binary file per column and a meta.json file.
+    Numeric columns are stored as raw arrays and can be memory-mapped; "category" columns are dictionary-encoded as int32 codes;
+    "text" columns are stored as newline-separated UTF-8 strings.
+    The number of committed rows is kept in meta.json, which is replaced atomically after each append: data written past the committed
+    size (e.g., by an interrupted append) is ignored by readers and overwritten by the next append.
+
+    Attributes
+    ----------
+    root: the directory containing the store.
+    meta: a dict with the schema, the number of committed rows, the category vocabularies and the size of the text columns.
+    '''
+    def __init__(self, root:str, schema:Dict[str, dict]=None):
+        '''
+        Parameters
+        ----------
+        root: the directory containing the store. Will be created if it does not exist.
+        schema: a dict mapping column names to dicts with keys "dtype" (a numpy dtype string, "category" or "text") and, for numeric columns, optionally "shape" (the shape of a single row). If None, the store must already exist on disk.
+        '''
+        self.root = root
+        self._meta_path = os.path.join(root, "meta.json")
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.meta = json.load(f)
+            if schema is not None and self._normalize_schema(schema) != self.meta["schema"]:
+                raise ValueError(f"The schema of the store at {root} does not match the requested one.")
+        else:
+            if schema is None:
+                raise FileNotFoundError(f"No store found at {root} and no schema was provided to create one.")
+            os.makedirs(root, exist_ok=True)
+            schema = self._normalize_schema(schema)
+            self.meta = {
+                "schema": schema,
+                "num_rows": 0,
+                "categories": {name: [] for name, spec in schema.items() if spec["dtype"] == CATEGORY},
+                "text_bytes": {name: 0 for name, spec in schema.items() if spec["dtype"] == TEXT},
+            }
+            _write_json_atomic(self.meta, self._meta_path)
+
+    @staticmethod
+    def _normalize_schema(schema:Dict[str, dict]) -> Dict[str, dict]:
+        normalized = {}
+        for name, spec in schema.items():
+            dtype = spec["dtype"]
+            if dtype not in (TEXT, CATEGORY):
+                dtype = np.dtype(dtype).str
+            normalized[name] = {"dtype": dtype, "shape": list(spec.get("shape", []))}
+        return normalized
+
+    def __len__(self):
+        return self.meta["num_rows"]
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.meta["schema"].keys())
+
+    def _column_path(self, name:str) -> str:
+        extension = "txt" if self.meta["schema"][name]["dtype"] == TEXT else "bin"
+        return os.path.join(self.root, f"{name}.{extension}")
+
+    def _numeric_spec(self, name:str):
+        spec = self.meta["schema"][name]
+        dtype = np.dtype("int32") if spec["dtype"] == CATEGORY else np.dtype(spec["dtype"])
+        return dtype, tuple(spec["shape"])
+
+    @staticmethod
+    def _write_at(path:str, offset:int, payload:bytes):
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(payload)
+
+    def append(self, columns:Dict[str, Sequence]):
+        '''
+        Appends a block of rows to the store.
+
+        Parameters
+        ----------
+        columns: a dict mapping every column name of the schema to a sequence of values (all of the same length).
+        '''
+        missing = set(self.meta["schema"]).difference(columns)
+        assert len(missing) == 0, f"Missing values for columns {sorted(missing)}"
+        lengths = {name: len(values) for name, values in columns.items()}
+        num_new = lengths[self.columns[0]]
+        assert all(l == num_new for l in lengths.values()), f"All columns must have the same number of rows, got {lengths}"
+        if num_new == 0:
+            return
+
+        num_rows = self.meta["num_rows"]
+        for name, spec in self.meta["schema"].items():
+            values = columns[name]
+            path = self._column_path(name)
+            if spec["dtype"] == TEXT:
+                values = [str(v) for v in values]
+                assert not any("\n" in v for v in values), f"Values of text column {name} cannot contain newlines"
+                payload = "".join(v + "\n" for v in values).encode("utf-8")
+                self._write_at(path, self.meta["text_bytes"][name], payload)
+                self.meta["text_bytes"][name] += len(payload)
+                continue
+            if spec["dtype"] == CATEGORY:
+                vocabulary = self.meta["categories"][name]
+                codes = {v: i for i, v in enumerate(vocabulary)}
+                for v in values:
+                    if str(v) not in codes:
+                        codes[str(v)] = len(vocabulary)
+                        vocabulary.append(str(v))
+                values = [codes[str(v)] for v in values]
+            dtype, shape = self._numeric_spec(name)
+            array = np.ascontiguousarray(np.asarray(values, dtype=dtype).reshape((num_new,) + shape))
+            row_bytes = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+            self._write_at(path, num_rows * row_bytes, array.tobytes())
+
+        self.meta["num_rows"] = num_rows + num_new
+        _write_json_atomic(self.meta, self._meta_path)
+
+    def add_columns(self, schema:Dict[str, dict], fill_value=-1):
+        '''
+        Adds numeric columns to the store, filled with fill_value for the rows already committed (e.g., to migrate a store to a newer schema).
+
+        Parameters
+        ----------
+        schema: a dict mapping the names of the new columns to their specs (see __init__).
+        fill_value: the value of the new columns in the existing rows.
+        '''
+        for name, spec in self._normalize_schema(schema).items():
+            assert name not in self.meta["schema"], f"Column {name} already exists"
+            assert spec["dtype"] not in (TEXT, CATEGORY), "Only numeric columns can be added"
+            self.meta["schema"][name] = spec
+            dtype, shape = self._numeric_spec(name)
+            self._write_at(self._column_path(name), 0, np.full((len(self),) + shape, fill_value, dtype=dtype).tobytes())
+        _write_json_atomic(self.meta, self._meta_path)
+
+    def codes(self, name:str) -> np.ndarray:
+        '''
+        Returns a read-only memory map over the int32 codes of a category column.
+        '''
+        assert self.meta["schema"][name]["dtype"] == CATEGORY, f"Column {name} is not a category column"
+        return self._memmap(name)
+
+    def categories(self, name:str) -> List[str]:
+        '''
+        Returns the vocabulary of a category column: the value of code i is categories(name)[i].
+        '''
+        return list(self.meta["categories"][name])
+
+    def _memmap(self, name:str) -> np.ndarray:
+        dtype, shape = self._numeric_spec(name)
+        if len(self) == 0:
+            return np.empty((0,) + shape, dtype=dtype)
+        return np.memmap(self._column_path(name), dtype=dtype, mode="r", shape=(len(self),) + shape)
+
+    def column(self, name:str):
+        '''
+        Returns the content of a column.
+        Numeric columns are returned as read-only memory maps, category columns as numpy arrays of strings and text columns as lists of strings.
+        '''
+        dtype = self.meta["schema"][name]["dtype"]
+        if dtype == TEXT:
+            if len(self) == 0:
+                return []
+            with open(self._column_path(name), "rb") as f:
+                payload = f.read(self.meta["text_bytes"][name])
+            return payload.decode("utf-8").split("\n")[:-1]
+        if dtype == CATEGORY:
+            return np.asarray(self.categories(name), dtype=object)[self.codes(name)]
+        return self._memmap(name)
+
+    def take(self, rows:np.ndarray, columns:Sequence[str]=None) -> Dict[str, np.ndarray]:
+        '''
+        Returns the values of the given columns at the given rows.
+
+        Parameters
+        ----------
+        rows: an array of row indices.
+        columns: the names of the columns to return. If None, all columns are returned.
+
+        Returns
+        -------
+        a dict mapping column names to numpy arrays (arrays of strings for category and text columns).
+        '''
+        columns = self.columns if columns is None else columns
+        result = {}
+        for name in columns:
+            dtype = self.meta["schema"][name]["dtype"]
+            if dtype == TEXT:
+                result[name] = np.asarray(self.column(name), dtype=object)[rows]
+            elif dtype == CATEGORY:
+                result[name] = np.asarray(self.categories(name), dtype=object)[self.codes(name)[rows]]
+            else:
+                result[name] = np.asarray(self._memmap(name)[rows])
+        return result
+
+    def where(self, chunk_rows:int=1<<20, **conditions) -> np.ndarray:
+        '''
+        Returns the indices of the rows satisfying all the given conditions.
+        The columns involved are scanned through their memory maps in chunks of chunk_rows rows, so that the store is never loaded as a whole.
+
+        Parameters
+        ----------
+        chunk_rows: the number of rows scanned at once.
+        conditions: column=value or column=[values] pairs; a row satisfies a condition if its value is equal to (one of) the value(s). Only numeric and category columns can be used.
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        for name, values in conditions.items():
+            values = list(values) if isinstance(values, (list, tuple, set)) else [values]
+            dtype = self.meta["schema"][name]["dtype"]
+            if dtype == TEXT:
+                raise ValueError(f"Cannot filter on text column {name}")
+            if dtype == CATEGORY:
+                vocabulary = self.categories(name)
+                values = [vocabulary.index(v) for v in values if v in vocabulary]
+                column = self.codes(name)
+            else:
+                column = self._memmap(name)
+            for start in range(0, len(self), chunk_rows):
+                mask[start:start+chunk_rows] &= np.isin(column[start:start+chunk_rows], values)
+        return np.nonzero(mask)[0]
+
+    def select(self, columns:Sequence[str]=None, **conditions) -> Dict[str, np.ndarray]:
+        '''
+        Returns the given columns for the rows satisfying the conditions (see where), e.g. store.select(["outlier_score"], split="valid").
+        '''
+        return self.take(self.where(**conditions), columns)
+
+
+SCORE_SCHEMA = {
+    "split": {"dtype": CATEGORY},
+    "path": {"dtype": TEXT},
+    "size": {"dtype": "int64"},
+    "mtime": {"dtype": "int64"},
+    "label": {"dtype": "int64"},
+    "pred": {"dtype": "int64"},
+    "outlier_score": {"dtype": "float32"},
+    "disc_score": {"dtype": "float32"},
+    "model": {"dtype": CATEGORY},
+}
+
+class ScoreStore(ColumnStore):
+    '''
+    A ColumnStore holding one row per scored image, with the columns of SCORE_SCHEMA.
+    Missing labels and predictions are stored as -1, missing scores as NaN, unknown file sizes and mtimes (e.g., of placeholder paths) as -1.
+    A file modified since it was scored is appended again: readers use the most recent row of each path (see latest).
+    '''
+    def __init__(self, root:str):
+        if os.path.exists(os.path.join(root, "meta.json")):
+            store = ColumnStore(root)
+            missing = {name: spec for name, spec in SCORE_SCHEMA.items() if name not in store.columns}
+            if len(missing) > 0:
+                # stores written before the file sizes and mtimes were recorded: their rows are treated as of unknown version
+                store.add_columns(missing, fill_value=-1)
+        super().__init__(root, SCORE_SCHEMA)
+
+    def append_scores(self, split:str, paths:Sequence[str], model_id:str, labels=None, preds=None, outlier_scores=None, disc_scores=None, sizes=None, mtimes=None):
+        '''
+        Appends the scores of a batch of images belonging to the same split and scored by the same model(s).
+
+        Parameters
+        ----------
+        split: the name of the split (e.g., "valid", "crops", "ood").
+        paths: a sequence of N file paths.
+        model_id: a string identifying the model(s) which produced the scores.
+        labels: a sequence of N ground-truth class indices. If None, will be stored as -1.
+        preds: a sequence of N predicted class indices. If None, will be stored as -1.
+        outlier_scores: a sequence of N II-loss outlier scores. If None, will be stored as NaN.
+        disc_scores: a sequence of N OpenGAN discriminator outputs. If None, will be stored as NaN.
+        sizes, mtimes: sequences of N file sizes (bytes) and mtimes (ns) of the scored files, e.g. from score_cache.file_keys taken before scoring.
+            If None, the files are looked up now (-1 for the paths which do not exist).
+        '''
+        n = len(paths)
+        def _or_default(values, default):
+            return np.full(n, default) if values is None else np.asarray(values).reshape(n)
+        if sizes is None or mtimes is None:
+            stats = [os.stat(path) if os.path.exists(path) else None for path in paths]
+            sizes = [stat.st_size if stat is not None else -1 for stat in stats]
+            mtimes = [stat.st_mtime_ns if stat is not None else -1 for stat in stats]
+        self.append({
+            "split": [split] * n,
+            "path": list(paths),
+            "size": _or_default(sizes, -1),
+            "mtime": _or_default(mtimes, -1),
+            "label": _or_default(labels, -1),
+            "pred": _or_default(preds, -1),
+            "outlier_score": _or_default(outlier_scores, np.nan),
+            "disc_score": _or_default(disc_scores, np.nan),
+            "model": [model_id] * n,
+        })
+
+    def latest(self, rows:np.ndarray) -> np.ndarray:
+        '''
+        Returns, among the given (increasing) rows, the most recent row of each path, in increasing order.
+        '''
+        paths = self.take(rows, ["path"])["path"]
+        _, last = np.unique(paths[::-1], return_index=True)
+        return rows[np.sort(len(rows) - 1 - last)]
+
+    def scores(self, split:str, column:str="outlier_score", model:str=None) -> torch.Tensor:
+        '''
+        Returns the scores of a split as a tensor, in the order in which they were appended. Files scored more than once only count with their most recent row.
+
+        Parameters
+        ----------
+        split: the name of the split.
+        column: the score column, "outlier_score" or "disc_score".
+        model: the model identifier. If None, the store must contain a single model.
+        '''
+        if model is None:
+            models = self.categories("model")
+            assert len(models) <= 1, f"The store contains scores for several models ({models}): please specify one."
+            conditions = {"split": split}
+        else:
+            conditions = {"split": split, "model": model}
+        return torch.from_numpy(self.take(self.latest(self.where(**conditions)), [column])[column])
+
+    def paths(self, split:str, model:str) -> set:
+        '''
+        Returns the set of paths already scored for a split by a model.
+        '''
+        return set(self.select(["path"], split=split, model=model)["path"])
+
+    def file_keys(self, split:str, model:str) -> set:
+        '''
+        Returns the set of keys (path, size, mtime) of the files already scored for a split by a model, comparable with score_cache.file_keys:
+        a file modified since it was scored has a different key.
+        '''
+        selected = self.select(["path", "size", "mtime"], split=split, model=model)
+        return set(zip(selected["path"], selected["size"].tolist(), selected["mtime"].tolist()))
+
+    def import_tensor(self, path:str, split:str, model_id:str, column:str="outlier_score"):
+        '''
+        Imports the scores saved as a bare tensor (e.g., by a previous version of ii_outscores.py) under the given split.
+        As the tensor carries no file paths, the rows get the placeholder paths "<split>/<index>".
+        '''
+        scores = torch.load(path, map_location="cpu").reshape(-1)
+        self.append_scores(split, [f"{split}/{i}" for i in range(len(scores))], model_id, **{column + "s": scores})
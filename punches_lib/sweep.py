@@ -0,0 +1,413 @@
+import itertools
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Collection, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+import torchvision
+
+from . import metrics, parallel, utils
+from .gan import architecture, data as gan_data, train as gan_train
+from .ii_loss import eval as eval_ii, ii_loss, models, train as train_ii
+from .radam import RAdam
+
+# values of the hyperparameters which are not part of the search space, as in the defaults of main_ii.py and main_gan.py
+II_LOSS_DEFAULTS = {"lr": 0.001, "lambda_ii": 1.0, "delta_ii": float("inf"), "dim_latent": 32}
+OPENGAN_DEFAULTS = {"lr": 0.0001, "lr_modifier_D": 0.2, "label_smoothing": 0.15, "base_width": 64}
+
+def _parse_value(text:str):
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+def parse_space(specs:Collection[str]) -> Dict[str, tuple]:
+    '''
+    Parses a search space from strings name=choice:v1,v2,..., name=uniform:low:high, name=loguniform:low:high or name=int:low:high
+    (e.g., "lr=loguniform:1e-4:1e-2", "delta_ii=choice:0.5,1,inf").
+
+    Returns
+    -------
+    a dict mapping each name to ("choice", [values]) or (kind, low, high).
+    '''
+    space = {}
+    for spec in specs:
+        name, distribution = spec.split("=", 1)
+        kind, *bounds = distribution.split(":")
+        if kind == "choice":
+            space[name] = ("choice", [_parse_value(v) for v in bounds[0].split(",")])
+        else:
+            assert kind in ("uniform", "loguniform", "int") and len(bounds) == 2, f"Invalid search space {spec}"
+            cast = int if kind == "int" else float
+            space[name] = (kind, cast(bounds[0]), cast(bounds[1]))
+    return space
+
+def grid_configs(space:Dict[str, tuple]) -> List[dict]:
+    '''
+    Returns all the combinations of the values of a search space made of "choice" and "int" dimensions.
+    '''
+    values = {}
+    for name, (kind, *args) in space.items():
+        assert kind in ("choice", "int"), f"A grid search needs discrete values, {name} is {kind}"
+        values[name] = args[0] if kind == "choice" else list(range(args[0], args[1] + 1))
+    return [dict(zip(values, combination)) for combination in itertools.product(*values.values())]
+
+def _to_unit(distribution:tuple, value:float) -> float:
+    # continuous dimensions are modelled in [0, 1], on a log scale for loguniform
+    kind, low, high = distribution
+    if kind == "loguniform":
+        return (math.log(value) - math.log(low)) / (math.log(high) - math.log(low))
+    return (value - low) / (high - low) if high > low else 0.0
+
+def _from_unit(distribution:tuple, u:float):
+    kind, low, high = distribution
+    u = min(max(u, 0.0), 1.0)
+    if kind == "loguniform":
+        return math.exp(math.log(low) + u * (math.log(high) - math.log(low)))
+    if kind == "int":
+        return int(round(low + u * (high - low)))
+    return low + u * (high - low)
+
+def sample_config(space:Dict[str, tuple], rng:np.random.Generator) -> dict:
+    '''
+    Draws a configuration uniformly from the search space (log-uniformly for loguniform dimensions).
+    '''
+    return {name: distribution[1][rng.integers(len(distribution[1]))] if distribution[0] == "choice" else _from_unit(distribution, rng.random())
+            for name, distribution in space.items()}
+
+class _Parzen(object):
+    '''
+    The density of one dimension of the search space estimated from the values of a set of trials, mixed with the uniform prior
+    (which keeps it positive everywhere): counts smoothed by one for "choice" dimensions, Gaussian kernels in [0, 1] otherwise.
+    '''
+    def __init__(self, distribution:tuple, values:list):
+        self.distribution = distribution
+        if distribution[0] == "choice":
+            counts = np.ones(len(distribution[1]))
+            for value in values:
+                counts[distribution[1].index(value)] += 1
+            self.probs = counts / counts.sum()
+        else:
+            self.points = np.array([_to_unit(distribution, v) for v in values])
+            # Scott's rule, with a floor so that a few identical values do not collapse the kernels
+            self.bandwidth = max(1.06 * self.points.std() * len(self.points) ** -0.2, 0.05) if len(self.points) > 0 else 1.0
+
+    def sample(self, rng:np.random.Generator):
+        if self.distribution[0] == "choice":
+            return self.distribution[1][rng.choice(len(self.probs), p=self.probs)]
+        component = rng.integers(len(self.points) + 1)
+        u = rng.random() if component == len(self.points) else rng.normal(self.points[component], self.bandwidth)
+        # reflected at the bounds, so that the kernels of values close to a bound do not pile up on it
+        u = abs(u) % 2
+        return _from_unit(self.distribution, 2 - u if u > 1 else u)
+
+    def log_density(self, value) -> float:
+        if self.distribution[0] == "choice":
+            return math.log(self.probs[self.distribution[1].index(value)])
+        u = _to_unit(self.distribution, value)
+        kernels = np.exp(-0.5 * ((u - self.points) / self.bandwidth) ** 2) / (self.bandwidth * math.sqrt(2 * math.pi))
+        return math.log((1.0 + kernels.sum()) / (len(self.points) + 1))
+
+def suggest_tpe(space:Dict[str, tuple], observations:List[Tuple[dict, float]], rng:np.random.Generator, num_candidates:int=64, gamma:float=0.25) -> dict:
+    '''
+    Suggests a configuration with the Tree-structured Parzen Estimator: the observed trials are split into the best gamma fraction and
+    the rest, the density of each dimension is estimated on both groups (independently per dimension), and among num_candidates
+    configurations drawn from the density of the best trials, the one maximizing the ratio between the two densities is returned.
+
+    Parameters
+    ----------
+    space: the search space (see parse_space).
+    observations: (configuration, score) pairs of the trials evaluated so far, higher scores being better (NaN for failed trials).
+    rng: a numpy random Generator.
+    num_candidates: the number of candidates compared.
+    gamma: the fraction of the observations considered good.
+    '''
+    scores = np.array([score for _, score in observations], dtype=float)
+    order = np.argsort(-np.nan_to_num(scores, nan=-np.inf), kind="stable")
+    num_good = max(1, int(math.ceil(gamma * len(observations))))
+    good = [observations[i][0] for i in order[:num_good]]
+    bad = [observations[i][0] for i in order[num_good:]]
+    densities = {name: (_Parzen(distribution, [c[name] for c in good]), _Parzen(distribution, [c[name] for c in bad]))
+                 for name, distribution in space.items()}
+    best, best_ratio = None, -float("inf")
+    for _ in range(num_candidates):
+        candidate = {name: good_density.sample(rng) for name, (good_density, _) in densities.items()}
+        ratio = sum(good_density.log_density(candidate[name]) - bad_density.log_density(candidate[name])
+                    for name, (good_density, bad_density) in densities.items())
+        if ratio > best_ratio:
+            best, best_ratio = candidate, ratio
+    return best
+
+def rung_budgets(min_budget:int, max_budget:int, eta:int=3) -> List[int]:
+    '''
+    Returns the budgets (e.g., numbers of epochs) of the rungs of successive halving, increasing by a factor eta from min_budget up to
+    max_budget, e.g. [2, 6, 18] for min_budget=2, max_budget=18, eta=3.
+    '''
+    num_rungs = int(math.floor(math.log(max_budget / min_budget, eta) + 1e-9)) + 1
+    return [max(1, int(round(max_budget / eta ** (num_rungs - 1 - rung)))) for rung in range(num_rungs)]
+
+def _run_trial(objective:Callable, config:dict, budget:int, trial_dir:str, num_threads:int) -> Tuple[float, float]:
+    num_threads_before = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    os.makedirs(trial_dir, exist_ok=True)
+    start = time.perf_counter()
+    try:
+        score = objective(config, budget, trial_dir)
+    finally:
+        torch.set_num_threads(num_threads_before)
+    return float(score), time.perf_counter() - start
+
+def _evaluate(executor:ProcessPoolExecutor, objective:Callable, configs:Dict[int, dict], budget:int, out_dir:str, num_threads:int) -> Dict[int, Tuple[float, float]]:
+    # the trials of a rung run concurrently; a failed trial gets a NaN score and is not promoted
+    calls = {trial: (objective, config, budget, os.path.join(out_dir, f"trial_{trial}"), num_threads) for trial, config in configs.items()}
+    futures = {trial: executor.submit(_run_trial, *args) for trial, args in calls.items()} if executor is not None else {}
+    outcomes = {}
+    for trial, args in calls.items():
+        try:
+            outcomes[trial] = futures[trial].result() if executor is not None else _run_trial(*args)
+        except Exception as e:
+            print(f"Trial {trial} failed: {e!r}")
+            outcomes[trial] = (float("nan"), float("nan"))
+    return outcomes
+
+def _observations(results:List[dict], space:Dict[str, tuple], min_observations:int) -> List[Tuple[dict, float]]:
+    # as in BOHB, the model is fitted on the largest budget with enough evaluations
+    for budget in sorted({row["epochs"] for row in results}, reverse=True):
+        rows = [row for row in results if row["epochs"] == budget]
+        if len(rows) >= min_observations:
+            return [({name: row[name] for name in space}, row["score"]) for row in rows]
+    return []
+
+def run_sweep(objective:Callable, space:Dict[str, tuple], method:str="random", num_trials:int=16, fixed:dict=None, min_budget:int=1, max_budget:int=9, eta:int=3,
+              num_rounds:int=1, num_procs:int=1, num_threads:int=None, out_dir:str="sweep", seed:int=0) -> pd.DataFrame:
+    '''
+    Runs a hyperparameter sweep with successive halving: every trial of a round is trained for the smallest budget, the best 1/eta of them
+    are trained further (resuming from their checkpoint) up to the next budget, and so on up to max_budget (see rung_budgets). The trials of
+    a rung are run concurrently by num_procs processes with num_threads threads each.
+
+    Parameters
+    ----------
+    objective: a picklable function (config, budget, trial_dir) -> score, higher being better, e.g. ii_loss_objective or opengan_objective.
+        It is called with increasing budgets for the same trial_dir, so it can resume from a checkpoint saved there.
+    space: the search space (see parse_space).
+    method: "grid" (all the combinations of the values), "random" (num_trials configurations drawn uniformly) or "bayes" (num_trials
+        configurations suggested with suggest_tpe, split into num_rounds rounds; the first round is random).
+    num_trials: the number of configurations, for "random" and "bayes".
+    fixed: the arguments of the objective which are not searched (e.g., the paths of the caches).
+    min_budget, max_budget, eta: the budgets of successive halving. If min_budget == max_budget, every trial runs for the full budget.
+    num_rounds: the number of rounds of "bayes", each one running successive halving over num_trials / num_rounds new configurations.
+    num_procs: the number of processes running the trials.
+    num_threads: the number of threads per trial. If None, the cores are split evenly among the processes.
+    out_dir: the folder of the trials (trial_<i>) and of the results table (results.csv).
+    seed: the seed of the sampling of the configurations.
+
+    Returns
+    -------
+    a pandas DataFrame with one row per evaluation (trial, round, rung, epochs, hyperparameters, score, seconds).
+    '''
+    assert method in ("grid", "random", "bayes"), f"Unknown method {method}"
+    rng = np.random.default_rng(seed)
+    fixed = fixed or {}
+    budgets = rung_budgets(min_budget, max_budget, eta)
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // num_procs)
+    if method == "grid":
+        round_sizes = [len(grid_configs(space))]
+    else:
+        num_rounds = num_rounds if method == "bayes" else 1
+        round_sizes = [num_trials // num_rounds + (1 if r < num_trials % num_rounds else 0) for r in range(num_rounds)]
+    os.makedirs(out_dir, exist_ok=True)
+
+    results = []
+    num_configs = 0
+    executor = ProcessPoolExecutor(max_workers=num_procs, mp_context=mp.get_context("spawn")) if num_procs > 1 else None
+    try:
+        for round_idx, round_size in enumerate(round_sizes):
+            if method == "grid":
+                configs = grid_configs(space)
+            elif method == "bayes" and (observations := _observations(results, space, len(space) + 1)):
+                configs = [suggest_tpe(space, observations, rng) for _ in range(round_size)]
+            else:
+                configs = [sample_config(space, rng) for _ in range(round_size)]
+            configs = {num_configs + i: config for i, config in enumerate(configs)}
+            num_configs += len(configs)
+            alive = list(configs)
+            for rung, budget in enumerate(budgets):
+                print(f"Round {round_idx}, rung {rung}: {len(alive)} trials for {budget} epochs")
+                outcomes = _evaluate(executor, objective, {trial: {**fixed, **configs[trial]} for trial in alive}, budget, out_dir, num_threads)
+                for trial in alive:
+                    score, seconds = outcomes[trial]
+                    results.append({"trial": trial, "round": round_idx, "rung": rung, "epochs": budget, **configs[trial], "score": score, "seconds": seconds})
+                    print(f"Trial {trial} {configs[trial]}: {score:.4f} after {budget} epochs ({seconds:.1f} s)")
+                alive = sorted(alive, key=lambda trial: -np.nan_to_num(outcomes[trial][0], nan=-np.inf))[:max(1, len(alive) // eta)]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    results = pd.DataFrame(results)
+    results.to_csv(os.path.join(out_dir, "results.csv"), index=False)
+    return results
+
+def summarize(results:pd.DataFrame) -> pd.DataFrame:
+    '''
+    Returns one row per trial, its evaluation with the largest budget, the trials that went furthest first and then by decreasing score.
+    '''
+    last = results.sort_values("epochs").groupby("trial").tail(1)
+    return last.sort_values(["epochs", "score"], ascending=False).reset_index(drop=True)
+
+def _decoded(model, X:torch.Tensor) -> Dict[str, torch.Tensor]:
+    return {"images": X}
+
+def cache_images(root:str, cache_dir:str, size:int=256, batch_size:int=64, num_procs:int=1) -> str:
+    '''
+    Decodes and resizes the images of an ImageFolder once (sharded across num_procs processes, see parallel.run_sharded) into
+    cache_dir/images.npy, uint8 of shape N x 3 x size x size. All the trials then memory-map the same file, so the decoded images are
+    shared through the page cache instead of being decoded (or held) once per trial; put cache_dir on /dev/shm to keep them in RAM.
+    The cache is reused if it holds the same files at the same size.
+
+    Returns
+    -------
+    cache_dir, to be read with CachedImageFolder.
+    '''
+    transforms = torchvision.transforms.Compose([torchvision.transforms.Resize((size, size)), torchvision.transforms.PILToTensor()])
+    dataset = torchvision.datasets.ImageFolder(root, transform=transforms)
+    meta = {"classes": dataset.classes, "targets": dataset.targets, "paths": [path for path, _ in dataset.samples], "size": size}
+    meta_path = os.path.join(cache_dir, "meta.pth")
+    if os.path.exists(meta_path) and torch.load(meta_path) == meta:
+        return cache_dir
+    parallel.run_sharded(None, dataset, _decoded, batch_size, num_procs, out_dir=cache_dir)
+    # written last: an interrupted decoding is redone
+    torch.save(meta, meta_path)
+    return cache_dir
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    '''
+    The images decoded by cache_images, as (X, y) pairs normalized as datasets.get_bare_transforms does. The memory-mapped array is opened
+    lazily by each process, so that pickling the dataset (e.g., into a trial process) does not copy the images.
+    If indices is not None, the dataset is restricted to those images (e.g., a fold of a cross-validation), keeping all the classes.
+    '''
+    def __init__(self, cache_dir:str, indices:Collection[int]=None):
+        meta = torch.load(os.path.join(cache_dir, "meta.pth"))
+        self.cache_dir = cache_dir
+        self.classes = meta["classes"]
+        self.indices = np.arange(len(meta["targets"])) if indices is None else np.asarray(indices)
+        self.targets = [meta["targets"][i] for i in self.indices]
+        self._images = None
+
+    @property
+    def images(self) -> np.ndarray:
+        if self._images is None:
+            self._images = np.load(os.path.join(self.cache_dir, "images.npy"), mmap_mode="r")
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        X = torch.from_numpy(np.array(self.images[self.indices[idx]])).float().div(255)
+        return (X - 0.5) / 0.5, self.targets[idx]
+
+def cache_features(backbone:torch.nn.Module, image_cache_dir:str, cache_dir:str, batch_size:int=64, num_procs:int=1) -> str:
+    '''
+    Extracts once the layer4 features of the backbone on the images of an image cache (see cache_images) into a memory-mapped .npy
+    file shared by the OpenGAN trials. The features are kept in a folder keyed by the fingerprint of the backbone and of the images.
+
+    Returns
+    -------
+    the path of the .npy file of the features.
+    '''
+    meta = torch.load(os.path.join(image_cache_dir, "meta.pth"))
+    folder = os.path.join(cache_dir, f"features_{utils.fingerprint(backbone, str(meta))}")
+    if not os.path.exists(folder):
+        parallel.run_sharded(backbone, CachedImageFolder(image_cache_dir), gan_data.compute_layer4_features, batch_size, num_procs, out_dir=folder + ".tmp")
+        os.replace(folder + ".tmp", folder)
+    return os.path.join(folder, "features.npy")
+
+def _resume(checkpoint_path:str, **objects) -> int:
+    # loads the state of the objects (model, optimizers, scheduler) saved by _checkpoint and returns the number of epochs already run
+    if not os.path.exists(checkpoint_path):
+        return 0
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    for name, obj in objects.items():
+        obj.load_state_dict(checkpoint[name])
+    return checkpoint["epoch"]
+
+def _checkpoint(checkpoint_path:str, epoch:int, **objects):
+    torch.save({"epoch": epoch, **{name: obj.state_dict() for name, obj in objects.items()}}, checkpoint_path)
+
+def ii_loss_objective(config:dict, budget:int, trial_dir:str) -> float:
+    '''
+    Trains a ResNetCustom with II-loss (as main_ii.py) on the cached training images up to budget epochs, resuming from the checkpoint of
+    trial_dir, and returns the AUROC between the outlier scores of the cached open-set (OOD) and validation (ID) images.
+
+    config holds the hyperparameters lr, lambda_ii, delta_ii, dim_latent and the fixed arguments train_cache, valid_cache, open_cache
+    (see cache_images), model_class, batch_size, lr_decay_epochs, lr_decay_gamma, pretrained_params_path, device and seed.
+    '''
+    device = config["device"]
+    trainset = CachedImageFolder(config["train_cache"])
+    torch.manual_seed(config["seed"])
+    net = models.ResNetCustom(len(trainset.classes), config["model_class"], dim_latent=config["dim_latent"])
+    if config["pretrained_params_path"] is not None:
+        net.load_state_dict(torch.load(config["pretrained_params_path"], map_location="cpu"), strict=False)
+    optimizer = RAdam(net.parameters(), lr=config["lr"])
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=config["lr_decay_epochs"], gamma=config["lr_decay_gamma"])
+    checkpoint_path = os.path.join(trial_dir, "checkpoint.pth")
+    done = _resume(checkpoint_path, model=net, optimizer=optimizer, scheduler=scheduler)
+
+    if budget > done:
+        torch.manual_seed(config["seed"] + done)
+        trainloader = torch.utils.data.DataLoader(trainset, batch_size=config["batch_size"], shuffle=True)
+        train_ii.train_model(net, trainloader, ii_loss.IILoss(delta=config["delta_ii"]), torch.nn.CrossEntropyLoss(), budget - done, optimizer, scheduler, device, lambda_scale=config["lambda_ii"])
+        _checkpoint(checkpoint_path, budget, model=net, optimizer=optimizer, scheduler=scheduler)
+
+    loader = lambda cache: torch.utils.data.DataLoader(CachedImageFolder(cache), batch_size=config["batch_size"], shuffle=False)
+    train_means = eval_ii.get_mean_embeddings(loader(config["train_cache"]), net, device)
+    scores_valid = eval_ii.eval_outlier_scores(loader(config["valid_cache"]), net, train_means, device)
+    scores_open = eval_ii.eval_outlier_scores(loader(config["open_cache"]), net, train_means, device)
+    return metrics.auroc(scores_open.cpu(), scores_valid.cpu())
+
+def opengan_objective(config:dict, budget:int, trial_dir:str) -> float:
+    '''
+    Trains a Generator/DiscriminatorFunnel pair (as main_gan.py) on the cached training features up to budget epochs, resuming from the
+    checkpoint of trial_dir, and returns the validation metric of the discriminator (see gan.train.validate) on the cached validation
+    (ID) and open-set (OOD) features.
+
+    config holds the hyperparameters lr, lr_modifier_D, label_smoothing, base_width (the size of the feature maps of both networks) and
+    the fixed arguments train_features, valid_features, open_features (see cache_features), nz, batch_size, monitor ("auroc" or "W"),
+    device and seed.
+    '''
+    device = config["device"]
+    features_train = np.load(config["train_features"], mmap_mode="r")
+    validation_features = [torch.from_numpy(np.load(config[name])) for name in ("valid_features", "open_features")]
+    nc, spatial_size = features_train.shape[1], features_train.shape[-1]
+    torch.manual_seed(config["seed"])
+    netG = architecture.Generator(nz=config["nz"], ngf=config["base_width"], nc=nc)
+    netD = architecture.DiscriminatorFunnel(nc=nc, ndf=config["base_width"], spatial_size=spatial_size)
+    netG.apply(architecture.weights_init)
+    netD.apply(architecture.weights_init)
+    optimizerD = torch.optim.Adam(netD.parameters(), lr=config["lr"] * config["lr_modifier_D"], betas=(0.5, 0.999))
+    optimizerG = torch.optim.Adam(netG.parameters(), lr=config["lr"], betas=(0.5, 0.999))
+    checkpoint_path = os.path.join(trial_dir, "checkpoint.pth")
+    done = _resume(checkpoint_path, netG=netG, netD=netD, optimizerG=optimizerG, optimizerD=optimizerD)
+
+    if budget > done:
+        torch.manual_seed(config["seed"] + done)
+        loader = torch.utils.data.DataLoader(gan_data.FeatDataset(data=features_train), batch_size=config["batch_size"], shuffle=True)
+        gan_train.train_model(budget - done, loader, netG, netD, 1, 0, optimizerG, optimizerD, config["nz"], torch.randn(64, config["nz"], 1, 1), torch.nn.BCELoss(), device, trial_dir,
+                              spatial_size=spatial_size, label_smoothing_factor=config["label_smoothing"])
+        _checkpoint(checkpoint_path, budget, netG=netG, netD=netD, optimizerG=optimizerG, optimizerD=optimizerD)
+
+    netD.to(device)
+    return gan_train.validate(netD, *(f.to(device).float() for f in validation_features))[config["monitor"]]
@@ -1,3 +1,5 @@
+import hashlib
+import time
 from typing import Collection
 import torch
 import torchvision
@@ -80,4 +82,82 @@ def subset_imagefolder(imagefolder:torchvision.datasets.ImageFolder, indices:Col
     d.imgs = [img for (img, idx) in zip(d.imgs, indices) if idx]
     d.samples = [sample for (sample, idx) in zip(d.samples, indices) if idx]
     d.targets = [target for (target, idx) in zip(d.targets, indices) if idx]
-    return d
\ No newline at end of file
+    return d
+
+def subset_dataloader(dataloader:torch.utils.data.DataLoader, indices:Collection[int]) -> torch.utils.data.DataLoader:
+    '''
+    Returns a non-shuffled dataloader over the given indices of the dataset of a dataloader, with the same batch size and workers.
+    ImageFolders are subset with subset_imagefolder, so that the result still lists its samples (e.g., for a ScoreCache).
+    '''
+    if hasattr(dataloader.dataset, "samples"):
+        mask = np.zeros(len(dataloader.dataset), dtype=bool)
+        mask[list(indices)] = True
+        dataset = subset_imagefolder(dataloader.dataset, mask)
+    else:
+        dataset = torch.utils.data.Subset(dataloader.dataset, list(indices))
+    return torch.utils.data.DataLoader(dataset, batch_size=dataloader.batch_size, shuffle=False, num_workers=dataloader.num_workers)
+
+def fingerprint(*objects) -> str:
+    '''
+    Computes a short hash identifying the content of a set of tensors, state_dicts or modules, e.g. for keying caches of model outputs.
+
+    Parameters
+    ----------
+    objects: any number of torch.Tensor, torch.nn.Module, dicts of tensors (such as state_dicts), bytes (e.g., the content of a file) or strings.
+        None objects are skipped, so that optional settings left unset do not change the fingerprint.
+
+    Returns
+    -------
+    a string of 16 hexadecimal characters.
+    '''
+    h = hashlib.sha1()
+    def _update(obj):
+        if isinstance(obj, torch.nn.Module):
+            obj = obj.state_dict()
+        if isinstance(obj, dict):
+            for key in sorted(obj):
+                h.update(str(key).encode())
+                _update(obj[key])
+        elif isinstance(obj, bytes):
+            h.update(obj)
+        elif isinstance(obj, torch.Tensor):
+            t = obj.detach().cpu()
+            if t.is_quantized:
+                h.update(f"{t.q_scale() if t.qscheme() == torch.per_tensor_affine else t.q_per_channel_scales()}".encode())
+                t = t.int_repr()
+            t = t.contiguous()
+            h.update(f"{t.dtype}{tuple(t.shape)}".encode())
+            h.update(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            h.update(str(obj).encode())
+    for obj in objects:
+        if obj is not None:
+            _update(obj)
+    return h.hexdigest()[:16]
+
+def time_inference(model:torch.nn.Module, X:torch.Tensor, num_runs:int=10, num_warmup:int=2) -> dict:
+    '''
+    Measures the latency of a model on a batch of inputs.
+
+    Parameters
+    ----------
+    model: a torch.nn.Module (or a scripted module) already on the same device as X.
+    X: a batch of inputs.
+    num_runs: the number of timed forward passes.
+    num_warmup: the number of untimed forward passes executed beforehand.
+
+    Returns
+    -------
+    a dict with the median latency per batch in milliseconds ("latency_ms") and the corresponding throughput in datapoints per second ("throughput").
+    '''
+    timings = []
+    with torch.no_grad():
+        for i in range(num_warmup + num_runs):
+            start = time.perf_counter()
+            _ = model(X)
+            if X.is_cuda:
+                torch.cuda.synchronize()
+            if i >= num_warmup:
+                timings.append(time.perf_counter() - start)
+    latency = float(np.median(timings))
+    return {"latency_ms": latency * 1000, "throughput": X.shape[0] / latency}
@@ -0,0 +1,251 @@
+import json
+import os
+import time
+from typing import Collection, Dict, List, Tuple, Union
+
+import torch
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader
+
+from . import datasets
+from .ii_loss.ii_loss import outlier_score
+from .ii_loss.registry import ClassRegistry
+from .storage import ScoreStore, _write_json_atomic
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+def scan_root(root:str) -> Dict[str, Tuple[int, int, str]]:
+    '''
+    Lists the images of a directory laid out like an ImageFolder root (root/<class>/**/<image>).
+
+    Parameters
+    ----------
+    root: the root directory.
+
+    Returns
+    -------
+    a dict mapping the path of each image to a tuple (size in bytes, mtime in nanoseconds, class folder name).
+    '''
+    entries = {}
+    if not os.path.isdir(root):
+        return entries
+    for class_entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if not class_entry.is_dir():
+            continue
+        for dirpath, _, filenames in sorted(os.walk(class_entry.path, followlinks=True)):
+            for filename in sorted(filenames):
+                if not filename.lower().endswith(IMG_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries[path] = (stat.st_size, stat.st_mtime_ns, class_entry.name)
+    return entries
+
+class Manifest(object):
+    '''
+    Keeps track of the (size, mtime) of the files which have already been scored, persisted as a JSON file so that a restarted daemon resumes where it stopped.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def changed(self, scanned:Dict[str, Tuple[int, int, str]]) -> List[str]:
+        '''
+        Returns the paths (in sorted order) of the scanned files which are new or whose size or mtime differ from the ones recorded.
+        '''
+        return sorted(path for path, (size, mtime, _) in scanned.items() if self.entries.get(path) != [size, mtime])
+
+    def update(self, scanned:Dict[str, Tuple[int, int, str]], paths:Collection[str]):
+        for path in paths:
+            size, mtime, _ = scanned[path]
+            self.entries[path] = [size, mtime]
+
+    def save(self):
+        if (folder := os.path.dirname(self.path)) != "":
+            os.makedirs(folder, exist_ok=True)
+        _write_json_atomic(self.entries, self.path)
+
+class PollingWatcher(object):
+    '''
+    Waits a fixed interval between two scans.
+    '''
+    def __init__(self, roots:Collection[str], interval:float=10.0):
+        self.interval = interval
+
+    def wait(self):
+        time.sleep(self.interval)
+
+class InotifyWatcher(object):
+    '''
+    Waits until a file is created, modified or moved within one of the roots (or until the interval expires).
+    Requires the optional package inotify_simple.
+    '''
+    def __init__(self, roots:Collection[str], interval:float=10.0):
+        assert inotify_simple is not None, "InotifyWatcher requires the package inotify_simple"
+        self.roots = roots
+        self.interval = interval
+        self.inotify = inotify_simple.INotify()
+        self.flags = inotify_simple.flags.CREATE | inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO
+        self.watched = set()
+        self._add_watches()
+
+    def _add_watches(self):
+        # new class folders may appear at any time, so the tree is re-walked after each wake-up
+        for root in self.roots:
+            for dirpath, _, _ in os.walk(root, followlinks=True):
+                if dirpath not in self.watched:
+                    self.inotify.add_watch(dirpath, self.flags)
+                    self.watched.add(dirpath)
+
+    def wait(self):
+        self.inotify.read(timeout=int(self.interval * 1000), read_delay=500)
+        self._add_watches()
+
+def get_watcher(roots:Collection[str], interval:float=10.0, use_inotify:bool=True):
+    '''
+    Returns an InotifyWatcher if requested and inotify_simple is installed, a PollingWatcher otherwise.
+    '''
+    if use_inotify and inotify_simple is not None:
+        return InotifyWatcher(roots, interval)
+    return PollingWatcher(roots, interval)
+
+class IIScorer(object):
+    '''
+    Scores a batch of images with a model trained with II-loss, producing the predicted class and the outlier score.
+    If traindata_means is a ClassRegistry, the classes registered in the meantime are picked up before each batch and the predicted class is the
+    one of the closest centroid, since the classification head of the model does not know the registered classes.
+    '''
+    def __init__(self, model:torch.nn.Module, traindata_means:Union[torch.Tensor, ClassRegistry], device:torch.device):
+        self.model = model.to(device).eval()
+        self.registry = traindata_means if isinstance(traindata_means, ClassRegistry) else None
+        self.traindata_means = (traindata_means.means if self.registry is not None else traindata_means).to(device)
+        self.device = device
+
+    def __call__(self, X:torch.Tensor) -> Dict[str, torch.Tensor]:
+        if self.registry is not None and self.registry.refresh():
+            self.traindata_means = self.registry.means.to(self.device)
+        with torch.no_grad():
+            embeddings, y_hat = self.model(X.to(self.device))
+            if self.registry is not None:
+                distances = ((embeddings.unsqueeze(1) - self.traindata_means)**2).sum(2)
+                scores, preds = distances.min(1)
+            else:
+                scores = outlier_score(embeddings, self.traindata_means)
+                preds = y_hat.argmax(1)
+        return {"preds": preds.cpu(), "outlier_scores": scores.cpu()}
+
+class GANScorer(object):
+    '''
+    Scores a batch of images with an OpenGAN discriminator operating on the layer4 features of a backbone.
+    The discriminator is used in eval mode, so that the score of an image does not depend on the other images in the batch.
+    '''
+    def __init__(self, backbone:torch.nn.Module, discriminator:torch.nn.Module, device:torch.device):
+        self.backbone = backbone.to(device).eval()
+        self.discriminator = discriminator.to(device).eval()
+        self.device = device
+        self.features = []
+        self.backbone.layer4.register_forward_hook(lambda module, input_, output: self.features.append(output))
+
+    def __call__(self, X:torch.Tensor) -> Dict[str, torch.Tensor]:
+        with torch.no_grad():
+            self.features.clear()
+            _ = self.backbone(X.to(self.device))
+            outputs = self.discriminator(self.features[0]).view(-1)
+        return {"disc_scores": outputs.cpu()}
+
+class WatchDaemon(object):
+    '''
+    Incrementally scores the images appearing in one or more ImageFolder-like roots and appends the results to a ScoreStore.
+    Only new or modified files (w.r.t. the manifest) are scored. The manifest is checkpointed after each batch has been appended to the store,
+    hence an interruption may at most cause the last batch to be scored twice, never an image to be skipped.
+    '''
+    def __init__(self, roots:Collection[str], store:ScoreStore, manifest:Manifest, scorers:Collection, model_id:str, class_names:Union[List[str], ClassRegistry]=None, splits:List[str]=None, batch_size:int=32, transforms=None, min_age:float=2.0):
+        '''
+        Parameters
+        ----------
+        roots: a collection of directories laid out like ImageFolder roots.
+        store: the ScoreStore where the scores are appended.
+        manifest: the Manifest of the already scored files.
+        scorers: a collection of callables (e.g., IIScorer, GANScorer) mapping a batch of images to a dict of score tensors.
+        model_id: a string identifying the scorers, stored along with the scores.
+        class_names: the class names of the training set (e.g., ImageFolder.classes), used to assign the labels. Images in class folders not in this list get label -1. If None, all labels are -1.
+            It can also be a ClassRegistry, so that the labels follow the classes registered while the daemon runs.
+        splits: the split name to store for each root. If None, the base name of each root is used.
+        batch_size: the maximum number of images scored at once.
+        transforms: the transforms applied to the images. If None, datasets.get_bare_transforms() is used.
+        min_age: files modified less than min_age seconds ago are skipped until the next scan, as they may be still being written.
+        '''
+        self.roots = list(roots)
+        self.store = store
+        self.manifest = manifest
+        self.scorers = scorers
+        self.model_id = model_id
+        self.class_names = class_names
+        self.splits = splits if splits is not None else [os.path.basename(os.path.normpath(root)) for root in self.roots]
+        assert len(self.splits) == len(self.roots), f"Expected one split name per root, got {len(self.splits)} for {len(self.roots)} roots"
+        self.batch_size = batch_size
+        self.transforms = transforms if transforms is not None else datasets.get_bare_transforms()
+        self.min_age = min_age
+
+    @property
+    def class_to_idx(self) -> Dict[str, int]:
+        if isinstance(self.class_names, ClassRegistry):
+            return self.class_names.class_to_idx
+        return {name: idx for idx, name in enumerate(self.class_names)} if self.class_names is not None else {}
+
+    def _score_batch(self, split:str, paths:List[str], scanned:Dict[str, Tuple[int, int, str]]) -> int:
+        images = []
+        valid_paths = []
+        for path in paths:
+            try:
+                images.append(self.transforms(default_loader(path)))
+                valid_paths.append(path)
+            except OSError as e:
+                # unreadable files are recorded in the manifest anyway: they will be retried only if they get modified
+                print(f"Skipping {path}: {e}")
+        if len(valid_paths) > 0:
+            X = torch.stack(images)
+            outputs = {}
+            for scorer in self.scorers:
+                outputs.update(scorer(X))
+            class_to_idx = self.class_to_idx
+            labels = [class_to_idx.get(scanned[path][2], -1) for path in valid_paths]
+            self.store.append_scores(split, valid_paths, self.model_id, labels=labels, **outputs)
+        self.manifest.update(scanned, paths)
+        self.manifest.save()
+        return len(valid_paths)
+
+    def run_once(self) -> int:
+        '''
+        Scans all roots once and scores the new or modified images.
+
+        Returns
+        -------
+        the number of images scored.
+        '''
+        num_scored = 0
+        now_ns = time.time_ns()
+        for root, split in zip(self.roots, self.splits):
+            scanned = scan_root(root)
+            changed = [path for path in self.manifest.changed(scanned) if now_ns - scanned[path][1] >= self.min_age * 1e9]
+            for i in range(0, len(changed), self.batch_size):
+                num_scored += self._score_batch(split, changed[i:i+self.batch_size], scanned)
+            if len(changed) > 0:
+                print(f"[{split}] scored {len(changed)} new or modified images ({len(self.store)} rows in store)")
+        return num_scored
+
+    def run_forever(self, watcher):
+        '''
+        Alternates scans and waits on the given watcher (PollingWatcher or InotifyWatcher) until interrupted.
+        '''
+        while True:
+            self.run_once()
+            watcher.wait()
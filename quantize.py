@@ -0,0 +1,74 @@
+import argparse
+
+import pandas as pd
+import torch
+
+from punches_lib import datasets, quantization
+from punches_lib.cnn import models as cnn_models
+from punches_lib.ii_loss import eval as eval_ii
+from punches_lib.ii_loss import models as ii_models, registry
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", type=str, default="ii", choices=["ii", "cnn"], help="model to quantize: 'ii' for ResNetCustom trained with II-loss, 'cnn' for a plain classifier from main_cnn.py (default: ii).")
+    parser.add_argument("--params_path", type=str, required=True, help="path to the params of the float model.")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class (default: resnet18).")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes in the dataset (default: 19).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space, for II-loss models (default: 32).")
+    parser.add_argument("--mode", type=str, default="static", choices=["static", "dynamic"], help="'static' quantizes weights and activations of all layers after calibration, 'dynamic' only the linear layers (default: static).")
+    parser.add_argument("--backend", type=str, default="x86", choices=["x86", "fbgemm", "qnnpack"], help="quantized engine (default: x86).")
+    parser.add_argument("--root_train", type=str, default="data/train", help="root of training data, used for calibration (default: data/train).")
+    parser.add_argument("--num_calibration_images", type=int, default=320, help="number of training images, randomly sampled, used for calibration (default: 320).")
+    parser.add_argument("--root_valid", type=str, default="data/test", help="root of validation data, used for the comparison (default: data/test).")
+    parser.add_argument("--root_ood", type=str, default=None, help="root of ood data, used for the AUROC of II-loss models (default: None).")
+    parser.add_argument("--mean_embedding_path", type=str, default=None, help="path to the mean embeddings of the float model. Required for II-loss models (default: None).")
+    parser.add_argument("--recompute_means", action="store_true", default=False, help="recompute the mean embeddings with the quantized model on the trainset and save them under <save_path>_means.pth (default: False).")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size (default: 32).")
+    parser.add_argument("--save_path", type=str, default="model/model_int8.pt", help="path where the quantized TorchScript model is saved (default: model/model_int8.pt).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the comparison report is saved (default: None).")
+    parser.add_argument("--seed", type=int, default=0, help="seed for sampling the calibration images (default: 0).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.model_type == "ii":
+        assert args.mean_embedding_path is not None, "--mean_embedding_path is required for II-loss models."
+        net = ii_models.ResNetCustom(args.num_classes, args.model_class, dim_latent=args.dim_latent)
+    else:
+        net = cnn_models.get_model(args.model_class, num_classes=args.num_classes)
+    net.load_state_dict(torch.load(args.params_path, map_location="cpu"))
+    net.eval()
+
+    trainset = datasets.get_dataset(args.root_train, transforms=datasets.get_bare_transforms())
+    generator = torch.Generator().manual_seed(args.seed)
+    calibration_indices = torch.randperm(len(trainset), generator=generator)[:args.num_calibration_images].tolist()
+    calibration_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(trainset, calibration_indices), batch_size=args.batch_size, shuffle=False, num_workers=4)
+
+    if args.mode == "static":
+        quantized_net = quantization.quantize_model_static(net, calibration_loader, num_batches=len(calibration_loader), backend=args.backend)
+    else:
+        quantized_net = quantization.quantize_model_dynamic(net)
+    example_inputs = next(iter(calibration_loader))[0]
+    quantization.save_quantized_model(quantized_net, example_inputs, args.save_path)
+    print(f"Quantized model saved to {args.save_path}")
+
+    validloader = datasets.get_dataloader(args.root_valid, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
+    oodloader = datasets.get_dataloader(args.root_ood, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms()) if args.root_ood is not None else None
+    means = quantized_means = None
+    if args.model_type == "ii":
+        means = registry.load_means(args.mean_embedding_path)
+        if args.recompute_means:
+            trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+            quantized_means = eval_ii.get_mean_embeddings(trainloader, quantized_net, device="cpu")
+            registry.save_means(f"{args.save_path}_means.pth", quantized_means, trainset.classes)
+            print(f"Mean embeddings of the quantized model saved to {args.save_path}_means.pth")
+
+    report = quantization.compare_models(net, quantized_net, validloader, oodloader, traindata_means=means, quantized_traindata_means=quantized_means)
+    report = pd.Series(report)
+    print(report.to_string())
+    if args.report_path is not None:
+        report.to_csv(args.report_path, header=False)
+
+if __name__ == "__main__":
+    main()
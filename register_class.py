@@ -0,0 +1,34 @@
+import argparse
+
+import torch
+
+from punches_lib import datasets
+from punches_lib.ii_loss import models, registry
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name", type=str, required=True, help="punch id of the new class.")
+    parser.add_argument("--images", type=str, nargs="+", required=True, help="image files and/or folders (searched recursively) with the exemplars of the new class.")
+    parser.add_argument("--means_path", type=str, required=True, help="path to the mean embeddings saved by main_ii.py (<model_path>_means.pth), to which the new centroid is appended.")
+    parser.add_argument("--pretrained_params_path", type=str, required=True, help="path to the params of the model trained with II-loss.")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes of the classification head of the model (default: 19).")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=models.MODEL_CLASSES, help="model class: a ResNet trained with II-loss or the architecture of a student distilled with main_distill.py (default: resnet18).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space (default: 32).")
+    parser.add_argument("--classes_root", type=str, default=None, help="root of training data, used to name the existing classes if the means were saved without their punch ids (default: None -> class indices).")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size (default: 32).")
+    parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.device is None:
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    net = models.get_model(args.num_classes, args.model_class, dim_latent=args.dim_latent)
+    net.load_state_dict(torch.load(args.pretrained_params_path, map_location="cpu"))
+    classes = datasets.get_dataset(args.classes_root).classes if args.classes_root is not None else None
+    class_registry = registry.ClassRegistry(args.means_path, classes)
+    registry.register_class(class_registry, args.name, net, args.images, args.device, args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+
+from punches_lib import datasets, metrics, samplers
+from punches_lib.ii_loss import eval as eval_ii, ii_loss, models, train
+from punches_lib.radam import RAdam
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_train", type=str, default="data/train", help="root of training data (default: data/train).")
+    parser.add_argument("--root_valid", type=str, default="data/test", help="root of validation data (default: data/test).")
+    parser.add_argument("--root_ood", type=str, default="data/openset", help="root of ood data (default: data/openset).")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class (default: resnet18).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space (default: 32).")
+    parser.add_argument("--lr", type=float, default=0.001, help="learning rate (default: 0.001).")
+    parser.add_argument("--max_epochs", type=int, default=20, help="maximum number of epochs per run (default: 20).")
+    parser.add_argument("--target_auroc", type=float, default=0.9, help="AUROC (OOD vs. validation) at which a run is stopped (default: 0.9).")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size for the random sampler and for evaluation (default: 32).")
+    parser.add_argument("--classes_per_batch", type=int, default=None, help="number of classes per batch for the balanced sampler (default: None -> all classes).")
+    parser.add_argument("--samples_per_class", type=int, default=2, help="number of images per class in each batch for the balanced sampler (default: 2).")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2], help="seeds; each sampler is run once per seed (default: 0 1 2).")
+    parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the AUROC per epoch of every run is saved (default: None).")
+    return parser.parse_args()
+
+def run(args, sampler_name, seed, trainset, evalloaders):
+    torch.manual_seed(seed)
+    num_classes = len(trainset.classes)
+    net = models.ResNetCustom(num_classes, args.model_class, dim_latent=args.dim_latent)
+    if sampler_name == "balanced":
+        batch_sampler = samplers.ClassBalancedBatchSampler(samplers.dataset_labels(trainset), args.classes_per_batch, args.samples_per_class, seed=seed)
+        trainloader = torch.utils.data.DataLoader(trainset, batch_sampler=batch_sampler, num_workers=4)
+    else:
+        trainloader = torch.utils.data.DataLoader(trainset, batch_size=args.batch_size, shuffle=True, num_workers=4)
+    optimizer = RAdam(net.parameters(), lr=args.lr)
+    history = []
+
+    def evaluate(epoch):
+        means = eval_ii.get_mean_embeddings(evalloaders["train"], net, device=args.device)
+        scores_valid = eval_ii.eval_outlier_scores(evalloaders["valid"], net, means, device=args.device)
+        scores_ood = eval_ii.eval_outlier_scores(evalloaders["ood"], net, means, device=args.device)
+        auroc = metrics.auroc(scores_ood, scores_valid)
+        print(f"[{sampler_name} | seed {seed}] epoch {epoch+1}: AUROC {auroc:.4f}")
+        history.append({"sampler": sampler_name, "seed": seed, "epoch": epoch + 1, "auroc": auroc})
+        return auroc >= args.target_auroc
+
+    train.train_model(net, trainloader, ii_loss.IILoss(), torch.nn.CrossEntropyLoss(), args.max_epochs, optimizer, device=args.device, epoch_callback=evaluate)
+    return history
+
+def main():
+    args = get_args()
+    if args.device is None:
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    trainset = datasets.get_dataset(args.root_train, transforms=datasets.get_bare_transforms())
+    evalloaders = {
+        "train": torch.utils.data.DataLoader(trainset, batch_size=args.batch_size, shuffle=False, num_workers=4),
+        "valid": datasets.get_dataloader(args.root_valid, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms()),
+        "ood": datasets.get_dataloader(args.root_ood, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms()),
+    }
+    history = []
+    for seed in args.seeds:
+        for sampler_name in ("random", "balanced"):
+            history += run(args, sampler_name, seed, trainset, evalloaders)
+    history = pd.DataFrame(history)
+
+    summary = []
+    for (sampler_name, seed), runs in history.groupby(["sampler", "seed"]):
+        reached = runs[runs["auroc"] >= args.target_auroc]
+        summary.append({
+            "sampler": sampler_name,
+            "seed": seed,
+            "epochs_to_target": reached["epoch"].min() if len(reached) > 0 else np.nan,
+            "best_auroc": runs["auroc"].max(),
+        })
+    summary = pd.DataFrame(summary)
+    print(summary.to_string(index=False))
+    print(summary.groupby("sampler")[["epochs_to_target", "best_auroc"]].agg(["mean", "std"]).to_string())
+    if args.report_path is not None:
+        history.to_csv(args.report_path, index=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+
+from punches_lib import datasets, metrics
+from punches_lib.ii_loss import eval as eval_ii
+from punches_lib.ii_loss import models, scorers
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pretrained_params_path", type=str, required=True, help="path to the params of the model trained with II-loss.")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=models.MODEL_CLASSES, help="model class: a ResNet trained with II-loss or the architecture of a student distilled with main_distill.py (default: resnet18).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space (default: 32).")
+    parser.add_argument("--root_train", type=str, default="data/train", help="root of training data, used for the moments (default: data/train).")
+    parser.add_argument("--root_valid", type=str, default="data/test", help="root of validation data (default: data/test).")
+    parser.add_argument("--root_ood", type=str, default="data/openset", help="root of ood data (default: data/openset).")
+    parser.add_argument("--moments_path", type=str, default=None, help="path of the moments of the trainset embeddings. Loaded if it exists, otherwise computed and saved there (default: None).")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size (default: 32).")
+    parser.add_argument("--num_timing_runs", type=int, default=10, help="number of timed scoring runs over the embeddings (default: 10).")
+    parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
+    parser.add_argument("--report_path", type=str, default=None, help="path of a CSV file where the comparison is saved (default: None).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.device is None:
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    trainloader = datasets.get_dataloader(args.root_train, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
+    net = models.get_model(len(trainloader.dataset.classes), args.model_class, dim_latent=args.dim_latent)
+    net.load_state_dict(torch.load(args.pretrained_params_path, map_location="cpu"))
+    moments = scorers.load_or_accumulate_moments(args.moments_path, trainloader, net, args.device)
+
+    # the embeddings are computed once, then scored by every scorer
+    embeddings = {}
+    for split, root in (("valid", args.root_valid), ("ood", args.root_ood)):
+        loader = datasets.get_dataloader(root, args.batch_size, shuffle=False, transforms=datasets.get_bare_transforms())
+        embeddings[split] = eval_ii.get_outputs(loader, net, moments.means().float(), args.device)["embeddings"].to(args.device)
+
+    results = []
+    for name in scorers.SCORERS:
+        scorer = scorers.get_scorer(name, moments).to(args.device)
+        timings = []
+        with torch.no_grad():
+            for _ in range(args.num_timing_runs):
+                if args.device != "cpu":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                scores_valid = scorer(embeddings["valid"])
+                scores_ood = scorer(embeddings["ood"])
+                if args.device != "cpu":
+                    torch.cuda.synchronize()
+                timings.append(time.perf_counter() - start)
+        num_embeddings = len(embeddings["valid"]) + len(embeddings["ood"])
+        results.append({
+            "scorer": name,
+            "auroc": metrics.auroc(scores_ood.cpu(), scores_valid.cpu()),
+            "time_ms": np.median(timings) * 1000,
+            "us_per_embedding": np.median(timings) * 1e6 / num_embeddings,
+        })
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.report_path is not None:
+        results.to_csv(args.report_path, index=False)
+
+if __name__ == "__main__":
+    main()
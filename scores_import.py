@@ -0,0 +1,24 @@
+import argparse
+
+from punches_lib.storage import ScoreStore
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--score_store", type=str, required=True, help="folder of the score store where the scores are imported.")
+    parser.add_argument("--paths", type=str, nargs="+", required=True, help="paths of the bare tensors saved by torch.save (e.g., model/model_ii.pth_valid.pth).")
+    parser.add_argument("--splits", type=str, nargs="+", required=True, help="split of each tensor (e.g., valid crops ood rand).")
+    parser.add_argument("--model_id", type=str, required=True, help="model id stored with the scores.")
+    parser.add_argument("--column", type=str, default="outlier_score", choices=["outlier_score", "disc_score"], help="column where the scores are stored (default: outlier_score).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    assert len(args.paths) == len(args.splits), f"Expected one split per path, got {len(args.splits)} splits for {len(args.paths)} paths"
+    store = ScoreStore(args.score_store)
+    for path, split in zip(args.paths, args.splits):
+        store.import_tensor(path, split, args.model_id, column=args.column)
+        print(f"Imported {path} as split {split}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import os
+
+import pandas as pd
+
+from punches_lib import sweep
+from punches_lib.gan import data as gan_data
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="ii", choices=["ii", "opengan"], help="'ii' sweeps the II-loss network (as main_ii.py), 'opengan' the OpenGAN trained on the layer4 features of a backbone (as main_gan.py) (default: ii).")
+    parser.add_argument("--space", type=str, nargs="+", required=True, help="search space, as name=choice:v1,v2,... , name=uniform:low:high, name=loguniform:low:high or name=int:low:high. Names: lr, lambda_ii, delta_ii, dim_latent for 'ii'; lr, lr_modifier_D, label_smoothing, base_width for 'opengan'. The others keep the defaults of main_ii.py/main_gan.py.")
+    parser.add_argument("--method", type=str, default="random", choices=["grid", "random", "bayes"], help="'grid' evaluates all the combinations of the values (choice and int dimensions only), 'random' draws --num_trials configurations, 'bayes' suggests them with a Tree-structured Parzen Estimator over --num_rounds rounds (default: random).")
+    parser.add_argument("--num_trials", type=int, default=16, help="number of configurations for 'random' and 'bayes' (default: 16).")
+    parser.add_argument("--num_rounds", type=int, default=4, help="number of rounds of 'bayes', each one informed by the results of the previous ones (default: 4).")
+    parser.add_argument("--min_epochs", type=int, default=2, help="epochs of the first rung of successive halving (default: 2).")
+    parser.add_argument("--max_epochs", type=int, default=18, help="epochs of the last rung of successive halving. Set it to --min_epochs to train every trial fully (default: 18).")
+    parser.add_argument("--eta", type=int, default=3, help="only the best 1/eta of the trials of each rung are trained for eta times more epochs (default: 3).")
+    parser.add_argument("--num_procs", type=int, default=1, help="number of processes running the trials concurrently (default: 1).")
+    parser.add_argument("--num_threads", type=int, default=None, help="number of threads of each trial (default: None -> the cores split evenly among the processes).")
+    parser.add_argument("--root_train", type=str, default="data/train", help="root of training data (default: data/train).")
+    parser.add_argument("--root_valid", type=str, default="data/valid", help="root of validation (ID) data (default: data/valid).")
+    parser.add_argument("--root_openset", type=str, default="data/openset", help="root of open-set (OOD) data (default: data/openset).")
+    parser.add_argument("--image_size", type=int, default=256, help="size of the decoded images (default: 256).")
+    parser.add_argument("--cache_dir", type=str, default=None, help="folder of the decoded images and features shared by the trials, e.g. on /dev/shm; reused across sweeps (default: None -> <out_dir>/cache).")
+    parser.add_argument("--out_dir", type=str, default="sweep", help="folder of the trials and of the results table results.csv (default: sweep).")
+    parser.add_argument("--batch_size", type=int, default=32, help="batch size of the trials (default: 32).")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=["resnet18", "resnet34", "resnet50"], help="model class for 'ii' (default: resnet18).")
+    parser.add_argument("--pretrained_params_path", type=str, default=None, help="path to pretrained params of the CNN for 'ii' (default: None).")
+    parser.add_argument("--lr_decay_gamma", type=float, default=0.1, help="learning rate decay factor for 'ii' (default: 0.1).")
+    parser.add_argument("--lr_decay_epochs", type=int, nargs="*", default=[10, 15], help="learning rate decay epochs for 'ii' (default: 10 and 15).")
+    parser.add_argument("--name_modelpth", type=str, default="./modelRes18.pth", help="params of the backbone extracting the features for 'opengan' (default: ./modelRes18.pth).")
+    parser.add_argument("--backbone", type=str, default="resnet18", help="backbone class for 'opengan' (default: resnet18).")
+    parser.add_argument("--nz", type=int, default=100, help="size of the latent vector of the generator for 'opengan' (default: 100).")
+    parser.add_argument("--monitor", type=str, default="auroc", choices=["auroc", "W"], help="validation metric of 'opengan' (the score of 'ii' is the AUROC) (default: auroc).")
+    parser.add_argument("--device", type=str, default="cpu", help="device of the trials (default: cpu).")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the sampling and of the trials (default: 0).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    cache_dir = args.cache_dir or os.path.join(args.out_dir, "cache")
+    image_caches = {}
+    for name, root in (("train", args.root_train), ("valid", args.root_valid), ("open", args.root_openset)):
+        print(f"Decoding the {name} images into {cache_dir}")
+        image_caches[name] = sweep.cache_images(root, os.path.join(cache_dir, f"images_{name}"), args.image_size, args.batch_size, args.num_procs)
+
+    fixed = {"batch_size": args.batch_size, "device": args.device, "seed": args.seed}
+    if args.model == "ii":
+        objective, defaults = sweep.ii_loss_objective, sweep.II_LOSS_DEFAULTS
+        fixed.update({f"{name}_cache": path for name, path in image_caches.items()})
+        fixed.update({"model_class": args.model_class, "pretrained_params_path": args.pretrained_params_path, "lr_decay_gamma": args.lr_decay_gamma, "lr_decay_epochs": args.lr_decay_epochs})
+    else:
+        objective, defaults = sweep.opengan_objective, sweep.OPENGAN_DEFAULTS
+        backbone = gan_data.create_backbone(args.name_modelpth, args.backbone, "cpu")
+        for name, path in image_caches.items():
+            print(f"Extracting the {name} features")
+            fixed[f"{name}_features"] = sweep.cache_features(backbone, path, cache_dir, args.batch_size, args.num_procs)
+        fixed.update({"nz": args.nz, "monitor": args.monitor})
+
+    space = sweep.parse_space(args.space)
+    unknown = set(space) - set(defaults)
+    assert not unknown, f"Unknown hyperparameters {unknown} for --model {args.model}"
+    results = sweep.run_sweep(objective, space, args.method, args.num_trials, {**defaults, **fixed}, args.min_epochs, args.max_epochs, args.eta,
+                              args.num_rounds, args.num_procs, args.num_threads, args.out_dir, args.seed)
+    with pd.option_context("display.width", 200):
+        print(sweep.summarize(results).to_string(index=False))
+    print(f"Results saved to {os.path.join(args.out_dir, 'results.csv')}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import argparse
+import os
+
+import torch
+
+from punches_lib import datasets, utils
+from punches_lib.gan import architecture, compression, data
+from punches_lib.ii_loss import models
+from punches_lib.ii_loss.registry import ClassRegistry, load_means
+from punches_lib.storage import ScoreStore
+from punches_lib.watch import GANScorer, IIScorer, Manifest, WatchDaemon, get_watcher
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--roots", type=str, nargs="+", required=True, help="roots (laid out like ImageFolder roots) to watch for new crops.")
+    parser.add_argument("--splits", type=str, nargs="*", default=None, help="split name stored for each root (default: None -> base name of each root).")
+    parser.add_argument("--store_path", type=str, default="model/scores", help="folder of the score store where the results are appended (default: model/scores).")
+    parser.add_argument("--manifest_path", type=str, default=None, help="path of the manifest of already scored files (default: None -> <store_path>/manifest.json).")
+    parser.add_argument("--model_id", type=str, default=None, help="identifier of the models stored along with the scores (default: None -> names of the param files).")
+    parser.add_argument("--classes_root", type=str, default=None, help="root of training data, used to map class folders to labels (default: None -> all labels are -1).")
+    parser.add_argument("--batch_size", type=int, default=32, help="maximum number of images scored at once (default: 32).")
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds between two scans when polling, or maximum wait with inotify (default: 10).")
+    parser.add_argument("--no_inotify", action="store_true", default=False, help="always poll, even if inotify_simple is installed (default: False).")
+    parser.add_argument("--once", action="store_true", default=False, help="scan the roots once and exit (default: False).")
+    parser.add_argument("--device", type=str, default=None, help="device to use (default: None -> use CUDA if available).")
+    # II-loss scorer
+    parser.add_argument("--ii_params_path", type=str, default=None, help="path to the params of the model trained with II-loss. If None, no II-loss scores are computed (default: None).")
+    parser.add_argument("--mean_embedding_path", type=str, default=None, help="path to the mean embeddings of the training data. Required with --ii_params_path (default: None).")
+    parser.add_argument("--use_registry", action="store_true", default=False, help="load --mean_embedding_path as a class registry: the classes registered with register_class.py while the daemon runs are used for scoring and labels, and the predicted class is the one of the closest mean (default: False).")
+    parser.add_argument("--num_classes", type=int, default=19, help="number of classes of the classification head of the model (default: 19).")
+    parser.add_argument("--model_class", type=str, default="resnet18", choices=models.MODEL_CLASSES, help="model class: a ResNet trained with II-loss or the architecture of a student distilled with main_distill.py (default: resnet18).")
+    parser.add_argument("--dim_latent", type=int, default=32, help="dimension of latent space (default: 32).")
+    # OpenGAN scorer
+    parser.add_argument("--discriminator_path", type=str, default=None, help="path to the params of the OpenGAN discriminator. If None, no discriminator scores are computed (default: None).")
+    parser.add_argument("--backbone_network_feats", type=str, choices=["resnet18", "resnet34", "resnet50"], default="resnet18", help="backbone network for obtaining the features (default: resnet18).")
+    parser.add_argument("--backbone_network_params", type=str, default=None, help="path to the state_dict of the backbone. Required with --discriminator_path (default: None).")
+    parser.add_argument("--nc", type=int, default=512, help="number of channels of the features (default: 512).")
+    parser.add_argument("--ndf", type=int, default=64, help="size of feature maps in discriminator (default: 64).")
+    parser.add_argument("--compressor_path", type=str, default=None, help="path of the feature compressor saved by main_gan.py with --compressor_path. The features are compressed with it before the discriminator, whose number of channels and spatial size follow from it (default: None).")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    assert args.ii_params_path is not None or args.discriminator_path is not None, "Need at least one of --ii_params_path or --discriminator_path."
+    device = args.device if args.device is not None else utils.use_cuda_if_possible()
+
+    scorers = []
+    model_ids = []
+    registry = None
+    if args.ii_params_path is not None:
+        assert args.mean_embedding_path is not None, "--mean_embedding_path is required with --ii_params_path."
+        net = models.get_model(args.num_classes, args.model_class, dim_latent=args.dim_latent)
+        net.load_state_dict(torch.load(args.ii_params_path, map_location="cpu"))
+        if args.use_registry:
+            classes = datasets.get_dataset(args.classes_root).classes if args.classes_root is not None else None
+            registry = ClassRegistry(args.mean_embedding_path, classes)
+            scorers.append(IIScorer(net, registry, device))
+        else:
+            scorers.append(IIScorer(net, load_means(args.mean_embedding_path), device))
+        model_ids.append(os.path.basename(args.ii_params_path))
+    if args.discriminator_path is not None:
+        assert args.backbone_network_params is not None, "--backbone_network_params is required with --discriminator_path."
+        backbone = data.create_backbone(args.backbone_network_params, args.backbone_network_feats, device)
+        compressor = compression.load_compressor(args.compressor_path) if args.compressor_path is not None else None
+        if compressor is not None:
+            netD = architecture.DiscriminatorFunnel(nc=compressor.num_channels(args.nc), ndf=args.ndf, spatial_size=compressor.spatial_size)
+        else:
+            netD = architecture.DiscriminatorFunnel(nc=args.nc, ndf=args.ndf)
+        netD.load_state_dict(torch.load(args.discriminator_path, map_location="cpu"))
+        # the discriminator scores the features compressed as in training
+        scorers.append(GANScorer(backbone, torch.nn.Sequential(compressor, netD) if compressor is not None else netD, device))
+        model_ids.append(os.path.basename(args.discriminator_path))
+
+    if registry is not None:
+        class_names = registry
+    else:
+        class_names = datasets.get_dataset(args.classes_root).classes if args.classes_root is not None else None
+    store = ScoreStore(args.store_path)
+    manifest = Manifest(args.manifest_path if args.manifest_path is not None else os.path.join(args.store_path, "manifest.json"))
+    model_id = args.model_id if args.model_id is not None else "+".join(model_ids)
+
+    daemon = WatchDaemon(args.roots, store, manifest, scorers, model_id, class_names=class_names, splits=args.splits, batch_size=args.batch_size)
+    if args.once:
+        num_scored = daemon.run_once()
+        print(f"Scored {num_scored} images")
+    else:
+        daemon.run_forever(get_watcher(args.roots, args.interval, use_inotify=not args.no_inotify))
+
+if __name__ == "__main__":
+    main()